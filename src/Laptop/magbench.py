@@ -0,0 +1,505 @@
+import argparse
+import ast
+import copy
+import json
+import math
+import os
+import platform
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from magdecode import extract_xyz_pixel, decode_words, parse_data, parse_records, record_poses
+from magdecode import STEP_CONVERSION, MAG_CONVERSION, PIXEL_JUMP_R, PIXEL_JUMP_Z
+from magwire import pack_udp_datagram, unpack_udp_datagram, pack_scan_record, ScanRecordReader
+from magstore import SampleStore
+from simulation import simulate_spi
+
+try:
+    import magrender
+except ImportError:          # opencv missing
+    magrender = None
+try:
+    from matplotlib import colormaps
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+except ImportError:
+    Figure = None
+
+
+# Headless benchmarks of the viewer's hot paths, run on frames from simulation.simulate_spi():
+#   python magbench.py [--quick] [-k NAME] [--repeat N] [--save | --check] [--baseline FILE]
+# Every benchmark runs at three sizes: one frame, 1k frames and a full 200 x 5 x 5 sweep
+# (theta x r x z head positions, 5000 frames of 64 pixels). Legacy paths (per-word decode, JSON
+# datagrams, text records) are kept here as baselines so a change can be compared against them.
+# Run it before and after touching magdecode, magwire, magstore or magrender.
+# --save stores the timings as the baseline (magbench_baseline.json), --check compares against it
+# and exits with status 1 when a benchmark got slower than the tolerance allows. A benchmark that
+# looks slower is measured again with more repeats first, a busy machine easily adds 30 %. Timings
+# only compare on the same machine: regenerate the baseline with --save on the laptop that runs the
+# viewer. Legacy benchmarks are not checked. --check also makes sure GridRenderer still draws exactly
+# what colorize() draws.
+
+SWEEP = (200, 5, 5)          # theta, r and z positions of a full scan
+MAG_TRESHOLD = 12            # same scale as the viewer
+VOXEL_BUDGET = 20000         # FIELD_POINT_BUDGET of the viewer
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "magbench_baseline.json")
+CHECK_TOLERANCE = 0.5        # --check fails on a benchmark more than 50 % slower than the baseline
+CHECK_MIN_SECONDS = 10e-6    # ... and slower by at least this much, below it timer noise dominates
+
+
+# ------------------------------- Workload
+# (location, frame) pairs of a sweep, in scan order. Only SIMULATED_FRAMES distinct frames are
+# simulated and reused, simulate_spi() itself costs about a millisecond.
+SIMULATED_FRAMES = 64
+
+
+def make_scan(n_frames):
+    frames = [simulate_spi() for _ in range(min(n_frames, SIMULATED_FRAMES))]
+    n_theta, n_r, n_z = SWEEP
+    scan = []
+    for i in range(n_frames):
+        tc = i % n_theta
+        rc = (i // n_theta) % n_r
+        zc = (i // (n_theta * n_r)) % n_z
+        location = [tc, 2800 * 7 - rc * 8 * PIXEL_JUMP_R, zc * 8 * PIXEL_JUMP_Z, i]
+        scan.append((location, frames[i % len(frames)]))
+    return scan
+
+
+SIZES = {
+    "1 frame": 1,
+    "1k frames": 1000,
+    "sweep": SWEEP[0] * SWEEP[1] * SWEEP[2],
+}
+
+
+# ------------------------------- Legacy baselines
+# Per-sample parse as the viewer did it before magdecode.parse_records
+def legacy_parse_data(in_data):
+    coord, sensor_data = in_data
+    out = []
+    for word in sensor_data:
+        Bx, By, Bz, pixel = extract_xyz_pixel(word)
+        Bx, By, Bz = Bx * MAG_CONVERSION, By * MAG_CONVERSION, Bz * MAG_CONVERSION
+        tc, rc, zc = coord[0], coord[1] + (pixel // 8) * PIXEL_JUMP_R, coord[2] + (pixel % 8) * PIXEL_JUMP_Z
+        x = rc * math.sin(math.radians(1.8 * tc)) * STEP_CONVERSION
+        y = rc * math.cos(math.radians(1.8 * tc)) * STEP_CONVERSION
+        z = zc * STEP_CONVERSION
+        out.append(((x, y, z), (Bx, By, Bz), pixel))
+    return out
+
+
+# The outlier filter as maglap_filter.py ran it before magrender.filter_outliers, cell by cell
+def legacy_filter_outliers(heatmap, z_thresh=2.5):
+    rows, cols = heatmap.shape
+    filtered_data = heatmap.copy()
+    for i in range(rows):
+        for j in range(cols):
+            neighborhood = heatmap[max(0, i-1):min(rows, i+2), max(0, j-1):min(cols, j+2)]
+            local_mean = np.mean(neighborhood)
+            local_std = np.std(neighborhood)
+            if local_std > 0 and abs(heatmap[i, j] - local_mean) / local_std > z_thresh:
+                filtered_data[i, j] = local_mean
+    return filtered_data
+
+
+# ------------------------------- Benchmarks
+# Each takes the scan and returns a zero-argument callable doing the work once, or (run, setup)
+# when every call has to start from the same state: setup() restores it before each run(), untimed.
+
+def bench_extract_xyz_pixel(scan):
+    words = [word for _, frame in scan for word in frame]
+    return lambda: [extract_xyz_pixel(word) for word in words]
+
+
+def bench_decode_words(scan):
+    words = np.array([frame for _, frame in scan], dtype=np.uint64)
+    return lambda: decode_words(words)
+
+
+def bench_udp_json(scan):
+    datagrams = [json.dumps(frame).encode() for _, frame in scan]
+    return lambda: [decode_words(json.loads(data.decode())) for data in datagrams]
+
+
+def bench_udp_binary(scan):
+    datagrams = [pack_udp_datagram(i, 0.0, [frame]) for i, (_, frame) in enumerate(scan)]
+    return lambda: [decode_words(unpack_udp_datagram(data)[1][-1]) for data in datagrams]
+
+
+def bench_parse_text(scan):
+    lines = [repr([location, frame]) for location, frame in scan]
+
+    def run():
+        for line in lines:
+            legacy_parse_data(ast.literal_eval(line))
+    return run
+
+
+def bench_parse_data(scan):
+    return lambda: [parse_data(item) for item in scan]
+
+
+def bench_parse_records(scan):
+    stream = b"".join(pack_scan_record(location, frame) for location, frame in scan)
+
+    def run():
+        records = ScanRecordReader().feed(stream)
+        parse_records(records)
+        record_poses(records)
+    return run
+
+
+def _samples(scan):
+    store = SampleStore()
+    records = ScanRecordReader().feed(b"".join(pack_scan_record(location, frame) for location, frame in scan))
+    (x, y, z), (Bx, By, Bz), pixel = parse_records(records)
+    pose, counter = record_poses(records)
+    store.append(x, y, z, Bx, By, Bz, pixel, pose, counter)
+    return store.snapshot()
+
+
+# The live heatmap colorized with a fresh image per frame (colorize) or into kept buffers (GridRenderer)
+def _bench_heatmap(scan, render):
+    frames = np.array([frame for _, frame in scan], dtype=np.uint64)
+    heatmap = np.zeros((8, 8), dtype=float)
+
+    def run():
+        for frame in frames:
+            magrender.update_heatmap(heatmap, frame, "M")
+            render(heatmap, invert=True)
+    return run
+
+
+def bench_heatmap_colorize(scan):
+    return _bench_heatmap(scan, lambda grid, **options: magrender.colorize(grid, (400, 400), **options))
+
+
+def bench_heatmap(scan):
+    return _bench_heatmap(scan, magrender.GridRenderer((400, 400)).render)
+
+
+def _bench_heatmap_filtered(scan, filter_outliers, render):
+    frames = np.array([frame for _, frame in scan], dtype=np.uint64)
+    heatmap = np.zeros((8, 8), dtype=float)
+
+    def run():
+        for frame in frames:
+            magrender.update_heatmap(heatmap, frame, "M")
+            filtered = filter_outliers(heatmap)
+            render(filtered, vmax=MAG_TRESHOLD, invert=True)
+    return run
+
+
+def bench_heatmap_filtered_loop(scan):
+    return _bench_heatmap_filtered(scan, legacy_filter_outliers,
+                                   lambda grid, **options: magrender.colorize(grid, (400, 400), **options))
+
+
+def bench_heatmap_filtered(scan):
+    return _bench_heatmap_filtered(scan, magrender.filter_outliers, magrender.GridRenderer((400, 400)).render)
+
+
+def bench_filter_loop(scan):
+    heatmap = _last_heatmap(scan)
+    return lambda: legacy_filter_outliers(heatmap)
+
+
+def bench_filter(scan):
+    heatmap = _last_heatmap(scan)
+    return lambda: magrender.filter_outliers(heatmap)
+
+
+def _last_heatmap(scan):
+    heatmap = np.zeros((8, 8), dtype=float)
+    magrender.update_heatmap(heatmap, np.array(scan[-1][1], dtype=np.uint64), "M")
+    return heatmap
+
+
+def bench_projections(scan):
+    samples = _samples(scan)
+
+    def run():
+        mags = np.sqrt(samples["Bx"] ** 2 + samples["By"] ** 2 + samples["Bz"] ** 2)
+        for u, v in (("x", "y"), ("y", "z"), ("z", "x")):
+            grid = magrender.projection_grid(samples[u], samples[v], mags, grid_size=50)
+            magrender.colorize(grid, (200, 200))
+    return run
+
+
+# One tick of the incremental projections: a frame of new samples on top of the rest of the scan.
+# Every call adds the frame to a fresh copy of the accumulators, which hold all but that frame.
+def bench_projections_incremental(scan):
+    samples = _samples(scan)
+    mags = np.sqrt(samples["Bx"] ** 2 + samples["By"] ** 2 + samples["Bz"] ** 2)
+    planes = (("x", "y"), ("y", "z"), ("z", "x"))
+    filled = [magrender.ProjectionAccumulator() for _ in planes]
+    renderers = [magrender.GridRenderer((200, 200)) for _ in planes]
+    head = slice(0, max(0, len(mags) - 64))
+    tail = slice(head.stop, len(mags))
+    for accumulator, (u, v) in zip(filled, planes):
+        accumulator.add(samples[u][head], samples[v][head], mags[head])
+    accumulators = []
+
+    def setup():
+        accumulators[:] = copy.deepcopy(filled)
+
+    def run():
+        for accumulator, renderer, (u, v) in zip(accumulators, renderers, planes):
+            accumulator.add(samples[u][tail], samples[v][tail], mags[tail])
+            renderer.render(accumulator.grid())
+    return run, setup
+
+
+def bench_voxel_decimate(scan):
+    samples = _samples(scan)
+    mag = np.sqrt(samples["Bx"] ** 2 + samples["By"] ** 2 + samples["Bz"] ** 2)
+    columns = (samples["x"], samples["y"], samples["z"], mag)
+    cell = magrender.voxel_decimate(*columns, VOXEL_BUDGET)[4]
+    # Warm, as on every tick after the first
+    return lambda: magrender.voxel_decimate(*columns, VOXEL_BUDGET, cell=cell)
+
+
+def _field_colors(samples, cmap):
+    mag = np.sqrt(samples["Bx"] ** 2 + samples["By"] ** 2 + samples["Bz"] ** 2)
+    keep = mag <= MAG_TRESHOLD
+    norm = np.clip(mag[keep] / MAG_TRESHOLD, 0, 1)
+    colors = cmap(norm)
+    colors[:, 3] = 0.5 + norm * 0.5
+    return keep, colors
+
+
+def _axes3d():
+    fig = Figure(figsize=(5, 4), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    return canvas, fig.add_subplot(111, projection="3d")
+
+
+# 3D view redrawn the old way: clear the axes and scatter every point again
+def bench_scatter3d_clear(scan):
+    samples = _samples(scan)
+    canvas, ax = _axes3d()
+    cmap = colormaps["viridis_r"]
+
+    def run():
+        ax.clear()
+        keep, colors = _field_colors(samples, cmap)
+        ax.scatter(samples["x"][keep], samples["y"][keep], samples["z"][keep], c=colors, s=10, edgecolors='none')
+        canvas.draw()
+    return run
+
+
+# 3D view as App.update_field_distribution does it: swap the data of one persistent artist
+def bench_scatter3d(scan):
+    samples = _samples(scan)
+    canvas, ax = _axes3d()
+    cmap = colormaps["viridis_r"]
+    scatter = ax.scatter([], [], [], s=10, edgecolors='none')
+
+    def run():
+        keep, colors = _field_colors(samples, cmap)
+        xs, ys, zs = samples["x"][keep], samples["y"][keep], samples["z"][keep]
+        scatter._offsets3d = (xs, ys, zs)
+        scatter.set_facecolor(colors)
+        ax.auto_scale_xyz(xs, ys, zs, had_data=False)
+        canvas.draw()
+    return run
+
+
+# Raster 3D view as cloud_worker draws it on a camera move: every sample, no decimation
+def bench_cloud_raster(scan):
+    samples = _samples(scan)
+    mag = np.sqrt(samples["Bx"] ** 2 + samples["By"] ** 2 + samples["Bz"] ** 2)
+    keep = mag <= MAG_TRESHOLD
+    x, y, z = samples["x"][keep], samples["y"][keep], samples["z"][keep]
+    levels = (np.clip(mag[keep] / MAG_TRESHOLD, 0, 1) * 255).astype(np.uint8)
+    renderer = magrender.PointCloudRenderer((500, 400))
+    matrix = magrender.orbit_matrix(*magrender.bounding_sphere(x, y, z), -60, 30, 1.0, renderer.size)
+    return lambda: renderer.render(x, y, z, levels, matrix)
+
+
+# name -> (benchmark, unit the throughput is counted in, needs, sizes it runs at)
+ALL_SIZES = tuple(SIZES)
+BENCHMARKS = {
+    "extract_xyz_pixel": (bench_extract_xyz_pixel, "word", None, ALL_SIZES),
+    "decode_words": (bench_decode_words, "word", None, ALL_SIZES),
+    "udp json (legacy)": (bench_udp_json, "frame", None, ALL_SIZES),
+    "udp binary": (bench_udp_binary, "frame", None, ALL_SIZES),
+    "parse text (legacy)": (bench_parse_text, "frame", None, ALL_SIZES),
+    "parse_data": (bench_parse_data, "frame", None, ALL_SIZES),
+    "parse_records": (bench_parse_records, "frame", None, ALL_SIZES),
+    "heatmap colorize (legacy)": (bench_heatmap_colorize, "frame", "opencv", ("1 frame", "1k frames")),
+    "heatmap": (bench_heatmap, "frame", "opencv", ("1 frame", "1k frames")),
+    "heatmap filtered (legacy)": (bench_heatmap_filtered_loop, "frame", "opencv", ("1 frame", "1k frames")),
+    "heatmap filtered": (bench_heatmap_filtered, "frame", "opencv", ("1 frame", "1k frames")),
+    "filter loop (legacy)": (bench_filter_loop, "tick", "opencv", ("1 frame",)),
+    "filter": (bench_filter, "tick", "opencv", ("1 frame",)),
+    "projections": (bench_projections, "frame", "opencv", ALL_SIZES),
+    "projections tick": (bench_projections_incremental, "tick", "opencv", ALL_SIZES),
+    "voxel decimate": (bench_voxel_decimate, "frame", "opencv", ALL_SIZES),
+    "scatter3d clear (legacy)": (bench_scatter3d_clear, "frame", "matplotlib", ALL_SIZES),
+    "scatter3d": (bench_scatter3d, "frame", "matplotlib", ALL_SIZES),
+    "cloud raster": (bench_cloud_raster, "frame", "opencv", ALL_SIZES),
+}
+
+
+def available(needs):
+    if needs == "opencv":
+        return magrender is not None
+    if needs == "matplotlib":
+        return Figure is not None
+    return True
+
+
+# Best time of `repeat` runs, each run long enough (autorange) to time reliably
+def measure(fn, repeat):
+    if isinstance(fn, tuple):
+        return measure_with_setup(*fn, repeat)
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+# The same for a (run, setup) benchmark: calls are timed one at a time with setup() in between,
+# until a run has MEASURE_SECONDS of timed calls
+MEASURE_SECONDS = 0.2
+
+
+def measure_with_setup(run, setup, repeat):
+    best = None
+    for _ in range(repeat):
+        elapsed, calls = 0.0, 0
+        while elapsed < MEASURE_SECONDS:
+            setup()
+            t0 = time.perf_counter()
+            run()
+            elapsed += time.perf_counter() - t0
+            calls += 1
+        best = elapsed / calls if best is None else min(best, elapsed / calls)
+    return best
+
+
+# ------------------------------- Output check
+# GridRenderer against colorize() on random grids, mostly of shapes that do not divide the image
+# size evenly (a projection grid cropped to the data rarely does). Returns the mismatches.
+CHECK_RENDER_SIZES = ((200, 200), (400, 400), (500, 400))
+CHECK_RENDER_DIMS = (1, 7, 8, 13, 50, 78, 99, 333)
+
+
+def check_renderer():
+    rng = np.random.default_rng(0)
+    mismatches = []
+    for size in CHECK_RENDER_SIZES:
+        renderer = magrender.GridRenderer(size)
+        for shape in [(rows, cols) for rows in CHECK_RENDER_DIMS for cols in CHECK_RENDER_DIMS]:
+            grid = rng.normal(size=shape)
+            for options in ({}, {"vmax": 2.0}, {"invert": True}):
+                if not np.array_equal(renderer.render(grid, **options), magrender.colorize(grid, size, **options)):
+                    mismatches.append((size, shape, options))
+    return mismatches
+
+
+# ------------------------------- Baseline
+# {"machine": ..., "results": {"<benchmark>/<size>": seconds per call}}
+def save_baseline(path, results):
+    baseline = {
+        "machine": f"{platform.node()} {platform.machine()} {platform.processor()}".strip(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+    # Keep the timings of benchmarks this run skipped (-k, --quick, a missing library)
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline["results"] = {**json.load(f).get("results", {}), **results}
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=1, sort_keys=True)
+    print(f"Saved {len(results)} timings to {path}")
+
+
+def _slower(seconds, before, tolerance):
+    return seconds > before * (1 + tolerance) and seconds - before > CHECK_MIN_SECONDS
+
+
+# Returns the number of regressions against the baseline. remeasure(key) times a benchmark again.
+def check_baseline(path, results, tolerance, remeasure):
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f"\nAgainst {path} ({baseline.get('machine', '?')}, tolerance {tolerance:.0%}):")
+    regressions = 0
+    for key, seconds in results.items():
+        if "(legacy)" in key:
+            continue
+        before = baseline["results"].get(key)
+        if before is None:
+            print(f"  {key:<40}no baseline")
+            continue
+        if _slower(seconds, before, tolerance):
+            seconds = min(seconds, remeasure(key))
+        slower = _slower(seconds, before, tolerance)
+        regressions += slower
+        print(f"  {key:<40}{seconds / before - 1:>+8.0%}{'  REGRESSION' if slower else ''}")
+    print(f"{regressions} regression(s)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the decode, parse and render paths")
+    parser.add_argument("-k", dest="name", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="skip the full sweep size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="baseline file for --save and --check")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--save", action="store_true", help="store the timings as the baseline")
+    mode.add_argument("--check", action="store_true", help="exit with status 1 on a slowdown against the baseline")
+    parser.add_argument("--tolerance", type=float, default=CHECK_TOLERANCE,
+                        help="slowdown --check accepts, as a fraction (0.5 = 50%%)")
+    args = parser.parse_args()
+
+    sizes = {name: n for name, n in SIZES.items() if not (args.quick and name == "sweep")}
+    scans = {name: make_scan(n) for name, n in sizes.items()}
+
+    results = {}
+    jobs = {}
+    print(f"{'benchmark':<26}{'size':<11}{'per call':>12}{'throughput':>20}")
+    for name, (bench, unit, needs, bench_sizes) in BENCHMARKS.items():
+        if args.name not in name:
+            continue
+        if not available(needs):
+            print(f"{name:<26}skipped, {needs} is not installed")
+            continue
+        for size in bench_sizes:
+            if size not in sizes:
+                continue
+            # Throughput in words or frames of the workload, or in calls for per-tick benchmarks
+            items = {"word": 64 * sizes[size], "frame": sizes[size]}.get(unit, 1)
+            seconds = measure(bench(scans[size]), args.repeat)
+            results[f"{name}/{size}"] = seconds
+            jobs[f"{name}/{size}"] = (bench, scans[size])
+            print(f"{name:<26}{size:<11}{seconds * 1e3:>9.3f} ms{items / seconds:>14,.0f} {unit}/s")
+        sys.stdout.flush()
+
+    if args.save:
+        save_baseline(args.baseline, results)
+    elif args.check:
+        if not os.path.exists(args.baseline):
+            sys.exit(f"No baseline at {args.baseline}, run with --save first")
+        def remeasure(key):
+            bench, scan = jobs[key]
+            return measure(bench(scan), 3 * args.repeat)
+        failed = check_baseline(args.baseline, results, args.tolerance, remeasure)
+        if magrender is not None:
+            mismatches = check_renderer()
+            print(f"GridRenderer vs colorize: {len(mismatches)} mismatch(es)")
+            for size, shape, options in mismatches[:10]:
+                print(f"  {shape[0]}x{shape[1]} grid -> {size[0]}x{size[1]} {options}")
+            failed += len(mismatches)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import asyncio
+import itertools
+import socket
+import threading
+import time
+
+from magwire import CommandReader, pack_command_message
+
+
+# ------------------------------- Command channel to the Pi
+# One long-lived TCP connection to the Pi's command port (message format in magwire.py) instead of
+# a new connection per command, so a jog costs one small write instead of a handshake, a send and
+# a close. send() never waits for the Pi: the reply is matched to its request by id and passed to
+# the request's callback when it arrives, and events the Pi pushes on its own go to on_event.
+# run() is a task on the laptop's network loop (magloop.py), the callbacks are called on it.
+# The channel reconnects when the connection drops. A command sent while it is down fails straight
+# away instead of waiting, so a stale jog is never replayed later.
+RECONNECT_DELAY = 0.5        # seconds before a reconnect attempt, doubled after each failure
+RECONNECT_MAX_DELAY = 5.0    # longest wait between reconnect attempts
+CONNECT_TIMEOUT = 2.0
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class CommandChannel:
+    def __init__(self, address, on_event=None):
+        self.address = address
+        self.on_event = on_event
+        self._loop = None
+        self._writer = None
+        self._ids = itertools.count(1)
+        self._pending = {}           # request id -> (cmd, callback, timeout handle), on the loop only
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    # Sends {"cmd": cmd, **args} from any thread and returns its request id. callback(reply) gets the
+    # Pi's reply with "cmd" added, or {"ok": False, "error": ...} if the channel is down, drops
+    # first or no reply came within timeout seconds (None waits as long as the connection lasts).
+    def send(self, cmd, callback=None, timeout=None, **args):
+        request_id = next(self._ids)
+        message = pack_command_message({"id": request_id, "cmd": cmd, **args})
+        if self._writer is None:
+            self._fail(request_id, cmd, callback, "not connected")
+        else:
+            self._loop.call_soon_threadsafe(self._write, request_id, cmd, callback, timeout, message)
+        return request_id
+
+    def _write(self, request_id, cmd, callback, timeout, message):
+        if self._writer is None:
+            self._fail(request_id, cmd, callback, "not connected")
+            return
+        expire = self._loop.call_later(timeout, self._expire, request_id) if timeout is not None else None
+        self._pending[request_id] = (cmd, callback, expire)
+        self._writer.write(message)
+
+    def _expire(self, request_id):
+        cmd, callback, _ = self._pending.pop(request_id)
+        self._fail(request_id, cmd, callback, "timed out")
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, RECONNECT_MAX_DELAY)
+                continue
+            connected = time.monotonic()
+            print(f"[COMMAND] Connected to {self.address[0]}:{self.address[1]}")
+            self._writer = writer
+            try:
+                await self._receive(reader)
+            finally:
+                self._writer = None
+                writer.close()
+                pending, self._pending = self._pending, {}
+                for request_id, (cmd, callback, expire) in pending.items():
+                    if expire is not None:
+                        expire.cancel()
+                    self._fail(request_id, cmd, callback, "connection lost")
+            print("[COMMAND] Connection lost, reconnecting")
+            # Keep backing off while connections keep dropping straight away
+            delay = RECONNECT_DELAY if time.monotonic() - connected > RECONNECT_MAX_DELAY else min(2 * delay, RECONNECT_MAX_DELAY)
+            await asyncio.sleep(delay)
+
+    # Reads messages until the connection ends
+    async def _receive(self, reader):
+        commands = CommandReader()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    return
+                for message in commands.feed(data):
+                    if "id" not in message:
+                        self._answer(self.on_event, message)
+                    elif message["id"] in self._pending:
+                        cmd, callback, expire = self._pending.pop(message["id"])
+                        if expire is not None:
+                            expire.cancel()
+                        self._answer(callback, dict(message, cmd=cmd))
+        except (OSError, ValueError) as e:
+            print(f"[COMMAND] Receive error: {e}")
+
+    def _fail(self, request_id, cmd, callback, error):
+        self._answer(callback, {"id": request_id, "cmd": cmd, "ok": False, "error": error})
+
+    @staticmethod
+    def _answer(callback, message):
+        if callback is None:
+            return
+        try:
+            callback(message)
+        except Exception as e:
+            print(f"[COMMAND] Callback error: {e}")
+
+
+# ------------------------------- Command server, the Pi end
+# Used by simulation.py and magreplay.py, magpi1.py has its own copy (command_listener).
+# handle(message, t_recv) runs for every command and returns the reply fields, {"error": ...} when
+# the command failed, or None when the command replies later through reply() (a motor move).
+# A new connection from the laptop replaces the old one: after a Wi-Fi drop the old one can be dead
+# without this end having noticed.
+class CommandServer:
+    def __init__(self, port, handle):
+        self.port = port
+        self.handle = handle
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def start(self):
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    # Sends a reply or event to the laptop, dropped when it is not connected
+    def send(self, message):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.sendall(pack_command_message(message))
+                except OSError:
+                    pass
+
+    def reply(self, request, **fields):
+        self.send({"id": request.get("id"), "ok": "error" not in fields, **fields})
+
+    def push_event(self, event, **fields):
+        self.send({"event": event, **fields})
+
+    def _listen(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("0.0.0.0", self.port))
+        server.listen(1)
+        print(f"[CMD LISTENER] Listening on port {self.port}")
+        while True:
+            conn, addr = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                if self._conn is not None:
+                    _shutdown(self._conn)
+                self._conn = conn
+            threading.Thread(target=self._session, args=(conn,), daemon=True).start()
+
+    def _session(self, conn):
+        reader = CommandReader()
+        try:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                t_recv = time.time()
+                for message in reader.feed(data):
+                    fields = self.handle(message, t_recv)
+                    if fields is not None:
+                        self.reply(message, **fields)
+        except (OSError, ValueError) as e:
+            print(f"[CMD LISTENER] Connection error: {e}")
+        finally:
+            with self._lock:
+                if self._conn is conn:
+                    self._conn = None
+            conn.close()
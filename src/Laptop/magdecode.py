@@ -0,0 +1,140 @@
+import math
+import numpy as np
+
+
+# ------------------------------- Packet layout
+# One packet is a 64 bit word read out of the FPGA FIFO (see src/CMOD/README.md):
+#   word1: Header (1), Pix ID Upper (3), Timestamp (8), Z Data (16), Y Data [15:12] (4)
+#   word0: Parity (1), Pix ID Lower (3), Y Data [11:0] (12), X Data (16)
+# A frame is 64 packets, one per pixel.
+WORDS_PER_FRAME = 64
+
+# ------------------------------- Rig geometry
+STEP_CONVERSION = 0.01       # motor steps -> plot units
+MAG_CONVERSION = 1 / 137     # Conversion from LSB to mT
+PIXEL_JUMP_R = 560           # r steps between sensor rows
+PIXEL_JUMP_Z = 560           # z steps between sensor columns
+THETA_STEPS = 200            # theta steps per revolution (1.8 degrees per step)
+
+_MASK3 = np.uint64(0x7)
+_MASK4 = np.uint64(0xF)
+_MASK8 = np.uint64(0xFF)
+_MASK12 = np.uint64(0xFFF)
+_MASK16 = np.uint64(0xFFFF)
+
+
+# ------------------------------- Single word decode
+def to_signed(val):
+    return val - 0x10000 if val & 0x8000 else val
+
+
+def extract_xyz_pixel(word):
+    word1 = (word >> 32) & 0xFFFFFFFF
+    word0 = word & 0xFFFFFFFF
+    pix_id_upper = (word1 >> 28) & 0x7
+    timestamp = (word1 >> 20) & 0xFF
+    z_data = (word1 >> 4) & 0xFFFF
+    y_upper = word1 & 0xF
+    pix_id_lower = (word0 >> 28) & 0x7
+    y_lower = (word0 >> 16) & 0xFFF
+    x_data = word0 & 0xFFFF
+    y_data = (y_upper << 12) | y_lower
+    pixel = (pix_id_upper << 3) | pix_id_lower
+    x_signed = to_signed(x_data)
+    y_signed = to_signed(y_data)
+    z_signed = to_signed(z_data)
+    return x_signed, y_signed, z_signed, pixel
+
+
+# ------------------------------- Batch decode
+# Vectorised extract_xyz_pixel for a whole frame (shape (64,)) or a stack of frames (shape (N, 64)).
+# Accepts anything np.asarray understands as uint64 (a list of ints straight from the wire works).
+# Returns Bx, By, Bz as int16, pixel and the 8 bit FPGA timestamp as uint8, all with the input shape.
+def decode_words(words):
+    words = np.asarray(words, dtype=np.uint64)
+    x_data = words & _MASK16
+    y_data = (((words >> np.uint64(32)) & _MASK4) << np.uint64(12)) | ((words >> np.uint64(16)) & _MASK12)
+    z_data = (words >> np.uint64(36)) & _MASK16
+    timestamp = (words >> np.uint64(52)) & _MASK8
+    pixel = (((words >> np.uint64(60)) & _MASK3) << np.uint64(3)) | ((words >> np.uint64(28)) & _MASK3)
+    # Reinterpreting the low 16 bits as int16 is the two's complement to_signed() does by hand
+    Bx = x_data.astype(np.uint16).view(np.int16)
+    By = y_data.astype(np.uint16).view(np.int16)
+    Bz = z_data.astype(np.uint16).view(np.int16)
+    return Bx, By, Bz, pixel.astype(np.uint8), timestamp.astype(np.uint8)
+
+
+# Value plotted for the selected mode: "X"/"Y"/"Z" for a signed component, anything else for |B|.
+# Bx is negated to match the orientation of the sensor head.
+def field_component(Bx, By, Bz, choice):
+    if choice == "X":
+        return -Bx
+    elif choice == "Y":
+        return By
+    elif choice == "Z":
+        return Bz
+    return np.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
+
+
+# ------------------------------- Cylindrical -> cartesian tables
+# Built with math.sin/math.cos so the values match the per-sample math exactly. Step counts outside
+# one revolution (a move or jog past 0 or 200) are computed the same way, folding them onto the
+# table would change the last bits.
+SIN_THETA = np.array([math.sin(math.radians(1.8 * tc)) for tc in range(THETA_STEPS)])
+COS_THETA = np.array([math.cos(math.radians(1.8 * tc)) for tc in range(THETA_STEPS)])
+# Offset of every pixel from the head position: pixel // 8 is the row along r, pixel % 8 the column along z
+PIXEL_OFFSET_R = (np.arange(WORDS_PER_FRAME) // 8) * PIXEL_JUMP_R
+PIXEL_OFFSET_Z = (np.arange(WORDS_PER_FRAME) % 8) * PIXEL_JUMP_Z
+
+
+# sin and cos of the theta angle for an array of theta step counts
+def _theta_trig(n_theta):
+    tc = np.asarray(n_theta, dtype=np.int64)
+    flat = tc.reshape(-1)
+    sin = SIN_THETA[flat % THETA_STEPS]
+    cos = COS_THETA[flat % THETA_STEPS]
+    for i in np.flatnonzero((flat < 0) | (flat >= THETA_STEPS)).tolist():
+        angle = math.radians(1.8 * int(flat[i]))
+        sin[i], cos[i] = math.sin(angle), math.cos(angle)
+    return sin.reshape(tc.shape), cos.reshape(tc.shape)
+
+
+def _to_cartesian(n_theta, n_r, n_z, words):
+    Bx, By, Bz, pixel, _ = decode_words(words)
+    Bx, By, Bz = Bx * MAG_CONVERSION, By * MAG_CONVERSION, Bz * MAG_CONVERSION
+    sin, cos = _theta_trig(n_theta)
+    rc = n_r + PIXEL_OFFSET_R[pixel]
+    zc = n_z + PIXEL_OFFSET_Z[pixel]
+
+    x = rc * sin * STEP_CONVERSION
+    y = rc * cos * STEP_CONVERSION
+    z = zc * STEP_CONVERSION
+    return (x, y, z), (Bx, By, Bz), pixel
+
+
+# convert 1 frame (location + up to 64 sensor words) into cartesian coordinates
+# Returns ((x, y, z), (Bx, By, Bz), pixel) with one array entry per sensor word.
+def parse_data(in_data):
+    coord, sensor_data = in_data
+    return _to_cartesian(coord[0], coord[1], coord[2], sensor_data)
+
+
+# Mask of the valid words of every record and the record index of each valid word
+def _valid_words(records):
+    valid = np.arange(WORDS_PER_FRAME) < records["n_words"][:, None]
+    return valid, np.nonzero(valid)[0]
+
+
+# Same as parse_data for a whole array of scan records (magwire.TCP_RECORD_DTYPE) at once.
+# The result is flattened over records, only the valid words of each record are kept.
+def parse_records(records):
+    valid, rows = _valid_words(records)
+    return _to_cartesian(records["n_theta"][rows], records["n_r"][rows].astype(np.int64),
+                         records["n_z"][rows].astype(np.int64), records["words"][valid])
+
+
+# Motor pose (n_theta, n_r, n_z) and acquisition counter for every sample parse_records returns
+def record_poses(records):
+    valid, rows = _valid_words(records)
+    pose = np.stack([records["n_theta"][rows], records["n_r"][rows], records["n_z"][rows]], axis=1)
+    return pose, records["counter"][rows]
@@ -2,12 +2,10 @@ import sys
 import threading
 import time
 import socket
-import ast
+import asyncio
+import queue
 import numpy as np
-import math
-import cv2
 import subprocess
-import json
 
 import tkinter as tk
 from tkinter import ttk, messagebox
@@ -21,67 +19,54 @@ from matplotlib import colors
 # For the 3D plot embedding
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib import gridspec, cm
+from matplotlib import gridspec, cm, colormaps
 from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
 
 
 # ------------------------------- Utility
-def to_signed(val):
-    return val - 0x10000 if val & 0x8000 else val
-
-
-def extract_xyz_pixel(word):
-    word1 = (word >> 32) & 0xFFFFFFFF
-    word0 = word & 0xFFFFFFFF
-    pix_id_upper = (word1 >> 28) & 0x7
-    timestamp = (word1 >> 20) & 0xFF
-    z_data = (word1 >> 4) & 0xFFFF
-    y_upper = word1 & 0xF
-    pix_id_lower = (word0 >> 28) & 0x7
-    y_lower = (word0 >> 16) & 0xFFF
-    x_data = word0 & 0xFFFF
-    y_data = (y_upper << 12) | y_lower
-    pixel = (pix_id_upper << 3) | pix_id_lower
-    x_signed = to_signed(x_data)
-    y_signed = to_signed(y_data)
-    z_signed = to_signed(z_data)
-    return x_signed, y_signed, z_signed, pixel
-
-
-# convert 1 frame (location + 64 sensor data) into cartesian coordinates
-def parse_data(in_data):
-    coord, sensor_data = in_data
-    for word in sensor_data:
-        Bx, By, Bz, pixel = extract_xyz_pixel(word)
-        Bx, By, Bz = Bx * MAG_CONVERSION, By * MAG_CONVERSION, Bz * MAG_CONVERSION
-        tc, rc, zc = coord[0], coord[1] + (pixel // 8) * PIXEL_JUMP_R, coord[2] + (pixel % 8) * PIXEL_JUMP_Z
-
-        x = rc * math.sin(math.radians(1.8 * tc)) * STEP_CONVERSION
-        y = rc * math.cos(math.radians(1.8 * tc)) * STEP_CONVERSION
-        z = zc * STEP_CONVERSION
-
-    return ((x, y, z), (Bx, By, Bz), pixel)
+from magdecode import parse_records, record_poses, field_component, WORDS_PER_FRAME
+from magwire import unpack_udp_datagram, ScanRecordReader, UDP_HEADER, SCAN_HELLO, unpack_scan_hello
+from magscanfile import BackgroundScanWriter, UdpCaptureWriter
+from magstore import SampleStore
+from magrender import update_heatmap, filter_outliers, GridRenderer, DoubleBuffer, ProjectionAccumulator, voxel_decimate
+from magrender import PointCloudRenderer, orbit_matrix, bounding_sphere
+from magrender import Z_THRESH, MIN_FRAME_STD
+from maglatency import LatencyTracer, estimate_clock_offset
+from magschedule import FrameScheduler
+from magstream import StreamHealth, MetricsLog
+from magcommand import CommandChannel
+from magloop import NetworkLoop
+from magresume import ScanResume
 
 
 # ------------------------------- Global variables
 
 SIMULATION = 1  #Variable for our simulation interface, if it is 1 we run a simulation of a file acting like the Rpi else 0 for the original code
-mag_data = []
+mag_data = SampleStore()  # every parsed scan sample, column by column (see magstore.py)
 udp_mag_data = None
+udp_mag_seq = None  # sequence number of the datagram udp_mag_data came from
+udp_mag_generation = 0  # bumped for every new udp_mag_data, the heatmap redraws only when it changed
 udp_heatmap_image = None
 file_lock = threading.Lock()
-MAG_CONVERSION = 1 / 137 #Conversion from LSB to mT
+scan_file = None  # BackgroundScanWriter for the current scan
+udp_capture = None  # UdpCaptureWriter when RECORD_UDP is on
+network = NetworkLoop()  # asyncio loop all laptop networking runs on, see magloop.py
 
 # Rate measurement
 UDP_RATE_WINDOW = 5  # seconds to calculate average rate
 udp_packet_times = deque(maxlen=1000)
 udp_rate = 0  # packets per second
+udp_superseded = 0  # datagrams drained in the same wake-up as a newer one, never shown
+stream_health = StreamHealth()  # loss, reordering, jitter and per-stage frame rates of the UDP stream, see magstream.py
+stream_metrics = None  # MetricsLog of stream_health when STREAM_METRICS_INTERVAL is on
+latency = LatencyTracer()  # per-stage latency of the live heatmap, see maglatency.py
 
 # OpenCV window flag
 opencv_window_active = True
 MAG_TRESHOLD = 12 # Threshold to avoid noise in plots
 SCALE = 300
 magchoice = "M"
+heatmap_filter = "--filter" in sys.argv  # z-score outlier filter on the live heatmap, toggled with the f key
 
 
 # ------------------------------- Remote Launch
@@ -129,11 +114,10 @@ def get_pi_ip(pi_hostname, username, password):
         print("Failed to get Raspberry Pi IP address:", e)
         return None
 
-#Connects to Rpi using SSH and launches program in RPi in a proper manner
+#Connects to Rpi using SSH and launches program in RPi in a proper manner. Returns the remote shell.
 def ssh_execute(pi_ip, remote_script_path, laptop_ip):
     global remote_shell, ssh_client
     remote_command = remote_script_path + " " + laptop_ip + " " + str(LAPTOP_RECEIVE_PORT) + " " + str(LAPTOP_COMMAND_PORT) + " " + str(UDP_HEATMAP_PORT)  # Pass laptop IP as argument
-    output_file = "rpi_output.txt"
     ssh_client = paramiko.SSHClient()
     ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
@@ -144,24 +128,10 @@ def ssh_execute(pi_ip, remote_script_path, laptop_ip):
         remote_shell = ssh_client.invoke_shell()
         time.sleep(0.5)
         remote_shell.send(remote_command + "\n")
-
-        def log_remote_output(shell, output_file):
-            with open(output_file, "w") as f:
-                try:
-                    while True:
-                        if shell.recv_ready():
-                            output = shell.recv(1024).decode("utf-8")
-                            sys.stdout.write(output)
-                            sys.stdout.flush()
-                            f.write(output)
-                            f.flush()
-                        time.sleep(0.1)
-                except Exception as e:
-                    print("Error in reading remote output:", e)
-
-        threading.Thread(target=log_remote_output, args=(remote_shell, output_file), daemon=True).start()
+        return remote_shell
     except Exception as e:
         print("An error occurred in ssh_execute:", e)
+        return None
 
 #Initialisation
 def initializer(pi_hostname, pi_username, pi_password, remote_script_path):
@@ -171,7 +141,28 @@ def initializer(pi_hostname, pi_username, pi_password, remote_script_path):
     if not pi_ip:
         raise Exception("Could not retrieve Raspberry Pi IP address")
     print("Raspberry Pi IP Address:", pi_ip)
-    ssh_execute(pi_ip, remote_script_path, laptop_ip)
+    return ssh_execute(pi_ip, remote_script_path, laptop_ip)
+
+# Copy the remote script's output to the console and a log file, on the network loop
+async def remote_log(shell, output_file):
+    with open(output_file, "w") as f:
+        try:
+            while not shell.closed:
+                while shell.recv_ready():
+                    output = shell.recv(1024).decode("utf-8", errors="replace")
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+                    f.write(output)
+                    f.flush()
+                await asyncio.sleep(REMOTE_LOG_POLL)
+        except Exception as e:
+            print("Error in reading remote output:", e)
+
+# Launch the remote script and follow its output. paramiko blocks, so the SSH login runs on a worker thread.
+async def start_remote(pi_hostname, pi_username, pi_password, remote_script_path):
+    shell = await asyncio.to_thread(initializer, pi_hostname, pi_username, pi_password, remote_script_path)
+    if shell is not None:
+        await remote_log(shell, REMOTE_LOG_FILE)
 
 
 
@@ -193,14 +184,34 @@ PI_USERNAME = "raunak"
 PI_PASSWORD = "123"
 #REMOTE_SCRIPT_PATH = "python /home/raunak/p2.py "
 REMOTE_SCRIPT_PATH = "python /home/raunak/magpi1.py"
+REMOTE_LOG_FILE = "rpi_output.txt"  # output of the remote script
+REMOTE_LOG_POLL = 0.1  # seconds between reads of the remote output
 BUFFER_SIZE = 1024
-DATA_FILE = "plot.txt"  # We'll also write out completed blocks here (optional)
+TCP_RECV_SIZE = 1 << 16  # bytes per recv() on the scan channel, ~120 records
+SCAN_FILE_FORMAT = "scan_%Y%m%d_%H%M%S.mscan"  # one binary scan file per scan, see magscanfile.py
+SCAN_WRITE_QUEUE = 256  # receive buffers the disk writer may fall behind by before the receiver waits
+SCAN_FSYNC_INTERVAL = 2.0  # seconds between fsyncs of the scan file
+SCAN_ACK_INTERVAL = 0.5  # seconds between acks to the Pi, which resends unacked records after a reconnect
+RECORD_UDP = False  # also record the live heatmap stream, for replay
+UDP_CAPTURE_FORMAT = "udp_%Y%m%d_%H%M%S.mudp"
+UDP_FRAME_RATE = 2000  # most heatmap datagrams per second the Pi sends, sizes the UDP socket buffer
+UDP_BUFFER_SECONDS = 0.5  # datagrams the socket buffer holds while the receiver is descheduled, in seconds
+STREAM_METRICS_INTERVAL = 5  # seconds between rows of UDP stream metrics in the CSV file, 0 = off
+STREAM_METRICS_FORMAT = "stream_%Y%m%d_%H%M%S.csv"
+
+# Replay (SIMULATION = 1 only): play a recorded scan through the receivers instead of running simulation.py
+REPLAY_FILE = None  # .mscan scan file or an old parsed_data.txt
+REPLAY_UDP_FILE = None  # optional .mudp capture for the live heatmap, else the scan frames are used
+REPLAY_SPEED = "1"  # 1 = recorded speed, N = N times faster, "max" = as fast as possible
 
 UPDATE_INTERVAL = 33  # update interval in ms
-STEP_CONVERSION = 0.01
-MAG_CONVERSION = 1 / 137
-PIXEL_JUMP_R = 560
-PIXEL_JUMP_Z = 560
+FRAME_BUDGET = 25  # ms of view updates per frame; heavier views are throttled to fit (see magschedule.py)
+PROJECTION_PLANES = (("x", "y"), ("y", "z"), ("z", "x"))  # axes of the 2D projections, top to bottom
+FIELD_POINT_BUDGET = 20000  # most points drawn in the 3D view, more samples are averaged per voxel
+FIELD_VOXEL_REDUCE = "mean"  # value shown per voxel: "mean" or "max" of the selected field
+FIELD_VIEW = "matplotlib"  # 3D view: "matplotlib" (axes, toolbar, colorbar) or "raster" (every sample, drag to rotate, wheel to zoom)
+CLOUD_POINT_SIZE = 2  # pixels per point side in the raster 3D view
+LATENCY_REPORT_INTERVAL = 10  # seconds between per-stage latency reports on the console, 0 = off
 
 LAPTOP_RECEIVE_PORT = get_free_port()
 LAPTOP_COMMAND_PORT = get_free_port()
@@ -210,114 +221,386 @@ if SIMULATION==1:
 else:
     RPi_IP = get_pi_ip(PI_HOSTNAME, PI_USERNAME, PI_PASSWORD)
 
-# At startup, clear and recreate the output file.
-with open(DATA_FILE, 'w') as f:
-    f.truncate(0)
-print(f"[INIT] {DATA_FILE} has been recreated.")
-
 # ------------------------------- Start Simulated p1.py (once only)
 if SIMULATION==1:
     if __name__ == '__main__':
-        subprocess.Popen([
-            sys.executable, "simulation.py",
-            RPi_IP,
-            str(LAPTOP_RECEIVE_PORT),
-            str(LAPTOP_COMMAND_PORT),
-            str(UDP_HEATMAP_PORT)
-        ])
+        if REPLAY_FILE:
+            # Replay a recorded scan through the same receivers (see magreplay.py)
+            replay_args = [REPLAY_FILE, "--speed", str(REPLAY_SPEED)]
+            if REPLAY_UDP_FILE:
+                replay_args += ["--udp", REPLAY_UDP_FILE]
+            subprocess.Popen([
+                sys.executable, "magreplay.py",
+                RPi_IP,
+                str(LAPTOP_RECEIVE_PORT),
+                str(LAPTOP_COMMAND_PORT),
+                str(UDP_HEATMAP_PORT)
+            ] + replay_args)
+        else:
+            subprocess.Popen([
+                sys.executable, "simulation.py",
+                RPi_IP,
+                str(LAPTOP_RECEIVE_PORT),
+                str(LAPTOP_COMMAND_PORT),
+                str(UDP_HEATMAP_PORT)
+            ])
 
 
 # ------------------------------- Command Sender
-def send_command(cmd):
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((RPi_IP, LAPTOP_COMMAND_PORT))
-            s.sendall(cmd.encode())
-            response = s.recv(1024).decode()
-            print(f"[COMMAND] Sent: {cmd}, Received: {response.strip()}")
-    except Exception as e:
-        print(f"[COMMAND] Error sending '{cmd}': {e}")
+# Commands go to the Pi over one persistent connection (see magcommand.py). Replies and the events
+# the Pi pushes are queued here and handled on the Tk thread by App.update_commands.
+command_messages = queue.Queue()
+command_channel = CommandChannel((RPi_IP, LAPTOP_COMMAND_PORT), on_event=command_messages.put)
 
 
-# ------------------------------- TCP Receiver
+# Send a command without waiting for the Pi, its reply comes back through command_messages
+def send_command(cmd, **args):
+    command_channel.send(cmd, command_messages.put, **args)
+
+
+# Estimate the Pi clock offset for the latency trace (see maglatency.py). The probes run on the
+# network loop and clock_estimated is called back from there, so nothing waits for them.
+def sync_clock():
+    estimate_clock_offset(command_channel, clock_estimated)
+
+
+def clock_estimated(estimate):
+    if estimate is None:
+        print("[CLOCK] No clock offset from the remote script, latencies include the clock offset")
+        return
+    latency.set_clock_offset(*estimate)
+    print(f"[CLOCK] Pi clock offset {estimate[0] * 1e3:+.2f} ms (round trip {estimate[1] * 1e3:.2f} ms)")
+
+
+latency.on_restart = sync_clock  # a restarted Pi script has a new clock offset
 
-def persistent_receiver():
-    global mag_data
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(("0.0.0.0", LAPTOP_RECEIVE_PORT))
-    server.listen(1)
-    while True:
-        try:
-            conn, addr = server.accept()
-            with conn:
-                # Create a file-like object for reading incoming lines.
-                with conn.makefile() as f:
-                    for line in f:
-                        try:
-                            tcpdata = ast.literal_eval(line.strip())
-                            parsed = parse_data(tcpdata)
-                            mag_data.append(parsed)
-                            # Append parsed data to the file
-                            with open(log_filename, "a") as log_file:
-                                log_file.write(f"{tcpdata}\n")
-
-                        except Exception as e:
-                            print("[TCP RECEIVER] Parsing error:", e)
-        except Exception as e:
-            print(f"[TCP RECEIVER] Exception: {e}")
-            time.sleep(1)
+
+# ------------------------------- Scan File
+# Start recording to a new scan file. Disk writes happen on the scan writer's own thread.
+def new_scan_file():
+    global scan_file
+    path = datetime.now().strftime(SCAN_FILE_FORMAT)
+    with file_lock:
+        if scan_file is None:
+            scan_file = BackgroundScanWriter(path, max_queue=SCAN_WRITE_QUEUE, fsync_interval=SCAN_FSYNC_INTERVAL)
+        else:
+            scan_file.roll(path)
+    print(f"[INIT] Recording scan to {path}")
+
+
+# ------------------------------- TCP Receiver
+scan_resume = ScanResume(ack_interval=SCAN_ACK_INTERVAL)  # where the Pi's scan stream is up to, across reconnects
+scan_connection = None  # writer of the current scan connection, a new one from the Pi replaces it
+
+
+# A server task on the network loop, each connection from the Pi is read by receive_scan.
+# The Pi resends what was not acknowledged when it reconnects (see magresume.py), records are acked
+# once they are queued for the scan file.
+async def scan_receiver():
+    server = await asyncio.start_server(receive_scan, "0.0.0.0", LAPTOP_RECEIVE_PORT, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+async def receive_scan(stream, writer):
+    global mag_data, scan_connection
+    # After a Wi-Fi drop the old connection can be dead without this end having noticed
+    if scan_connection is not None:
+        scan_connection.close()
+    scan_connection = writer
+    reader = ScanRecordReader()
+    try:
+        stream_id, first_seq = unpack_scan_hello(await stream.readexactly(SCAN_HELLO.size))
+        writer.write(scan_resume.hello(stream_id, first_seq))
+        print(f"[TCP RECEIVER] Scan stream {stream_id:08x} from record {first_seq}")
+        while True:
+            try:
+                data = await asyncio.wait_for(stream.read(TCP_RECV_SIZE), SCAN_ACK_INTERVAL)
+            except asyncio.TimeoutError:
+                # Stream went quiet, ack what came in since the last ack
+                if scan_resume.ack_due():
+                    writer.write(scan_resume.ack())
+                continue
+            if not data:
+                break
+            # Every complete record in this buffer comes back as one array (see magwire.py),
+            # minus records a resend repeated
+            records = scan_resume.accept(reader.feed(data))
+            if len(records) == 0:
+                continue
+            # Every sensor of every record in the buffer, converted in one pass
+            try:
+                (x, y, z), (Bx, By, Bz), pixel = parse_records(records)
+                pose, counter = record_poses(records)
+                mag_data.append(x, y, z, Bx, By, Bz, pixel, pose, counter)
+            except Exception as e:
+                print("[TCP RECEIVER] Parsing error:", e)
+            # Queue the raw records of this buffer for the scan file writer. When the disk falls
+            # behind, wait for it on a worker thread: this connection stops being read (TCP
+            # backpressure to the Pi) while the rest of the loop carries on.
+            if not scan_file.write_nowait(records):
+                await asyncio.to_thread(scan_file.write_wait, records)
+            if scan_resume.ack_due():
+                writer.write(scan_resume.ack())
+    except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+        print(f"[TCP RECEIVER] Exception: {e}")
+    except asyncio.CancelledError:
+        # Network loop stopping. Connection handlers end quietly, asyncio reports a cancelled one as an error.
+        pass
+    finally:
+        if scan_connection is writer:
+            scan_connection = None
+        writer.close()
 
 
 # ------------------------------- UDP Receiver
-def udp_persistent_receiver():
-    global udp_mag_data, udp_rate, udp_packet_times
+# The network loop calls drain_udp_socket when the socket is readable, which drains every datagram
+# that is waiting. Each one is timed, recorded and counted (latency, stream_health), but only the
+# newest frame of the burst is handed to the heatmap; the others are counted as superseded.
+UDP_MAX_DATAGRAM = 65535
+UDP_MAX_BURST = 1024  # datagrams per wake-up before the other network tasks get a turn
+
+
+# SO_RCVBUF for UDP_BUFFER_SECONDS of datagrams at UDP_FRAME_RATE. The kernel charges about twice
+# the payload per datagram. Linux caps the request at net.core.rmem_max, so the size actually
+# granted is read back and a shortfall reported.
+def size_udp_buffer(sock, datagram_size):
+    wanted = int(UDP_FRAME_RATE * UDP_BUFFER_SECONDS * datagram_size * 2)
+    current = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if wanted > current:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, wanted)
+        current = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if current < wanted:
+        print(f"[UDP RECEIVER] Socket buffer {current} bytes, {wanted} wanted (raise net.core.rmem_max)")
+    return current
+
+
+async def udp_receiver():
     udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    size_udp_buffer(udp_sock, UDP_HEADER.size + WORDS_PER_FRAME * 8)
     udp_sock.bind(("0.0.0.0", UDP_HEATMAP_PORT))
 
-    # Set non-blocking mode
+    # Non-blocking so a burst can be drained until the socket is empty
     udp_sock.setblocking(False)
+    loop = asyncio.get_running_loop()
+    loop.add_reader(udp_sock, drain_udp_socket, udp_sock)
+    try:
+        await asyncio.Future()  # until the network loop is stopped
+    finally:
+        loop.remove_reader(udp_sock)
+        udp_sock.close()
 
-    while True:
-        try:
-            try:
-                data, addr = udp_sock.recvfrom(65535)
-                # Record timestamp for rate calculation
-                now = datetime.now()
-                udp_packet_times.append(now)
-
-                # Calculate current rate
-                if len(udp_packet_times) > 1:
-                    # Remove old packets outside our window
-                    while udp_packet_times and (now - udp_packet_times[0]).total_seconds() > UDP_RATE_WINDOW:
-                        udp_packet_times.popleft()
-
-                    # Calculate rate
-                    if len(udp_packet_times) > 1:
-                        time_diff = (udp_packet_times[-1] - udp_packet_times[0]).total_seconds()
-                        if time_diff > 0:
-                            udp_rate = (len(udp_packet_times) - 1) / time_diff
 
-                try:
-                    frames = json.loads(data.decode("utf-8"))
-                    udp_mag_data = frames
-                except Exception as e:
-                    print("[UDP RECEIVER] Error parsing UDP:", e)
+def drain_udp_socket(udp_sock):
+    global udp_mag_data, udp_mag_seq, udp_mag_generation, udp_rate, udp_packet_times
+    global udp_superseded
+    try:
+        newest = None
+        # A longer burst is picked up again on the next loop iteration, after the other tasks
+        for _ in range(UDP_MAX_BURST):
+            try:
+                data, addr = udp_sock.recvfrom(UDP_MAX_DATAGRAM)
             except BlockingIOError:
-                # No data available, just continue
-                time.sleep(0.001)
+                break
+            t_recv = time.time()
+            # Record timestamp for rate calculation
+            udp_packet_times.append(datetime.now())
+            if udp_capture is not None:
+                udp_capture.write(t_recv, data)
+            try:
+                # Binary datagram, see magwire.py
+                header, frames = unpack_udp_datagram(data)
             except Exception as e:
-                print("[UDP RECEIVER] Exception in receive:", e)
-                time.sleep(0.01)
+                print("[UDP RECEIVER] Error parsing UDP:", e)
+                continue
+            latency.received(header, len(frames), t_recv)
+            stream_health.received(header, frames, t_recv)
+            if newest is not None:
+                udp_superseded += 1
+            newest = (header, frames)
+
+        # Only the newest frame is shown
+        if newest is not None:
+            header, frames = newest
+            udp_mag_data = frames[-1]
+            udp_mag_seq = header.seq
+            udp_mag_generation += 1
+
+        # Calculate current rate, once per burst
+        now = datetime.now()
+        # Remove old packets outside our window
+        while udp_packet_times and (now - udp_packet_times[0]).total_seconds() > UDP_RATE_WINDOW:
+            udp_packet_times.popleft()
+        if len(udp_packet_times) > 1:
+            time_diff = (udp_packet_times[-1] - udp_packet_times[0]).total_seconds()
+            if time_diff > 0:
+                udp_rate = (len(udp_packet_times) - 1) / time_diff
+    except Exception as e:
+        print("[UDP RECEIVER] Exception in receive:", e)
+
+
+# ------------------------------- Render Workers
+# Decoding, filtering, binning, decimating and colorizing run on these threads instead of in Tk
+# after() callbacks, so a slow step never holds up the UI or the jog keys. numpy and OpenCV
+# release the GIL in their inner loops, so the three workers and Tk spread over several cores.
+# The images go through DoubleBuffers, the App only copies out the newest one and shows it.
+heatmap_frames = DoubleBuffer((400, 400))  # live heatmap images from heatmap_worker
+projection_frames = [DoubleBuffer((200, 200)) for _ in PROJECTION_PLANES]  # from projection_worker
+field_request = None  # (mag_data generation, magchoice, bounds) the 3D view wants, set by the App
+field_result = None  # newest decimated 3D points from field_worker, taken by the App
+field_condition = threading.Condition()  # guards field_request and field_result
+cloud_frames = DoubleBuffer((500, 400))  # raster 3D view images from cloud_worker
+cloud_camera = (-60, 30, 1.0)  # azimuth and elevation in degrees and zoom of the raster 3D view, set by the App
+
+
+def heatmap_worker():
+    heatmap_data = np.zeros((8, 8), dtype=float)
+    renderer = GridRenderer(heatmap_frames.size)
+    state = None
+    while True:
+        try:
+            time.sleep(UPDATE_INTERVAL / 1000)
+            # Nothing to draw unless a new frame arrived, or the field mode or filter changed
+            if (udp_mag_generation, magchoice, heatmap_filter) == state:
+                continue
+            state = (udp_mag_generation, magchoice, heatmap_filter)
+            _, choice, filtering = state
+            seq, frame = udp_mag_seq, udp_mag_data
+
+            # Process new UDP data, updating only the corresponding cells if mag_val is nonzero.
+            if frame is not None:
+                update_heatmap(heatmap_data, frame, choice)
+            if filtering:
+                # Skip frame if it's likely invalid or too weak, the last good one stays on screen
+                if np.count_nonzero(heatmap_data) < 10 or np.std(heatmap_data) < MIN_FRAME_STD:
+                    continue
+                # Outlier filtering: smooth extreme pixels based on local neighborhood, shown on an absolute scale
+                filtered_data = filter_outliers(heatmap_data, Z_THRESH)
+                renderer.render(filtered_data, vmax=MAG_TRESHOLD, invert=True, out=heatmap_frames.back)
+            else:
+                renderer.render(heatmap_data, invert=True, out=heatmap_frames.back)
+            heatmap_frames.publish(seq)
+        except Exception as e:
+            print(f"[HEATMAP WORKER] Exception: {e}")
+            time.sleep(1)
+
+
+def projection_worker():
+    # Running sum/count grids of the xy, yz and zx projections, fed only the new samples each tick
+    projections = [ProjectionAccumulator() for _ in PROJECTION_PLANES]
+    renderers = [GridRenderer(frames.size) for frames in projection_frames]
+    choice = None  # field mode the accumulators hold
+    projected = 0  # samples of mag_data already in the accumulators
+    clears = mag_data.clears  # mag_data clears the accumulators have seen
+    generation = None  # mag_data generation the projections were last drawn at
+    while True:
+        try:
+            time.sleep(0.1)
+            # Nothing to draw unless samples arrived, the store was cleared or the field mode changed.
+            # The generation is read before the snapshot, so samples appended in between are drawn next tick.
+            if mag_data.generation == generation and magchoice == choice:
+                continue
+            generation = mag_data.generation
+
+            # The accumulators hold values of one field mode; start over when it changes or the store was cleared
+            if magchoice != choice or mag_data.clears != clears:
+                for projection in projections:
+                    projection.clear()
+                choice = magchoice
+                clears = mag_data.clears
+                projected = 0
+
+            # One snapshot of the samples that arrived since the last tick, shared by all three planes
+            samples = mag_data.snapshot(projected)
+            values = field_component(samples["Bx"], samples["By"], samples["Bz"], choice)
+            projected += len(values)
+
+            for projection, (u, v), renderer, frames in zip(projections, PROJECTION_PLANES, renderers, projection_frames):
+                projection.add(samples[u], samples[v], values)
+                # Average value per cell, colorized like the live heatmap.
+                renderer.render(projection.grid(), out=frames.back)
+                frames.publish()
+        except Exception as e:
+            print(f"[PROJECTION WORKER] Exception: {e}")
+            time.sleep(1)
+
+
+# Decimates and colors the 3D points for the newest field_request. The axes themselves belong to
+# Tk, so the App posts what it wants drawn and applies field_result to its scatter artist.
+def field_worker():
+    global field_result
+    field_cmap = colormaps["viridis_r"]
+    voxel_cell = voxel_bounds = None  # voxel size of the last decimation and the region it was found for
+    done = None
+    while True:
+        with field_condition:
+            while field_request == done:
+                field_condition.wait()
+            request = field_request
+        try:
+            _, choice, bounds = request
+            # One consistent view of all samples so far
+            samples = mag_data.snapshot()
+            mag = field_component(samples["Bx"], samples["By"], samples["Bz"], choice)
+            keep = mag <= MAG_TRESHOLD
+
+            # Level of detail: at most FIELD_POINT_BUDGET points, finer voxels when zoomed in
+            cell = voxel_cell if bounds == voxel_bounds else None
+            xs, ys, zs, mag_array, voxel_cell = voxel_decimate(
+                samples["x"][keep], samples["y"][keep], samples["z"][keep], mag[keep],
+                FIELD_POINT_BUDGET, bounds, FIELD_VOXEL_REDUCE, cell)
+            voxel_bounds = bounds
+
+            # Normalize on an absolute scale [0, MAG_TRESHOLD].
+            norm = np.clip(mag_array / MAG_TRESHOLD, 0, 1)
+            colors = field_cmap(norm)
+            # Set alpha proportional to intensity (low intensity nearly transparent)
+            colors[:, 3] = 0.5+norm*0.5
+            with field_condition:
+                field_result = (xs, ys, zs, mag_array, colors)
         except Exception as e:
-            print("[UDP RECEIVER] Outer exception:", e)
+            print(f"[FIELD WORKER] Exception: {e}")
+        done = request
+
+
+# The raster 3D view (FIELD_VIEW = "raster"): all samples below MAG_TRESHOLD, no decimation,
+# drawn by PointCloudRenderer from the camera the App's mouse handlers set.
+def cloud_worker():
+    renderer = PointCloudRenderer(cloud_frames.size, CLOUD_POINT_SIZE)
+    state = None
+    points = None  # ((generation, choice), x, y, z, levels, (center, radius)) of the last snapshot
+    while True:
+        try:
+            time.sleep(UPDATE_INTERVAL / 1000)
+            # Nothing to draw unless samples arrived, the field mode changed or the camera moved
+            if (mag_data.generation, magchoice, cloud_camera) == state:
+                continue
+            state = (mag_data.generation, magchoice, cloud_camera)
+            generation, choice, (azim, elev, zoom) = state
+
+            # Rotating and zooming reuse the points, only new samples or a new field mode take a snapshot
+            if points is None or points[0] != (generation, choice):
+                samples = mag_data.snapshot()
+                mag = field_component(samples["Bx"], samples["By"], samples["Bz"], choice)
+                keep = mag <= MAG_TRESHOLD
+                x, y, z = samples["x"][keep], samples["y"][keep], samples["z"][keep]
+                # Colormap level on an absolute scale [0, MAG_TRESHOLD], like the matplotlib view
+                levels = (np.clip(mag[keep] / MAG_TRESHOLD, 0, 1) * 255).astype(np.uint8)
+                points = ((generation, choice), x, y, z, levels, bounding_sphere(x, y, z))
+            _, x, y, z, levels, (center, radius) = points
+
+            matrix = orbit_matrix(center, radius, azim, elev, zoom, cloud_frames.size)
+            renderer.render(x, y, z, levels, matrix, out=cloud_frames.back)
+            cloud_frames.publish()
+        except Exception as e:
+            print(f"[CLOUD WORKER] Exception: {e}")
             time.sleep(1)
 
 
 # ------------------------------- Laptop Key Handler
 def on_arrow_key(event):
-    global magchoice
+    global magchoice, heatmap_filter
 
     # Get current coordinate values from the input fields; default to 0 if empty.
     current_r=0
@@ -348,10 +631,14 @@ def on_arrow_key(event):
     #To plot modB on our GUI
     elif event.keysym.lower() == "m":
         magchoice = "M"
-
-    # Form the command string and send it.
-    command_string = f"update acoordinates,{current_r},{current_theta},{current_z}"
-    send_command(command_string)
+    #To switch the outlier filter on the live heatmap on or off
+    elif event.keysym.lower() == "f":
+        heatmap_filter = not heatmap_filter
+        print(f"[HEATMAP] Outlier filter {'on' if heatmap_filter else 'off'}")
+
+    # Jog the motors relative to where they are, only for the arrow keys
+    if current_r or current_theta or current_z:
+        send_command("jog", r=current_r, theta=current_theta, z=current_z)
     #app.status_var.set(f"Updated via arrow key: r={current_r}, θ={current_theta}, z={current_z}")
 
 
@@ -371,23 +658,21 @@ class App(tk.Tk):
         self.control_frame = ttk.Frame(self)
         self.control_frame.pack(side=tk.TOP, fill=tk.X, padx=10, pady=10)
         self.start_btn = ttk.Button(self.control_frame, text="Start",
-                                    command=lambda: threading.Thread(target=self.button_command, args=("start",),
-                                                                     daemon=True).start())
+                                    command=lambda: self.button_command("start"))
         self.start_btn.pack(side=tk.LEFT, padx=5)
         self.stop_btn = ttk.Button(self.control_frame, text="Stop",
-                                   command=lambda: threading.Thread(target=self.button_command, args=("stop",),
-                                                                    daemon=True).start())
+                                   command=lambda: self.button_command("stop"))
         self.stop_btn.pack(side=tk.LEFT, padx=5)
         self.pause_btn = ttk.Button(self.control_frame, text="Pause",
-                                    command=lambda: threading.Thread(target=self.button_command, args=("pause",),
-                                                                     daemon=True).start())
+                                    command=lambda: self.button_command("pause"))
         self.pause_btn.pack(side=tk.LEFT, padx=5)
         self.reset_btn = ttk.Button(self.control_frame, text="Reset",
-                                    command=lambda: threading.Thread(target=self.button_command, args=("reset",),
-                                                                     daemon=True).start())
+                                    command=lambda: self.button_command("reset"))
         self.reset_btn.pack(side=tk.LEFT, padx=5)
+        # The raster view has no matplotlib axes, the button shows its newest frame instead
         self.update_field_btn = ttk.Button(self.control_frame, text="Update Distribution",
-                                           command=self.update_field_distribution)
+                                           command=self.update_point_cloud if FIELD_VIEW == "raster"
+                                           else self.update_field_distribution)
         self.update_field_btn.pack(side=tk.LEFT, padx=5)
 
         # Coordinates update controls
@@ -403,9 +688,7 @@ class App(tk.Tk):
         self.input_z = ttk.Entry(self.coords_frame, width=10)
         self.input_z.pack(side=tk.LEFT, padx=2)
         self.update_coords_btn = ttk.Button(self.coords_frame, text="Update Coordinates",
-                                            command=lambda: threading.Thread(target=self.button_command,
-                                                                             args=("update_coords",),
-                                                                             daemon=True).start())
+                                            command=lambda: self.button_command("update_coords"))
         self.update_coords_btn.pack(side=tk.LEFT, padx=5)
         self.status_var = tk.StringVar(value="Idle")
         self.status_label = ttk.Label(self.coords_frame, textvariable=self.status_var, font=("Helvetica", 12))
@@ -425,6 +708,7 @@ class App(tk.Tk):
         self.heatmap_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
         self.heatmap_label = ttk.Label(self.heatmap_frame)
         self.heatmap_label.pack(side=tk.LEFT, padx=5, pady=5)
+        self.live_image(self.heatmap_label, heatmap_frames.size)
         self.heatmap_colorbar_label = ttk.Label(self.heatmap_frame)
         self.heatmap_colorbar_label.pack(side=tk.LEFT, padx=5, pady=5)
         self.rate_var = tk.StringVar()
@@ -435,23 +719,43 @@ class App(tk.Tk):
         self.right_frame = ttk.Frame(self.display_frame)
         self.right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=10)
         ttk.Label(self.right_frame, text="3D plot", font=("Helvetica", 14)).pack(pady=5)
-        self.fig3d = Figure(figsize=(5, 4), dpi=100)
-        self.ax3d = self.fig3d.add_subplot(111, projection="3d")
-        self.ax3d.set_xlabel("X")
-        self.ax3d.set_ylabel("Y")
-        self.ax3d.set_zlabel("Z")
-        self.ax3d.dist = 5  # Lower values zoom in, default is 10
-        self.canvas3d = FigureCanvasTkAgg(self.fig3d, master=self.right_frame)
-        self.canvas3d.get_tk_widget().pack(fill=tk.BOTH, expand=True)
-        self.toolbar3d = NavigationToolbar2Tk(self.canvas3d, self.right_frame)
-        self.toolbar3d.update()
-        self.toolbar3d.pack(fill=tk.X)
-
-        self.sm = cm.ScalarMappable(cmap="viridis_r", norm=colors.Normalize(0, MAG_TRESHOLD))
-        self.ax3d.dist = 5  # default zoom (closer)
-        self.sm = cm.ScalarMappable(cmap="viridis_r", norm=colors.Normalize(0, MAG_TRESHOLD))
-        self.field_colorbar = self.fig3d.colorbar(self.sm, ax=self.ax3d, pad=0.1, aspect=10)
-        self.field_colorbar.set_label("|B| (magnetic field strength)")
+        if FIELD_VIEW == "raster":
+            # Drawn by cloud_worker; drag to rotate, mouse wheel to zoom
+            self.cloud_label = ttk.Label(self.right_frame)
+            self.cloud_label.pack(fill=tk.BOTH, expand=True)
+            self.live_image(self.cloud_label, cloud_frames.size)
+            self.cloud_label.bind("<ButtonPress-1>", self.cloud_press)
+            self.cloud_label.bind("<B1-Motion>", self.cloud_rotate)
+            self.cloud_label.bind("<MouseWheel>", self.cloud_zoom)
+            self.cloud_label.bind("<Button-4>", self.cloud_zoom)
+            self.cloud_label.bind("<Button-5>", self.cloud_zoom)
+            self.cloud_drag = None
+        else:
+            self.fig3d = Figure(figsize=(5, 4), dpi=100)
+            self.ax3d = self.fig3d.add_subplot(111, projection="3d")
+            self.ax3d.set_xlabel("X")
+            self.ax3d.set_ylabel("Y")
+            self.ax3d.set_zlabel("Z")
+            self.ax3d.dist = 5  # Lower values zoom in, default is 10
+            self.canvas3d = FigureCanvasTkAgg(self.fig3d, master=self.right_frame)
+            self.canvas3d.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+            self.toolbar3d = NavigationToolbar2Tk(self.canvas3d, self.right_frame)
+            self.toolbar3d.update()
+            self.toolbar3d.pack(fill=tk.X)
+
+            self.sm = cm.ScalarMappable(cmap="viridis_r", norm=colors.Normalize(0, MAG_TRESHOLD))
+            self.ax3d.dist = 5  # default zoom (closer)
+            self.sm = cm.ScalarMappable(cmap="viridis_r", norm=colors.Normalize(0, MAG_TRESHOLD))
+            self.field_colorbar = self.fig3d.colorbar(self.sm, ax=self.ax3d, pad=0.1, aspect=10)
+            self.field_colorbar.set_label("|B| (magnetic field strength)")
+
+            # One scatter artist for the whole session, update_field_distribution only swaps its data
+            self.scatter3d = self.ax3d.scatter([], [], [], s=10, edgecolors='none')
+            self.no_points_text = self.ax3d.text2D(0.5, 0.5, "No valid points", horizontalalignment='center',
+                                                   transform=self.ax3d.transAxes)
+            self.field_requested = None  # field_request last posted to field_worker
+            self.scatter_view = None  # view limits after the scatter was last updated
+            self.follow_data = True  # autoscale to the data until the user zooms or pans
 
         # Bottom Panel: 2D Heatmap Plot
         self.bottom_frame = ttk.Frame(self.display_frame)
@@ -472,19 +776,34 @@ class App(tk.Tk):
         # Bind the Enter key to launch the main application
         self.bind("<Escape>", self.close_app)
 
-        # Begin periodic updates
-        self.update_opencv_heatmap()
-        self.update_rate()
-        self.update_field_distribution()  # Initial update for 3D plot
-        self.update_2d_heatmap()  # Initial update for 2D heatmap
-        self.update_2d_heatmap1()
-        self.update_2d_heatmap2()
+        self.projection_labels = [self.heatmap1_label, self.heatmap2_label, self.heatmap3_label]
+        for label, frames in zip(self.projection_labels, projection_frames):
+            self.live_image(label, frames.size)
+
+        # Begin periodic updates: one timer runs all views by priority within the frame budget,
+        # the live heatmap every frame, the others as often as their cost allows
+        self.last_latency_report = time.monotonic()
+        self.last_stream_metrics = time.monotonic()
+        self.scheduler = FrameScheduler(UPDATE_INTERVAL / 1000, FRAME_BUDGET / 1000)
+        self.scheduler.add("heatmap", self.update_opencv_heatmap, UPDATE_INTERVAL / 1000, essential=True)
+        self.scheduler.add("commands", self.update_commands, UPDATE_INTERVAL / 1000)
+        if FIELD_VIEW == "raster":
+            self.scheduler.add("3D", self.update_point_cloud, UPDATE_INTERVAL / 1000)
+        else:
+            self.scheduler.add("3D", self.update_field_distribution, 0.1)
+        self.scheduler.add("projections", self.update_projections, 0.1)
+        self.scheduler.add("rate", self.update_rate, 0.5)
+        self.run_views()
+
+    def run_views(self):
+        self.after(self.scheduler.tick(), self.run_views)
 
     # ---------------- Button Command Handler ----------------
     def button_command(self, command_type):
         if command_type == "start":
             send_command("start")
             self.status_var.set("Acquisition Started")
+            sync_clock()
         elif command_type == "stop":
             send_command("stop")
             self.status_var.set("Acquisition Stopped")
@@ -492,12 +811,12 @@ class App(tk.Tk):
             send_command("pause")
             self.status_var.set("Acquisition Paused")
         elif command_type == "reset":
-            with file_lock:
-                try:
-                    open(DATA_FILE, 'w').close()
-                    print("[RESET] Data file cleared.")
-                except Exception as e:
-                    print(f"[RESET] Error: {e}")
+            try:
+                new_scan_file()
+            except Exception as e:
+                print(f"[RESET] Error: {e}")
+            # A new scan: the plots start empty, like the new scan file
+            mag_data.clear()
             send_command("reset")
             self.status_var.set("Acquisition Reset")
         elif command_type == "update_coords":
@@ -505,280 +824,164 @@ class App(tk.Tk):
             theta = self.input_theta.get()
             z = self.input_z.get()
             if r and theta and z:
-                send_command(f"update coordinates,{r},{theta},{z}")
+                try:
+                    send_command("move", r=int(r), theta=int(theta), z=int(z))
+                except ValueError:
+                    self.status_var.set("Coordinates are motor steps, please enter whole numbers.")
+                    return
                 self.status_var.set(f"Updated coordinates: r={r}, θ={theta}, z={z}")
             else:
                 self.status_var.set("Please enter all coordinates (r, theta, z).")
         else:
             self.status_var.set("Idle")
 
+    # ---------------- Command Replies and Events ----------------
+    # Replies to send_command and events pushed by the Pi, handed over by the command channel
+    def update_commands(self):
+        shown = False
+        while True:
+            try:
+                message = command_messages.get_nowait()
+            except queue.Empty:
+                return shown
+            shown = True
+            if "event" in message:
+                self.command_event(message)
+            elif message["ok"]:
+                print(f"[COMMAND] Sent: {message['cmd']}, Received: {message.get('status', 'ok')}")
+                if "status" in message:
+                    self.status_var.set(message["status"])
+            else:
+                print(f"[COMMAND] Error sending '{message['cmd']}': {message['error']}")
+                self.status_var.set(f"{message['cmd'].capitalize()} failed: {message['error']}")
+
+    def command_event(self, event):
+        if event["event"] == "state":
+            self.status_var.set(event["status"])
+        elif event["event"] == "progress":
+            self.status_var.set(f"Scanning: cycle {event['counter']}, r={event['r']}, θ={event['theta']}, z={event['z']}")
+
+    # ---------------- Heatmap Images ----------------
+    # One image per label for the whole session, redrawn in place: the newest image of a
+    # DoubleBuffer is copied into one PIL image and pasted into one PhotoImage. Creating a
+    # PhotoImage per frame churns Tk image memory and gives GC pauses in long sessions.
+    def live_image(self, label, size):
+        label.pil_image = Image.new("RGB", size)
+        label.imgtk = ImageTk.PhotoImage(label.pil_image)  # Keep a reference to avoid GC.
+        label.configure(image=label.imgtk)
+
+    # Show the newest image of frames, if there is one. Returns (shown, info) as DoubleBuffer.take().
+    def show_frame(self, label, frames):
+        shown, info = frames.take(label.pil_image.frombytes)
+        if shown:
+            label.imgtk.paste(label.pil_image)
+        return shown, info
+
     # ---------------- OpenCV Heatmap Update ----------------
     def update_opencv_heatmap(self):
-
-        global udp_mag_data
-
-        # Initialize the heatmap_data attribute only once
-        if not hasattr(self, 'heatmap_data'):
-            self.heatmap_data = np.zeros((8, 8), dtype=float)
-
-        # Process new UDP data, updating only the corresponding cells if mag_val is nonzero.
-        if udp_mag_data:
-            for word in udp_mag_data:
-                try:
-                    Bx, By, Bz, pixel = extract_xyz_pixel(word)
-                    Bx*=MAG_CONVERSION
-                    By*=MAG_CONVERSION
-                    Bz*=MAG_CONVERSION
-                    # Calculate the magnitude value.
-                    if magchoice == "M":
-                        mag = math.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-                    elif magchoice == "X":
-                        mag = -Bx
-                    elif magchoice == "Y":
-                        mag = By
-                    elif magchoice == "Z":
-                        mag = Bz
-                    else:
-                        mag = math.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-                    # Determine row and column in the 8x8 grid.
-                    row = 7 - (pixel // 8)
-                    col = pixel % 8
-                    # If the indices are valid and we have a nonzero value, update the cell.
-                    if 0 <= row < 8 and 0 <= col < 8 and mag != 0:
-                        self.heatmap_data[row, col] = mag
-                except Exception:
-                    continue
-
-        # Resize and colorize the heatmap using the persistent self.heatmap_data.
-        resized = cv2.resize(self.heatmap_data, (400, 400), interpolation=cv2.INTER_NEAREST)
-        norm_img = cv2.normalize(resized, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-        inv_img = 255 - norm_img
-        colored = cv2.applyColorMap(inv_img, cv2.COLORMAP_VIRIDIS)
-        colored_rgb = cv2.cvtColor(colored, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(colored_rgb)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.heatmap_label.imgtk = imgtk  # Keep reference to prevent GC.
-        self.heatmap_label.configure(image=imgtk)
-
-        # Schedule the next update (approximately every 33 ms for ~30 FPS).
-        self.after(UPDATE_INTERVAL, self.update_opencv_heatmap)
+        # Drawn by heatmap_worker; the image is tagged with the datagram it shows
+        shown, seq = self.show_frame(self.heatmap_label, heatmap_frames)
+        if shown and seq is not None:
+            latency.painted(seq, time.time())
+        return shown
 
     # ---------------- UDP Rate Update ----------------
     def update_rate(self):
         global udp_rate, udp_packet_times, UDP_RATE_WINDOW
+        disk = scan_file.stats() if scan_file is not None else None
+        disk_text = f" | Disk: {disk['bytes_per_s'] / 1e6:.2f} MB/s, queue {disk['queue_depth']}/{disk['queue_size']}" if disk else ""
+        if disk and disk["errors"]:
+            disk_text += f", {disk['errors']} write errors"
+        p50, p99, _ = latency.stats()[0]["read -> paint"]
+        latency_text = f"\nLatency p50/p99: {p50 * 1e3:.1f}/{p99 * 1e3:.1f} ms" if p50 is not None else ""
+        # Frames per second each view achieved, and what an update of it costs on the Tk thread
+        view_stats = self.scheduler.stats()
+        fps_text = " | ".join(f"{name} {fps:.1f} fps ({cost * 1e3:.1f} ms)" for name, (fps, cost) in view_stats.items()
+                              if name not in ("commands", "rate"))
         self.rate_var.set(
-            f"UDP Rate: {udp_rate:.2f} packets/sec | Count (last {UDP_RATE_WINDOW}s): {len(udp_packet_times)}")
-        self.after(500, self.update_rate)
+            f"UDP Rate: {udp_rate:.2f} packets/sec | Count (last {UDP_RATE_WINDOW}s): {len(udp_packet_times)}"
+            f" | Superseded {udp_superseded}{disk_text} | {scan_resume.summary()}\n{stream_health.summary()}{latency_text}\n{fps_text}")
+        # Full per-stage report on the console
+        if LATENCY_REPORT_INTERVAL and time.monotonic() - self.last_latency_report >= LATENCY_REPORT_INTERVAL:
+            print(latency.report())
+            self.last_latency_report = time.monotonic()
+        if stream_metrics is not None and time.monotonic() - self.last_stream_metrics >= STREAM_METRICS_INTERVAL:
+            stream_metrics.write(stream_health.stats())
+            self.last_stream_metrics = time.monotonic()
+        return True
 
     # ---------------- 3D Field Distribution Plot Update ----------------
-    def update_field_distribution(self):
-        global magchoice
-        global mag_data
-        self.ax3d.clear()
-        self.ax3d.set_xlabel("X")
-        self.ax3d.set_ylabel("Y")
-        self.ax3d.set_zlabel("Z")
-
-        points = []
-        for frame in mag_data:
-            if isinstance(frame, tuple) and len(frame) == 3:
-                try:
-                    coords, B_vector, pixel = frame
-                    x, y, z = coords
-                    Bx, By, Bz = B_vector
-                    if magchoice == "M":
-                        mag = math.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-                    elif magchoice == "X":
-                        mag = -Bx
-                    elif magchoice == "Y":
-                        mag = By
-                    elif magchoice == "Z":
-                        mag = Bz
-                    else:
-                        mag = math.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-
-                    if mag <= MAG_TRESHOLD:
-                        points.append((x, y, z, mag))
-                except Exception as e:
-                    print("Error processing frame:", e)
-                    continue
-
-        if points:
-            x_vals, y_vals, z_vals, mag_vals = zip(*points)
-            mag_array = np.array(mag_vals)
-            # Normalize on an absolute scale [0, MAG_TRESHOLD].
-            norm = np.clip(mag_array / MAG_TRESHOLD, 0, 1)
-            cmap = cm.get_cmap("viridis_r")
-            colors = cmap(norm)
-            # Set alpha proportional to intensity (low intensity nearly transparent)
-            colors[:, 3] = 0.5+norm*0.5
-            self.ax3d.scatter(x_vals, y_vals, z_vals, c=colors, s=10, edgecolors='none')
-            # Update colorbar without removing it
-            self.sm.set_array(mag_array)
-            self.sm.set_clim(0, MAG_TRESHOLD)
-            self.field_colorbar.update_normal(self.sm)
-
-        else:
-            self.ax3d.text2D(0.5, 0.5, "No valid points", horizontalalignment='center', transform=self.ax3d.transAxes)
-        self.canvas3d.draw()
-        self.after(100, self.update_field_distribution)
-
-    # ---------------- 2D Heatmap projection for xy plane  Plot Update ----------------
-    def update_2d_heatmap(self):
-
-        global mag_data
-
-        data_points = []
-        try:
-            for frame in mag_data:
-                if isinstance(frame, tuple) and len(frame) == 3:
-                    try:
-                        coords, B_vector, pixel = frame
-                        x, y, z = coords
-                        Bx, By, Bz = B_vector
-                        mag = math.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-                        data_points.append((x, y, mag))
-                    except Exception as e:
-                        print("Error processing frame:", e)
-                        continue
-        except Exception as e:
-            print("[2D Heatmap] Data parsing error:", e)
-
-        # Define grid resolution (50x50 by default)
-        grid_size = 50
-        if data_points:
-            xs = [pt[0] for pt in data_points]
-            ys = [pt[1] for pt in data_points]
-            mags = [pt[2] for pt in data_points]
-            # Define bins based on the range of x and y values.
-            x_bins = np.linspace(min(xs), max(xs), grid_size + 1)
-            y_bins = np.linspace(min(ys), max(ys), grid_size + 1)
-            # Create two 2D histograms: one for the sum of magnitudes and one for counting.
-            sum_grid, _, _ = np.histogram2d(xs, ys, bins=[x_bins, y_bins], weights=mags)
-            count_grid, _, _ = np.histogram2d(xs, ys, bins=[x_bins, y_bins])
-            # Compute the average magnitude per bin.
-            with np.errstate(divide='ignore', invalid='ignore'):
-                avg_grid = np.divide(sum_grid, count_grid, out=np.zeros_like(sum_grid), where=count_grid != 0)
-            avg_grid = np.nan_to_num(avg_grid)
-        else:
-            avg_grid = np.zeros((grid_size, grid_size), dtype=float)
-
-        # Use OpenCV functions (like in update_opencv_heatmap) to generate an image:
-        resized = cv2.resize(avg_grid, (200, 200), interpolation=cv2.INTER_NEAREST)
-        norm_img = cv2.normalize(resized, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-        colored = cv2.applyColorMap(norm_img, cv2.COLORMAP_VIRIDIS)
-        colored_rgb = cv2.cvtColor(colored, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(colored_rgb)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.heatmap1_label.imgtk = imgtk  # Keep a reference to avoid GC.
-        self.heatmap1_label.configure(image=imgtk)
-        self.after(100, self.update_2d_heatmap)
-    # ---------------- 2D Heatmap projection for yz plane  Plot Update ----------------
-    def update_2d_heatmap1(self):
-
-        global mag_data
-
-        data_points = []
-        try:
-            for frame in mag_data:
-                if isinstance(frame, tuple) and len(frame) == 3:
-                    try:
-                        coords, B_vector, pixel = frame
-                        x, y, z = coords
-                        Bx, By, Bz = B_vector
-                        mag = math.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-                        data_points.append((y, z, mag))
-                    except Exception as e:
-                        print("Error processing frame:", e)
-                        continue
-        except Exception as e:
-            print("[2D Heatmap] Data parsing error:", e)
-
-        # Define grid resolution (50x50 by default)
-        grid_size = 50
-        if data_points:
-            xs = [pt[0] for pt in data_points]
-            ys = [pt[1] for pt in data_points]
-            mags = [pt[2] for pt in data_points]
-            # Define bins based on the range of x and y values.
-            x_bins = np.linspace(min(xs), max(xs), grid_size + 1)
-            y_bins = np.linspace(min(ys), max(ys), grid_size + 1)
-            # Create two 2D histograms: one for the sum of magnitudes and one for counting.
-            sum_grid, _, _ = np.histogram2d(xs, ys, bins=[x_bins, y_bins], weights=mags)
-            count_grid, _, _ = np.histogram2d(xs, ys, bins=[x_bins, y_bins])
-            # Compute the average magnitude per bin.
-            with np.errstate(divide='ignore', invalid='ignore'):
-                avg_grid = np.divide(sum_grid, count_grid, out=np.zeros_like(sum_grid), where=count_grid != 0)
-            avg_grid = np.nan_to_num(avg_grid)
-        else:
-            avg_grid = np.zeros((grid_size, grid_size), dtype=float)
-
-        # Use OpenCV functions (like in update_opencv_heatmap) to generate an image:
-        resized = cv2.resize(avg_grid, (200, 200), interpolation=cv2.INTER_NEAREST)
-        norm_img = cv2.normalize(resized, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-        colored = cv2.applyColorMap(norm_img, cv2.COLORMAP_VIRIDIS)
-        colored_rgb = cv2.cvtColor(colored, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(colored_rgb)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.heatmap2_label.imgtk = imgtk  # Keep a reference to avoid GC.
-        self.heatmap2_label.configure(image=imgtk)
-        self.after(100, self.update_2d_heatmap1)
-
+    def view_limits(self):
+        return (self.ax3d.get_xlim(), self.ax3d.get_ylim(), self.ax3d.get_zlim())
 
-    # ---------------- 2D Heatmap projection for zx plane  Plot Update ----------------
-    def update_2d_heatmap2(self):
-
-        global mag_data
-        # Use the current z-slice value if needed for filtering (optional)
+    def update_field_distribution(self):
+        global field_request, field_result
+
+        # Apply the newest points from field_worker: swap the data of the existing artist instead of
+        # clearing the axes and scattering again
+        with field_condition:
+            result, field_result = field_result, None
+        if result is not None:
+            xs, ys, zs, mag_array, colors = result
+            self.scatter3d._offsets3d = (xs, ys, zs)
+            self.scatter3d.set_facecolor(colors)
+            self.no_points_text.set_visible(len(xs) == 0)
+            if len(xs):
+                if self.follow_data:
+                    self.ax3d.auto_scale_xyz(xs, ys, zs, had_data=False)
+                # Update colorbar without removing it
+                self.sm.set_array(mag_array)
+                self.sm.set_clim(0, MAG_TRESHOLD)
+                self.field_colorbar.update_normal(self.sm)
+            self.scatter_view = self.view_limits()
+            # Drawn here rather than with draw_idle, so the scheduler sees what the redraw costs
+            self.canvas3d.draw()
+
+        # Limits that differ from the ones set here last time mean the user zoomed or panned with the
+        # toolbar. From then on the view is left alone and only the visible region is decimated.
+        view = self.view_limits()
+        if self.scatter_view is not None and view != self.scatter_view:
+            self.follow_data = False
+
+        # Ask for new points only when samples arrived, the field mode changed or the view was zoomed;
+        # rotating is redrawn by matplotlib itself
+        request = (mag_data.generation, magchoice, None if self.follow_data else view)
+        if request != self.field_requested:
+            with field_condition:
+                field_request = request
+                field_condition.notify()
+            self.field_requested = request
+        return result is not None
+
+    # ---------------- Raster 3D View Update ----------------
+    def update_point_cloud(self):
+        # Drawn by cloud_worker
+        return self.show_frame(self.cloud_label, cloud_frames)[0]
+
+    def cloud_press(self, event):
+        self.cloud_drag = (event.x, event.y)
+
+    # Half a degree per pixel dragged, elevation stops at the poles
+    def cloud_rotate(self, event):
+        global cloud_camera
+        azim, elev, zoom = cloud_camera
+        if self.cloud_drag is not None:
+            dx, dy = event.x - self.cloud_drag[0], event.y - self.cloud_drag[1]
+            cloud_camera = ((azim - dx * 0.5) % 360, min(90, max(-90, elev + dy * 0.5)), zoom)
+        self.cloud_drag = (event.x, event.y)
+
+    # <MouseWheel> on Windows and macOS, <Button-4>/<Button-5> on X11
+    def cloud_zoom(self, event):
+        global cloud_camera
+        azim, elev, zoom = cloud_camera
+        zoom_in = event.num == 4 or event.delta > 0
+        cloud_camera = (azim, elev, zoom * 1.2 if zoom_in else zoom / 1.2)
+
+    # ---------------- 2D Heatmap projections (xy, yz, zx) Plot Update ----------------
+    def update_projections(self):
+        # Drawn by projection_worker
+        return any([self.show_frame(label, frames)[0] for label, frames in zip(self.projection_labels, projection_frames)])
 
-        # Gather data points: (x, y, magnetic intensity) from mag_data.
-        # (Here we ignore z, but you could filter on z_slice_val if desired.)
-        data_points = []
-        try:
-            for frame in mag_data:
-                if isinstance(frame, tuple) and len(frame) == 3:
-                    try:
-                        coords, B_vector, pixel = frame
-                        x, y, z = coords
-                        Bx, By, Bz = B_vector
-                        mag = math.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-                        data_points.append((z, x, mag))
-                    except Exception as e:
-                        print("Error processing frame:", e)
-                        continue
-        except Exception as e:
-            print("[2D Heatmap] Data parsing error:", e)
-
-        # Define grid resolution (50x50 by default)
-        grid_size = 50
-        if data_points:
-            xs = [pt[0] for pt in data_points]
-            ys = [pt[1] for pt in data_points]
-            mags = [pt[2] for pt in data_points]
-            # Define bins based on the range of x and y values.
-            x_bins = np.linspace(min(xs), max(xs), grid_size + 1)
-            y_bins = np.linspace(min(ys), max(ys), grid_size + 1)
-            # Create two 2D histograms: one for the sum of magnitudes and one for counting.
-            sum_grid, _, _ = np.histogram2d(xs, ys, bins=[x_bins, y_bins], weights=mags)
-            count_grid, _, _ = np.histogram2d(xs, ys, bins=[x_bins, y_bins])
-            # Compute the average magnitude per bin.
-            with np.errstate(divide='ignore', invalid='ignore'):
-                avg_grid = np.divide(sum_grid, count_grid, out=np.zeros_like(sum_grid), where=count_grid != 0)
-            avg_grid = np.nan_to_num(avg_grid)
-        else:
-            avg_grid = np.zeros((grid_size, grid_size), dtype=float)
-
-        # Use OpenCV functions (like in update_opencv_heatmap) to generate an image:
-        resized = cv2.resize(avg_grid, (200, 200), interpolation=cv2.INTER_NEAREST)
-        norm_img = cv2.normalize(resized, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
-        colored = cv2.applyColorMap(norm_img, cv2.COLORMAP_VIRIDIS)
-        colored_rgb = cv2.cvtColor(colored, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(colored_rgb)
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.heatmap3_label.imgtk = imgtk  # Keep a reference to avoid GC.
-        self.heatmap3_label.configure(image=imgtk)
-        self.after(100, self.update_2d_heatmap2)
-    
     def close_app(self, event=None):
         self.destroy()
 
@@ -841,26 +1044,45 @@ class IntroScreen(tk.Tk):
 
 
 # ---------------- Starting Threads ----------------
-def start_network_threads():
-    threading.Thread(target=persistent_receiver, daemon=True).start()  # TCP receiver
-    threading.Thread(target=udp_persistent_receiver, daemon=True).start()  # UDP receiver
+# All networking runs as tasks on the network loop (see magloop.py)
+def start_network():
+    network.start()
+    network.submit(scan_receiver(), "TCP receiver")
+    network.submit(udp_receiver(), "UDP receiver")
+    network.submit(command_channel.run(), "command channel")  # reconnects on its own
+
+
+def start_render_workers():
+    threading.Thread(target=heatmap_worker, daemon=True).start()  # live heatmap
+    threading.Thread(target=projection_worker, daemon=True).start()  # xy, yz and zx projections
+    if FIELD_VIEW == "raster":
+        threading.Thread(target=cloud_worker, daemon=True).start()  # raster 3D view
+    else:
+        threading.Thread(target=field_worker, daemon=True).start()  # 3D level of detail
 
 
 #########################
 # Main Execution        #
 #########################
 if __name__ == '__main__':
-    log_filename = "parsed_data.txt"
-    start_network_threads()
+    new_scan_file()
+    if RECORD_UDP:
+        udp_capture = UdpCaptureWriter(datetime.now().strftime(UDP_CAPTURE_FORMAT))
+    if STREAM_METRICS_INTERVAL:
+        stream_metrics = MetricsLog(datetime.now().strftime(STREAM_METRICS_FORMAT))
+    start_network()
+    start_render_workers()
     if SIMULATION=="0":
     # Start remote command initialization.
-        remote_thread = threading.Thread(
-            target=initializer,
-            args=(PI_HOSTNAME, PI_USERNAME, PI_PASSWORD, REMOTE_SCRIPT_PATH),
-            daemon=True
-        )
-        remote_thread.start()
+        network.submit(start_remote(PI_HOSTNAME, PI_USERNAME, PI_PASSWORD, REMOTE_SCRIPT_PATH), "remote launch")
     intro = IntroScreen()
     intro.mainloop()
     print("[MAIN]: Network threads started")
+    # Cancel the network tasks first so nothing is written to the files after they are closed
+    network.stop()
+    scan_file.close()
+    if udp_capture is not None:
+        udp_capture.close()
+    if stream_metrics is not None:
+        stream_metrics.close()
 
@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from magstream import RESTART_SEQ_GAP
+
+
+# ------------------------------- Per-stage latency of the live heatmap
+# Every UDP datagram carries the Pi times at which its first frame was read from the FPGA, put on
+# the UDP queue and sent (see magwire.py). The laptop adds the time it was received and the time
+# update_opencv_heatmap painted it. Pi times are moved onto the laptop clock with the offset from
+# estimate_clock_offset(), so only the network stage depends on the offset being right.
+#   read -> queue    read_frame() returning until the frame is on the UDP queue (parity check)
+#   queue -> send    waiting in the Pi's LifoQueue for udp_sender
+#   send -> recv     network, socket buffer and the receiver's poll
+#   recv -> paint    waiting for the next Tk heatmap tick, plus decode and colorize
+#   read -> paint    all of the above, what the operator sees
+STAGES = ("read -> queue", "queue -> send", "send -> recv", "recv -> paint", "read -> paint")
+LATENCY_WINDOW = 2000        # samples kept per stage
+CLOCK_PROBES = 8             # round trips per clock offset estimate
+
+
+# NTP style offset of the Pi clock against ours over the command channel (see magcommand.py). The
+# Pi answers "clock" with the times it received the request and sent the reply. The probe with the
+# shortest round trip wins, its offset is off by at most half that round trip.
+# The probes go out one after the other from the channel's callbacks, so nothing waits for them.
+# done(estimate) is called with (offset, rtt) in seconds, offset = Pi clock - laptop clock, or with
+# None if the Pi script does not answer clock probes within timeout seconds.
+def estimate_clock_offset(channel, done, probes=CLOCK_PROBES, timeout=1.0):
+    best = None
+
+    def probe(remaining):
+        t0 = time.time()
+        channel.send("clock", lambda reply: answered(reply, t0, remaining), timeout=timeout)
+
+    def answered(reply, t0, remaining):
+        nonlocal best
+        t3 = time.time()
+        if not reply["ok"] or "t_recv" not in reply:
+            done(None)
+            return
+        t1, t2 = reply["t_recv"], reply["t_sent"]
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        if best is None or rtt < best[1]:
+            best = (offset, rtt)
+        if remaining > 1:
+            probe(remaining - 1)
+        else:
+            done(best)
+
+    probe(probes)
+
+
+# Collects the stage latencies and drop counts. received() is called by the UDP receiver thread,
+# painted() by the Tk thread.
+# A restart of the Pi script numbers datagrams and frames from 0 again and brings a new clock offset.
+# It is detected like StreamHealth does (magstream.py): everything starts over, the offset is
+# dropped and on_restart() is called from the receiver thread to have it estimated again.
+class LatencyTracer:
+    def __init__(self, window=LATENCY_WINDOW, on_restart=None):
+        self._lock = threading.Lock()
+        self._window = window
+        self.on_restart = on_restart
+        self.clock_offset = 0.0
+        self.clock_rtt = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        self._stages = {stage: deque(maxlen=self._window) for stage in STAGES}
+        self._unpainted = OrderedDict()   # seq -> (t_read, t_recv) on the laptop clock
+        self._first_seq = self._last_seq = None
+        self._first_frame = self._last_frame = None
+        self._last_sent = None            # t_sent of the datagram numbered _last_seq
+        self._datagrams = self._frames = self._painted = 0
+
+    def set_clock_offset(self, offset, rtt):
+        self.clock_offset, self.clock_rtt = offset, rtt
+
+    def received(self, header, n_frames, t_recv):
+        last_frame = header.frame_id + n_frames - 1
+        with self._lock:
+            last_seq = self._last_seq
+            restarted = last_seq is not None and header.seq < last_seq and (
+                header.t_sent > self._last_sent or last_seq - header.seq > RESTART_SEQ_GAP)
+            if restarted:
+                self._reset()
+                self.clock_offset, self.clock_rtt = 0.0, None
+            offset = self.clock_offset
+            self._stages["read -> queue"].append(header.t_queued - header.t_read)
+            self._stages["queue -> send"].append(header.t_sent - header.t_queued)
+            self._stages["send -> recv"].append(t_recv - (header.t_sent - offset))
+            if self._first_seq is None:
+                self._first_seq = self._last_seq = header.seq
+                self._first_frame = self._last_frame = header.frame_id
+            if header.seq >= self._last_seq:
+                self._last_seq, self._last_sent = header.seq, header.t_sent
+            self._last_frame = max(self._last_frame, last_frame)
+            self._datagrams += 1
+            self._frames += n_frames
+            self._unpainted[header.seq] = (header.t_read - offset, t_recv)
+            while len(self._unpainted) > 64:
+                self._unpainted.popitem(last=False)
+        if restarted and self.on_restart is not None:
+            self.on_restart()
+
+    # The heatmap now shows datagram seq. Datagrams received before it and never shown are superseded.
+    def painted(self, seq, t_paint):
+        with self._lock:
+            times = self._unpainted.pop(seq, None)
+            if times is None:
+                return
+            t_read, t_recv = times
+            self._stages["recv -> paint"].append(t_paint - t_recv)
+            self._stages["read -> paint"].append(t_paint - t_read)
+            self._painted += 1
+
+    # {stage: (p50, p99, samples)} in seconds, and the drop counts:
+    #   network      datagrams missing from the sequence numbers
+    #   pi queue     frames read on the Pi that never left it (left behind in the LifoQueue)
+    #   superseded   datagrams received but replaced by a newer one before the heatmap painted them
+    def stats(self):
+        with self._lock:
+            samples = {stage: np.array(values) for stage, values in self._stages.items()}
+            if self._first_seq is None:
+                drops = {"network": 0, "pi queue": 0, "superseded": 0}
+            else:
+                lost = (self._last_seq - self._first_seq + 1) - self._datagrams
+                frames_per_datagram = self._frames / self._datagrams
+                sent = self._frames + lost * frames_per_datagram
+                drops = {
+                    "network": lost,
+                    "pi queue": max(0, round((self._last_frame - self._first_frame + 1) - sent)),
+                    "superseded": self._datagrams - self._painted,
+                }
+        percentiles = {}
+        for stage, values in samples.items():
+            if len(values):
+                p50, p99 = np.percentile(values, [50, 99])
+                percentiles[stage] = (p50, p99, len(values))
+            else:
+                percentiles[stage] = (None, None, 0)
+        return percentiles, drops
+
+    def report(self):
+        percentiles, drops = self.stats()
+        if self.clock_rtt is None:
+            lines = ["Latency (clock offset not estimated, send -> recv and read -> paint include it)"]
+        else:
+            lines = [f"Latency (clock offset {self.clock_offset * 1e3:+.2f} ms, +/- {self.clock_rtt * 5e2:.2f} ms)"]
+        for stage, (p50, p99, n) in percentiles.items():
+            if n:
+                lines.append(f"  {stage:<14} p50 {p50 * 1e3:8.2f} ms  p99 {p99 * 1e3:8.2f} ms  ({n} samples)")
+            else:
+                lines.append(f"  {stage:<14} no samples")
+        lines.append("  drops: " + ", ".join(f"{name} {count}" for name, count in drops.items()))
+        return "\n".join(lines)
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+
+# ------------------------------- Networking event loop
+# All laptop networking (scan receiver, live UDP receiver, command channel and the remote log)
+# runs as tasks on one asyncio event loop in one background thread, instead of a blocking thread
+# per socket that each wake up and contend for the GIL with Tk. Timeouts, reconnects and shutdown
+# are explicit in the tasks: stop() cancels them, and each closes its own sockets.
+# Other threads start tasks with submit() and hand calls over with call(). Nothing on the loop
+# touches Tk: results reach the GUI through queues and shared frames the Tk thread polls.
+# A selector loop on every platform, the UDP receiver drains bursts with add_reader(), which the
+# Windows proactor loop does not have.
+STOP_TIMEOUT = 2.0           # seconds stop() waits for the tasks to finish
+
+
+class NetworkLoop:
+    def __init__(self):
+        self.loop = asyncio.SelectorEventLoop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        # The loop only keeps weak references to tasks, a task waiting on nothing else would be collected
+        self._tasks = set()
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Runs coroutine as a task on the loop, from any thread. Returns a concurrent.futures.Future;
+    # a task that fails is reported under name.
+    def submit(self, coroutine, name):
+        future = asyncio.run_coroutine_threadsafe(self._report(coroutine, name), self.loop)
+        self._tasks.add(future)
+        future.add_done_callback(self._tasks.discard)
+        return future
+
+    # Calls function(*args) on the loop thread, from any thread
+    def call(self, function, *args):
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        if not self.loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result(timeout)
+        except Exception as e:
+            print(f"[NETWORK] Tasks did not stop cleanly: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+    @staticmethod
+    async def _report(coroutine, name):
+        try:
+            return await coroutine
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[NETWORK] {name} stopped: {e}")
+            raise
+
+    @staticmethod
+    async def _cancel_tasks():
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
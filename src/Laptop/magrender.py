@@ -0,0 +1,429 @@
+import threading
+
+import cv2
+import numpy as np
+
+from magdecode import decode_words, field_component, MAG_CONVERSION, STEP_CONVERSION
+
+
+# The array side of the viewer's plots, kept free of Tk so it can be profiled and benchmarked
+# headless (see magbench.py). The App methods in maglap.py only turn the results into PhotoImages.
+
+# ------------------------------- Live heatmap
+Z_THRESH = 2.5               # Z-score threshold for detecting local outliers
+MIN_FRAME_STD = 0.3          # frames flatter than this are treated as invalid by the filter
+
+
+# Write the selected field value of every pixel in a frame into the 8x8 heatmap, in place.
+# Pixel p goes to row 7 - p // 8, column p % 8. Zero values (this includes zero padding words)
+# leave the cell as it was.
+def update_heatmap(heatmap, words, choice):
+    Bx, By, Bz, pixel, _ = decode_words(words)
+    mag = field_component(Bx * MAG_CONVERSION, By * MAG_CONVERSION, Bz * MAG_CONVERSION, choice)
+    valid = mag != 0
+    heatmap[7 - pixel[valid] // 8, pixel[valid] % 8] = mag[valid]
+
+
+# Replace every cell that is more than z_thresh standard deviations away from the mean of its
+# 3x3 neighbourhood (clipped at the border) with that mean.
+# All cells at once: the neighbourhoods are gathered into a (rows, cols, 9) array through a
+# precomputed index table, border cells packed to the front and padded with zeros. The sums are
+# taken in the order np.mean/np.std use for a 3x3 slice (pairwise over 8 values plus the ninth,
+# plain left to right for the 4 or 6 values of a border cell), so the result is bit-identical to
+# filtering cell by cell.
+_neighbourhood_tables = {}
+
+
+def _neighbourhoods(shape):
+    if shape not in _neighbourhood_tables:
+        rows, cols = shape
+        sentinel = rows * cols               # index of the zero appended to the flattened grid
+        index = np.full((rows, cols, 9), sentinel, dtype=np.intp)
+        count = np.zeros((rows, cols), dtype=np.intp)
+        for i in range(rows):
+            for j in range(cols):
+                cells = [r * cols + c for r in range(max(0, i-1), min(rows, i+2))
+                         for c in range(max(0, j-1), min(cols, j+2))]
+                index[i, j, :len(cells)] = cells
+                count[i, j] = len(cells)
+        _neighbourhood_tables[shape] = (index, count, np.arange(9) < count[..., None])
+    return _neighbourhood_tables[shape]
+
+
+def _neighbourhood_sum(values, full):
+    # Left to right, as numpy sums fewer than 8 values. Padding zeros leave the sum unchanged.
+    total = 0.0
+    for k in range(9):
+        total = total + values[..., k]
+    # numpy's pairwise sum over 8 values, then the ninth
+    v = values
+    pairwise = ((v[..., 0] + v[..., 1]) + (v[..., 2] + v[..., 3])) + ((v[..., 4] + v[..., 5]) + (v[..., 6] + v[..., 7]))
+    pairwise = pairwise + v[..., 8]
+    return np.where(full, pairwise, total)
+
+
+def filter_outliers(heatmap, z_thresh=Z_THRESH):
+    index, count, valid = _neighbourhoods(heatmap.shape)
+    full = count == 9
+    flat = np.append(heatmap.ravel(), 0.0)
+    neighbours = flat[index]
+    local_mean = _neighbourhood_sum(neighbours, full) / count
+    deviation = np.where(valid, neighbours - local_mean[..., None], 0.0)
+    local_std = np.sqrt(_neighbourhood_sum(deviation * deviation, full) / count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        outlier = (local_std > 0) & (np.abs(heatmap - local_mean) / local_std > z_thresh)
+    return np.where(outlier, local_mean, heatmap)
+
+
+# ------------------------------- Colorizing
+# Scale a grid up to size (width, height) with nearest neighbour and map it through viridis.
+# Values are stretched over the grid's own min..max, or over 0..vmax when vmax is given.
+# Returns an RGB uint8 image.
+def colorize(grid, size, vmax=None, invert=False):
+    resized = cv2.resize(grid, size, interpolation=cv2.INTER_NEAREST)
+    if vmax is None:
+        norm_img = cv2.normalize(resized, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    else:
+        norm_img = np.clip(resized / vmax * 255, 0, 255).astype(np.uint8)
+    if invert:
+        norm_img = 255 - norm_img
+    colored = cv2.applyColorMap(norm_img, cv2.COLORMAP_VIRIDIS)
+    return cv2.cvtColor(colored, cv2.COLOR_BGR2RGB)
+
+
+# RGB of viridis for every uint8 level, the table applyColorMap uses. Reversed for invert.
+VIRIDIS_LUT = cv2.cvtColor(cv2.applyColorMap(np.arange(256, dtype=np.uint8)[:, None], cv2.COLORMAP_VIRIDIS),
+                           cv2.COLOR_BGR2RGB)[:, 0]
+VIRIDIS_LUT_INVERTED = VIRIDIS_LUT[::-1].copy()
+
+
+# colorize() into buffers that are kept from call to call, for the images redrawn every tick.
+# The grid is scaled to uint8 levels at its own size, looked up in VIRIDIS_LUT and then scaled up
+# by replicating pixels through an index map, so nothing of the output size is allocated per call.
+# The index map is an arange of the grid's cells put through the same cv2.resize as colorize(), so
+# it picks exactly the pixels INTER_NEAREST picks at any ratio. When the grid is shrunk and some
+# cells are never picked, the min/max scaling is taken over the picked cells only, like colorize()
+# does on the resized image. render() returns the same (height, width, 3) RGB array every time
+# (or out, when given), equal to what colorize() returns for the same arguments. The small
+# buffers and the index map are rebuilt only when the grid shape changes.
+class GridRenderer:
+    def __init__(self, size):
+        width, height = size
+        self.size = size
+        self.rgb = np.zeros((height, width, 3), dtype=np.uint8)
+        self._shape = None
+
+    def _reshape(self, shape):
+        rows, cols = shape
+        cells = np.arange(rows * cols, dtype=np.int32).reshape(shape)
+        self._index = cv2.resize(cells, self.size, interpolation=cv2.INTER_NEAREST).ravel().astype(np.intp)
+        picked = np.zeros(rows * cols, dtype=np.uint8)
+        picked[self._index] = 1
+        self._mask = None if picked.all() else picked.reshape(shape)
+        self._scaled = np.zeros(shape)          # cells the mask leaves out stay 0
+        self._levels = np.empty(shape, dtype=np.uint8)
+        self._colors = np.empty((rows * cols, 3), dtype=np.uint8)
+        self._shape = shape
+
+    def render(self, grid, vmax=None, invert=False, out=None):
+        if grid.shape != self._shape:
+            self._reshape(grid.shape)
+        scaled = self._scaled
+        if vmax is None:
+            # Through OpenCV, whose fused multiply-add numpy can not reproduce
+            cv2.normalize(grid, scaled, 0, 255, cv2.NORM_MINMAX, mask=self._mask)
+        else:
+            np.divide(grid, vmax, out=scaled)
+            np.multiply(scaled, 255, out=scaled)
+            np.clip(scaled, 0, 255, out=scaled)
+        np.copyto(self._levels, scaled, casting="unsafe")
+        lut = VIRIDIS_LUT_INVERTED if invert else VIRIDIS_LUT
+        np.take(lut, self._levels.ravel(), axis=0, out=self._colors, mode="clip")
+        rgb = self.rgb if out is None else out
+        np.take(self._colors, self._index, axis=0, out=rgb.reshape(-1, 3), mode="clip")
+        return rgb
+
+
+# ------------------------------- Handing images to the Tk thread
+# Two preallocated RGB images of one view. A render worker draws into back and makes it the front
+# image with publish(); the Tk thread copies the front image out with take(). The lock is held
+# for the swap and the copy only, never while drawing, so neither side waits on the other's work.
+class DoubleBuffer:
+    def __init__(self, size):
+        width, height = size
+        self.size = size
+        self._images = [np.zeros((height, width, 3), dtype=np.uint8) for _ in range(2)]
+        self._lock = threading.Lock()
+        self._published = self._taken = 0
+        self._info = None
+
+    # The image the worker draws into next
+    @property
+    def back(self):
+        return self._images[1]
+
+    # Swap back and front. info (the datagram seq of the live heatmap) is handed to take().
+    def publish(self, info=None):
+        with self._lock:
+            self._images.reverse()
+            self._info = info
+            self._published += 1
+
+    # If an image was published since the last take, call copy(front image) and return
+    # (True, info), else (False, None).
+    def take(self, copy):
+        with self._lock:
+            if self._taken == self._published:
+                return False, None
+            copy(self._images[0])
+            self._taken = self._published
+            return True, self._info
+
+
+# ------------------------------- Projections
+# Average of values binned over (u, v) on a grid_size x grid_size grid spanning the data range.
+def projection_grid(u, v, values, grid_size=50):
+    if len(u) == 0:
+        return np.zeros((grid_size, grid_size), dtype=float)
+    # Define bins based on the range of u and v values.
+    u_bins = np.linspace(u.min(), u.max(), grid_size + 1)
+    v_bins = np.linspace(v.min(), v.max(), grid_size + 1)
+    # Create two 2D histograms: one for the sum of values and one for counting.
+    sum_grid, _, _ = np.histogram2d(u, v, bins=[u_bins, v_bins], weights=values)
+    count_grid, _, _ = np.histogram2d(u, v, bins=[u_bins, v_bins])
+    # Compute the average value per bin.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_grid = np.divide(sum_grid, count_grid, out=np.zeros_like(sum_grid), where=count_grid != 0)
+    return np.nan_to_num(avg_grid)
+
+
+# Running sum and count grids of one projection, fed only the samples added since the last tick.
+# The grid starts out spanning the first samples. When later samples fall outside it, the cell
+# size doubles on that axis and neighbouring cells are merged pairwise, so nothing is ever
+# re-binned from the samples. grid() crops to the cells the data covers, so the shown grid has
+# fewer cells than bins once the range has grown.
+PROJECTION_BINS = 100        # cells per axis, twice the 50 the projections used to show
+
+
+class ProjectionAccumulator:
+    def __init__(self, bins=PROJECTION_BINS):
+        if bins % 2:
+            raise ValueError("bins must be even")
+        self.bins = bins
+        self.clear()
+
+    def __len__(self):
+        return self.n_samples
+
+    def clear(self):
+        self._sum = np.zeros((self.bins, self.bins))
+        self._count = np.zeros((self.bins, self.bins))
+        self._origin = None          # lower edge of cell (0, 0) per axis
+        self._width = None           # cell size per axis
+        self._bounds = None          # data range per axis, [[umin, umax], [vmin, vmax]]
+        self.n_samples = 0
+
+    def add(self, u, v, values):
+        if len(u) == 0:
+            return
+        bounds = np.array([[u.min(), u.max()], [v.min(), v.max()]], dtype=float)
+        if self._origin is None:
+            # Centre the data on bins - 1 cells, so there is half a cell to spare at both ends
+            self._width = np.maximum((bounds[:, 1] - bounds[:, 0]) / (self.bins - 1), STEP_CONVERSION)
+            self._origin = bounds[:, 0] - self._width / 2
+            self._bounds = bounds
+        else:
+            self._bounds[:, 0] = np.minimum(self._bounds[:, 0], bounds[:, 0])
+            self._bounds[:, 1] = np.maximum(self._bounds[:, 1], bounds[:, 1])
+        for axis in (0, 1):
+            while bounds[axis, 0] < self._origin[axis]:
+                self._grow(axis, down=True)
+            while bounds[axis, 1] >= self._origin[axis] + self.bins * self._width[axis]:
+                self._grow(axis, down=False)
+
+        iu = self._cells(u, 0)
+        iv = self._cells(v, 1)
+        flat = iu * self.bins + iv
+        size = self.bins * self.bins
+        self._sum += np.bincount(flat, weights=values, minlength=size).reshape(self.bins, self.bins)
+        self._count += np.bincount(flat, minlength=size).reshape(self.bins, self.bins)
+        self.n_samples += len(u)
+
+    def _cells(self, coords, axis):
+        cells = ((coords - self._origin[axis]) / self._width[axis]).astype(np.intp)
+        # Values on the very edge can round one cell out
+        return np.clip(cells, 0, self.bins - 1)
+
+    # Double the cell size along axis. The old cells become one half of the grid, the upper half
+    # when growing down and the lower half when growing up.
+    def _grow(self, axis, down):
+        half = self.bins // 2
+        for name in ("_sum", "_count"):
+            grid = np.moveaxis(getattr(self, name), axis, 0)
+            grown = np.zeros_like(grid)
+            if down:
+                grown[half:] = grid[0::2] + grid[1::2]
+            else:
+                grown[:half] = grid[0::2] + grid[1::2]
+            setattr(self, name, np.ascontiguousarray(np.moveaxis(grown, 0, axis)))
+        if down:
+            self._origin[axis] -= self.bins * self._width[axis]
+        self._width[axis] *= 2
+
+    # Average value per cell over the data range, zero where a cell has no samples.
+    def grid(self):
+        if self._origin is None:
+            return np.zeros((self.bins // 2, self.bins // 2))
+        (u0, u1), (v0, v1) = (self._cells(self._bounds[axis], axis) for axis in (0, 1))
+        sum_grid = self._sum[u0:u1 + 1, v0:v1 + 1]
+        count_grid = self._count[u0:u1 + 1, v0:v1 + 1]
+        return np.divide(sum_grid, count_grid, out=np.zeros_like(sum_grid), where=count_grid != 0)
+
+
+# ------------------------------- 3D level of detail
+# Thin the samples of the 3D view down to at most budget points by averaging them per voxel.
+# Voxels are cubes, their size is searched in steps of 2 ** (1 / 3) (doubling or halving the number
+# of voxels in a volume) for the finest grid with no more than budget occupied voxels. cell is the
+# size found last time and is a good place to start, the data usually changed little since.
+# bounds ((x0, x1), (y0, y1), (z0, z1)) restricts the samples to the visible region, which gives
+# finer voxels when zoomed in. Each voxel is drawn at the centroid of its samples with the mean
+# (reduce="mean") or max (reduce="max") value. Returns x, y, z, values and the voxel size, 0 when
+# the samples were already within the budget.
+VOXEL_STEP = 2 ** (1 / 3)
+VOXEL_SEARCH_STEPS = 32      # bound on voxel size changes per call
+_BINCOUNT_MAX_CELLS = 1 << 24  # count occupied voxels with bincount up to this many, np.unique above
+
+
+def _voxel_keys(x, y, z, origin, cell):
+    ix = ((x - origin[0]) / cell).astype(np.int64)
+    iy = ((y - origin[1]) / cell).astype(np.int64)
+    iz = ((z - origin[2]) / cell).astype(np.int64)
+    dims = (ix.max() + 1, iy.max() + 1, iz.max() + 1)
+    return (ix * dims[1] + iy) * dims[2] + iz, dims[0] * dims[1] * dims[2]
+
+
+def _occupied(keys, n_cells):
+    if n_cells <= _BINCOUNT_MAX_CELLS:
+        return np.count_nonzero(np.bincount(keys, minlength=n_cells))
+    return len(np.unique(keys))
+
+
+def voxel_decimate(x, y, z, values, budget, bounds=None, reduce="mean", cell=None):
+    if bounds is not None:
+        inside = ((x >= bounds[0][0]) & (x <= bounds[0][1]) & (y >= bounds[1][0]) & (y <= bounds[1][1])
+                  & (z >= bounds[2][0]) & (z <= bounds[2][1]))
+        x, y, z, values = x[inside], y[inside], z[inside], values[inside]
+    if len(x) <= budget:
+        return x, y, z, values, 0
+
+    origin = np.array([x.min(), y.min(), z.min()], dtype=np.float64)
+    extent = np.array([x.max(), y.max(), z.max()], dtype=np.float64) - origin
+    if not cell:
+        # Fits the whole bounding box into budget voxels
+        cell = max(extent.max() / budget ** (1 / 3), 1e-9)
+    # Never finer than one voxel per sample on the longest axis, so the search always ends
+    min_cell = extent.max() / len(x)
+
+    keys, n_cells = _voxel_keys(x, y, z, origin, cell)
+    for _ in range(VOXEL_SEARCH_STEPS):
+        if _occupied(keys, n_cells) > budget:
+            cell *= VOXEL_STEP
+            keys, n_cells = _voxel_keys(x, y, z, origin, cell)
+            continue
+        finer = cell / VOXEL_STEP
+        if finer < min_cell:
+            break
+        finer_keys, finer_cells = _voxel_keys(x, y, z, origin, finer)
+        if _occupied(finer_keys, finer_cells) > budget:
+            break
+        cell, keys, n_cells = finer, finer_keys, finer_cells
+
+    # Reduce every occupied voxel. Sparse grids too big for bincount are compacted first.
+    if n_cells > _BINCOUNT_MAX_CELLS:
+        _, keys = np.unique(keys, return_inverse=True)
+        n_cells = keys.max() + 1
+    counts = np.bincount(keys, minlength=n_cells)
+    occupied = np.flatnonzero(counts)
+    counts = counts[occupied]
+    centroid = [np.bincount(keys, weights=axis, minlength=n_cells)[occupied] / counts for axis in (x, y, z)]
+    if reduce == "max":
+        reduced = np.full(n_cells, -np.inf)
+        np.maximum.at(reduced, keys, values)
+        reduced = reduced[occupied]
+    else:
+        reduced = np.bincount(keys, weights=values, minlength=n_cells)[occupied] / counts
+    return centroid[0], centroid[1], centroid[2], reduced, cell
+
+
+# ------------------------------- 3D point cloud rasterizer
+# The "raster" 3D view (FIELD_VIEW in maglap.py): every sample drawn as a point_size square
+# through an orthographic camera, nearest point wins, in NumPy. There are no axes or colorbar,
+# but it renders a million points in tens of milliseconds where the matplotlib scatter manages
+# a few thousand.
+CLOUD_BACKGROUND = (255, 255, 255)
+_DEPTH_LEVELS = (1 << 32) - 2        # depths quantized to 1 .. 2**32 - 1, 0 marks an empty pixel
+
+
+# 4x4 matrix taking world points to (pixel column, pixel row, depth, 1) for a camera orbiting
+# center at azimuth azim and elevation elev in degrees, as in matplotlib's 3D axes (z up).
+# The sphere of the given radius around center fills the smaller image side at zoom 1. Depth
+# runs from -1 (far side of the sphere) to 1 (near side).
+def orbit_matrix(center, radius, azim, elev, zoom, size):
+    azim, elev = np.radians(azim), np.radians(elev)
+    towards_viewer = np.array([np.cos(elev) * np.cos(azim), np.cos(elev) * np.sin(azim), np.sin(elev)])
+    right = np.array([-np.sin(azim), np.cos(azim), 0.0])
+    up = np.cross(towards_viewer, right)
+    width, height = size
+    scale = zoom * min(width, height) / 2 / radius
+    rotation = np.array([right * scale, -up * scale, towards_viewer / radius])
+    matrix = np.eye(4)
+    matrix[:3, :3] = rotation
+    matrix[:3, 3] = np.array([width / 2, height / 2, 0.0]) - rotation @ np.asarray(center, dtype=float)
+    return matrix
+
+
+# Center and radius of the bounding sphere of the points' bounding box, for orbit_matrix
+def bounding_sphere(x, y, z):
+    if len(x) == 0:
+        return np.zeros(3), 1.0
+    low = np.array([x.min(), y.min(), z.min()], dtype=float)
+    high = np.array([x.max(), y.max(), z.max()], dtype=float)
+    return (low + high) / 2, max(np.linalg.norm(high - low) / 2, STEP_CONVERSION)
+
+
+# Splats points into an RGB image with a depth buffer. The depth and the point index are packed
+# into one uint64 key per covered pixel, depth in the high half, so np.maximum.at leaves the
+# nearest point of every pixel in the buffer in one vectorized pass. Only the winners are looked
+# up in the colormap. render() draws into the same (height, width, 3) array every time, or out.
+class PointCloudRenderer:
+    def __init__(self, size, point_size=2, background=CLOUD_BACKGROUND):
+        width, height = size
+        self.size = size
+        self.point_size = point_size
+        self.background = np.array(background, dtype=np.uint8)
+        self.rgb = np.zeros((height, width, 3), dtype=np.uint8)
+        self._depth = np.zeros(width * height, dtype=np.uint64)
+
+    # x, y, z: positions, levels: uint8 colormap level per point, matrix: from orbit_matrix()
+    def render(self, x, y, z, levels, matrix, lut=VIRIDIS_LUT_INVERTED, out=None):
+        width, height = self.size
+        rgb = self.rgb if out is None else out
+        column = (matrix[0, 0] * x + matrix[0, 1] * y + matrix[0, 2] * z + matrix[0, 3]).astype(np.intp)
+        row = (matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2] * z + matrix[1, 3]).astype(np.intp)
+        depth = matrix[2, 0] * x + matrix[2, 1] * y + matrix[2, 2] * z + matrix[2, 3]
+        key = (np.clip((depth + 1) / 2, 0, 1) * _DEPTH_LEVELS + 1).astype(np.uint64) << np.uint64(32)
+        key |= np.arange(len(x), dtype=np.uint64)
+
+        self._depth[:] = 0
+        for d_row in range(self.point_size):
+            for d_column in range(self.point_size):
+                r, c = row + d_row, column + d_column
+                inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+                np.maximum.at(self._depth, r[inside] * width + c[inside], key[inside])
+
+        flat = rgb.reshape(-1, 3)
+        flat[:] = self.background
+        covered = np.flatnonzero(self._depth)
+        winner = (self._depth[covered] & np.uint64(0xFFFFFFFF)).astype(np.intp)
+        flat[covered] = lut[levels[winner]]
+        return rgb
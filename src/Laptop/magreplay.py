@@ -0,0 +1,217 @@
+import argparse
+import ast
+import heapq
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+from magwire import TCP_RECORD_DTYPE, TCP_RECORD_SIZE, TCP_VERSION, pack_scan_record, pack_udp_datagram, pack_scan_hello
+from magscanfile import ScanFile, read_udp_capture
+from magcommand import CommandServer
+
+
+# Stands in for magpi1.py / simulation.py and plays a recorded scan into the laptop receivers:
+#   python magreplay.py <laptop ip> <tcp port> <cmd port> <udp port> <scan> [--udp CAPTURE] [--speed N]
+# <scan> is a .mscan file (magscanfile.py) or an old parsed_data.txt text log. The live heatmap is
+# fed from a UDP capture if one is given, otherwise every scan record is also sent as a UDP frame.
+# --speed 1 replays in recorded time, N replays N times faster and 0 (or "max") as fast as possible.
+# Like the Pi, nothing is sent until the GUI sends "start"; --autostart begins straight away.
+# Records are numbered from 0 like a fresh Pi stream (magresume.py), but a replay does not resume:
+# the laptop's acks are not read and a dropped connection ends it.
+
+REPLAY_TEXT_RATE = 100.0     # records/s assumed for text logs, which carry no timing
+TCP_BATCH_BYTES = 1 << 16    # records are coalesced up to this size before a sendall
+
+acquisition_enabled = False
+running = True
+
+
+# ------------------------------- Event sources
+# Every source yields (time, kind, payload) in time order. kind is "tcp" (a packed scan record),
+# "udp" (a datagram as captured) or "frame" (sensor words to be sent as a UDP datagram).
+
+def scan_file_events(path, with_frames):
+    scan = ScanFile(path)
+    seq = 0
+    for i in range(len(scan.chunks)):
+        records = scan.chunk(i)
+        if scan.chunk_times[i] is None:
+            # v1 files carry no timing, play them like a text log
+            times = ((np.arange(len(records)) + seq) / REPLAY_TEXT_RATE).tolist()
+        else:
+            # Only chunk arrival times are stored, spread the records of a chunk evenly between them
+            t_first, t_last = scan.chunk_times[i]
+            times = np.linspace(t_first, t_last, len(records)).tolist()
+        # Number the records for this replay, which also brings records of older files to the current version
+        out = np.zeros(len(records), dtype=TCP_RECORD_DTYPE)
+        for name in records.dtype.names:
+            out[name] = records[name]
+        out["version"] = TCP_VERSION
+        out["seq"] = np.arange(seq, seq + len(records))
+        seq += len(records)
+        raw = out.tobytes()
+        for k, t in enumerate(times):
+            yield t, "tcp", raw[k * TCP_RECORD_SIZE:(k + 1) * TCP_RECORD_SIZE]
+            if with_frames:
+                yield t, "frame", records["words"][k][:records["n_words"][k]].tolist()
+
+
+def text_log_events(path, with_frames):
+    with open(path) as f:
+        n = 0
+        for line in f:
+            line = line.strip()
+            if not line.startswith("[["):
+                continue
+            # Lines are the repr of [[n_theta, n_r, n_z, counter], [words]], which is also valid JSON
+            try:
+                location, frame = json.loads(line)
+            except ValueError:
+                location, frame = ast.literal_eval(line)
+            t = n / REPLAY_TEXT_RATE
+            yield t, "tcp", pack_scan_record(location, frame, n)
+            n += 1
+            if with_frames:
+                yield t, "frame", frame
+
+
+def udp_capture_events(path, relative):
+    t0 = None
+    for t_recv, data in read_udp_capture(path):
+        if relative:
+            # Line the capture up with a text log, which starts at t = 0
+            if t0 is None:
+                t0 = t_recv
+            t_recv -= t0
+        yield t_recv, "udp", data
+
+
+def replay_events(scan_path, udp_path=None):
+    if scan_path.endswith(".mscan"):
+        scan = scan_file_events(scan_path, with_frames=udp_path is None)
+    else:
+        scan = text_log_events(scan_path, with_frames=udp_path is None)
+    if udp_path is None:
+        return scan
+    udp = udp_capture_events(udp_path, relative=not scan_path.endswith(".mscan"))
+    return heapq.merge(scan, udp, key=lambda event: event[0])
+
+
+# ------------------------------- Player
+def player(ip, tcp_port, udp_port, events, speed):
+    udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    while running:
+        try:
+            tcp_sock = socket.create_connection((ip, tcp_port))
+            tcp_sock.sendall(pack_scan_hello(random.getrandbits(32), 0))
+            break
+        except OSError as e:
+            print("[REPLAY] TCP connection error:", e)
+            time.sleep(2)
+    else:
+        return
+
+    pending = []
+    pending_bytes = 0
+
+    def flush():
+        nonlocal pending, pending_bytes
+        if pending:
+            tcp_sock.sendall(b"".join(pending))
+            pending, pending_bytes = [], 0
+
+    seq = 0
+    n_records = n_frames = 0
+    wall0 = origin = None
+    t_start = time.monotonic()
+    for t, kind, payload in events:
+        # Hold while paused and re-anchor the clock on resume
+        while running and not acquisition_enabled:
+            flush()
+            wall0 = None
+            time.sleep(0.1)
+        if not running:
+            break
+        if speed > 0:
+            if wall0 is None:
+                wall0, origin = time.monotonic(), t
+            delay = wall0 + (t - origin) / speed - time.monotonic()
+            if delay > 0:
+                flush()
+                time.sleep(delay)
+
+        if kind == "tcp":
+            pending.append(payload)
+            pending_bytes += len(payload)
+            n_records += 1
+            if pending_bytes >= TCP_BATCH_BYTES:
+                flush()
+        else:
+            if kind == "frame":
+                # Stamped with the replay clock so the latency trace measures the laptop side
+                payload = pack_udp_datagram(seq, time.time(), [payload], frame_id=seq)
+            udp_sock.sendto(payload, (ip, udp_port))
+            seq += 1
+            n_frames += 1
+    flush()
+
+    elapsed = time.monotonic() - t_start
+    print(f"[REPLAY] Done: {n_records} records and {n_frames} UDP frames in {elapsed:.2f} s "
+          f"({n_records / max(elapsed, 1e-9):.0f} records/s)")
+    tcp_sock.close()
+
+
+# ------------------------------- Commands from the laptop
+# Commands over the persistent command connection, see magcommand.py
+def handle_command(message, t_recv):
+    global acquisition_enabled, running
+    cmd = message.get("cmd")
+    if cmd == "clock":
+        # Clock offset probe, see maglatency.py
+        return {"t_recv": t_recv, "t_sent": time.time()}
+    print(f"[CMD RECEIVED] {cmd}")
+    if cmd == "start":
+        acquisition_enabled = True
+        return {"status": "Replay started"}
+    elif cmd == "pause":
+        acquisition_enabled = False
+        return {"status": "Replay paused"}
+    elif cmd == "stop":
+        acquisition_enabled = False
+        running = False
+        return {"status": "Replay stopped"}
+    return {"error": f"unknown command {cmd!r}"}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded scan into the magnetic field viewer")
+    parser.add_argument("ip")
+    parser.add_argument("tcp_port", type=int)
+    parser.add_argument("cmd_port", type=int)
+    parser.add_argument("udp_port", type=int)
+    parser.add_argument("scan", help=".mscan scan file or parsed_data.txt text log")
+    parser.add_argument("--udp", help="UDP capture (.mudp) to drive the live heatmap")
+    parser.add_argument("--speed", default="1", help="replay speed factor, 0 or 'max' for as fast as possible")
+    parser.add_argument("--autostart", action="store_true", help="start without waiting for the start command")
+    args = parser.parse_args()
+    speed = 0.0 if args.speed == "max" else float(args.speed)
+
+    acquisition_enabled = args.autostart
+    CommandServer(args.cmd_port, handle_command).start()
+    play = threading.Thread(target=player, args=(args.ip, args.tcp_port, args.udp_port,
+                                                 replay_events(args.scan, args.udp), speed), daemon=True)
+    play.start()
+
+    print(f"[REPLAY] Replaying {args.scan} at {'max' if speed == 0 else f'{speed:g}x'} speed.")
+    try:
+        while play.is_alive():
+            play.join(1)
+    except KeyboardInterrupt:
+        running = False
+        print("[REPLAY] Shutting down.")
+    sys.exit(0)
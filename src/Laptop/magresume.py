@@ -0,0 +1,155 @@
+import random
+import socket
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from magwire import pack_scan_record, pack_scan_hello, pack_scan_ack, ScanAckReader
+
+
+# ------------------------------- Resumable scan stream
+# Wire format in magwire.py ("Scan stream resume"). The Pi numbers every scan record and keeps it in
+# a spool until the laptop acknowledges it. When the connection drops (a Wi-Fi blip, the laptop
+# restarting its receiver) the Pi reconnects and sends the spool again from the laptop's last ack,
+# the laptop drops the records it already had. Records are only lost when the spool overflows,
+# and then the laptop sees the gap in the sequence numbers and counts it.
+# Sequence numbers are uint32 and not expected to wrap: at 100 records/s that takes over a year.
+SPOOL_RECORDS = 32768        # unacknowledged records the Pi keeps for a resend, ~17 MB
+ACK_INTERVAL = 0.5           # seconds between acks from the laptop while records come in
+ACK_RECORDS = 1024           # records after which the laptop acks without waiting for ACK_INTERVAL
+ACK_TIMEOUT = 10.0           # seconds without an ack, with records waiting, before the Pi reconnects
+
+
+# ------------------------------- Spool, the Pi end
+# Used by simulation.py, magpi1.py has its own copy. The sender thread numbers records with add()
+# and starts every connection with resume(); read_acks() runs on a thread per connection.
+class ScanSpool:
+    def __init__(self, max_records=SPOOL_RECORDS):
+        self.max_records = max_records
+        self.stream_id = random.getrandbits(32)
+        self.next_seq = 0
+        self.dropped = 0             # records pushed out of a full spool before they were acked
+        self._records = deque()      # (seq, packed record), sent or about to be sent, not acked
+        self._lock = threading.Lock()
+        self._waiting_since = time.monotonic()
+
+    # Numbers and spools a record and returns it packed, ready to send
+    def add(self, location, frame):
+        record = pack_scan_record(location, frame, self.next_seq)
+        with self._lock:
+            if not self._records:
+                self._waiting_since = time.monotonic()
+            self._records.append((self.next_seq, record))
+            if len(self._records) > self.max_records:
+                self._records.popleft()
+                self.dropped += 1
+        self.next_seq += 1
+        return record
+
+    # The hello and every unacknowledged record, to send first on a new connection
+    def resume(self):
+        with self._lock:
+            first_seq = self._records[0][0] if self._records else self.next_seq
+            self._waiting_since = time.monotonic()
+            return b"".join([pack_scan_hello(self.stream_id, first_seq)] + [record for _, record in self._records])
+
+    # The laptop has everything before next_seq
+    def acked(self, next_seq):
+        with self._lock:
+            while self._records and self._records[0][0] < next_seq:
+                self._records.popleft()
+            self._waiting_since = time.monotonic()
+
+    # True when records have been waiting for an ack longer than timeout: the connection is
+    # probably dead even though sends still succeed (they only fill the socket buffer)
+    def stalled(self, timeout=ACK_TIMEOUT):
+        with self._lock:
+            return bool(self._records) and time.monotonic() - self._waiting_since > timeout
+
+    def __len__(self):
+        return len(self._records)
+
+
+# Reads acks from the laptop until the connection closes, then shuts sock down so the sender's next
+# send fails and it reconnects. The sender may have given sock a timeout for its sends, a quiet
+# stream is not an error here.
+def read_acks(sock, spool):
+    acks = ScanAckReader()
+    try:
+        while True:
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            next_seq = acks.feed(data)
+            if next_seq is not None:
+                spool.acked(next_seq)
+    except (OSError, ValueError):
+        pass
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+# ------------------------------- Resume, the laptop end
+# Tracks the Pi's scan stream across connections, on the laptop's network loop. hello() is called at
+# the start of every connection, accept() with every array of records received.
+class ScanResume:
+    def __init__(self, ack_interval=ACK_INTERVAL, ack_records=ACK_RECORDS):
+        self.ack_interval = ack_interval
+        self.ack_records = ack_records
+        self.stream_id = None
+        self.next_seq = 0
+        self.resumes = 0             # reconnects that continued the same stream
+        self.duplicates = 0          # resent records that had already arrived, dropped
+        self.lost = 0                # records the Pi no longer had when the connection came back
+        self._unacked = 0
+        self._last_ack = time.monotonic()
+
+    # A new stream id means the Pi script restarted and numbers from scratch.
+    # Returns the ack to send straight away, so the Pi can trim what it is about to resend.
+    def hello(self, stream_id, first_seq):
+        if stream_id != self.stream_id:
+            self.stream_id = stream_id
+            self.next_seq = first_seq
+        else:
+            self.resumes += 1
+            self._skip(first_seq)
+        return self.ack()
+
+    # Returns the records not received before, in order
+    def accept(self, records):
+        seq = records["seq"]
+        if len(seq) == 0 or seq[-1] < self.next_seq:
+            self.duplicates += len(seq)
+            return records[:0]
+        first = int(np.searchsorted(seq, self.next_seq))
+        self.duplicates += first
+        records = records[first:]
+        self._skip(int(seq[first]))
+        self.next_seq = int(seq[-1]) + 1
+        self._unacked += len(records)
+        return records
+
+    def _skip(self, seq):
+        if seq > self.next_seq:
+            print(f"[TCP RECEIVER] Lost {seq - self.next_seq} scan records (Pi spool overflowed)")
+            self.lost += seq - self.next_seq
+            self.next_seq = seq
+
+    def ack_due(self):
+        return self._unacked > 0 and (self._unacked >= self.ack_records or
+                                      time.monotonic() - self._last_ack >= self.ack_interval)
+
+    def ack(self):
+        self._unacked = 0
+        self._last_ack = time.monotonic()
+        return pack_scan_ack(self.next_seq)
+
+    def summary(self):
+        return f"Scan stream: {self.resumes} resumes, {self.duplicates} resent, {self.lost} lost"
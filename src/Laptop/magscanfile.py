@@ -0,0 +1,372 @@
+import json
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from magdecode import WORDS_PER_FRAME, STEP_CONVERSION, MAG_CONVERSION, PIXEL_JUMP_R, PIXEL_JUMP_Z, THETA_STEPS
+from magwire import TCP_RECORD_DTYPE, TCP_RECORD_DTYPE_V1, TCP_RECORD_SIZE
+
+
+# ------------------------------- Scan file layout
+# File header, padded to SCAN_HEADER_SIZE: magic "MIRASCAN", version (uint16), length of a JSON
+# metadata block (uint32), then the JSON itself (rig constants, units, record layout, start time).
+# After that the file is a sequence of chunks. A chunk is a 32 byte header: "CHNK", record count
+# (uint32), the z position of every record in it (int32, motor steps) and the laptop arrival time of
+# its first and last record (float64, time.time()), followed by that many raw scan records exactly
+# as they came over TCP (magwire.TCP_RECORD_DTYPE, 536 bytes each, with the Pi's sequence number).
+# Version 2 files hold version 1 records without a sequence number (TCP_RECORD_DTYPE_V1, 532 bytes)
+# and can still be read. Version 1 files also have the 16 byte chunk header without arrival times
+# (CHUNK_HEADER_V1); their chunk_times are None.
+# A chunk never mixes z-layers. The file is only ever appended to, so a scan cut short by a crash
+# is still readable up to the last complete record.
+SCAN_MAGIC = b"MIRASCAN"
+SCAN_VERSION = 3
+SCAN_HEADER_SIZE = 4096
+SCAN_PREFIX = struct.Struct(">8sHI")
+CHUNK_MAGIC = b"CHNK"
+CHUNK_HEADER = struct.Struct(">4sIi4xdd")
+CHUNK_HEADER_V1 = struct.Struct(">4sIi4x")
+CHUNK_RECORDS = 2048         # ~1 MB of records per chunk
+WRITE_QUEUE_SIZE = 256       # receive buffers the background writer can fall behind by (~16 MB)
+FSYNC_INTERVAL = 2.0         # seconds between fsyncs while records are coming in
+
+
+def scan_metadata(**extra):
+    metadata = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "record_size": TCP_RECORD_SIZE,
+        "record_dtype": TCP_RECORD_DTYPE.descr,
+        "words_per_frame": WORDS_PER_FRAME,
+        "rig": {
+            "STEP_CONVERSION": STEP_CONVERSION,
+            "MAG_CONVERSION": MAG_CONVERSION,
+            "PIXEL_JUMP_R": PIXEL_JUMP_R,
+            "PIXEL_JUMP_Z": PIXEL_JUMP_Z,
+            "THETA_STEPS": THETA_STEPS,
+        },
+        "units": {
+            "n_theta": "motor steps (360 / THETA_STEPS degrees)",
+            "n_r": "motor steps",
+            "n_z": "motor steps",
+            "position": "motor steps * STEP_CONVERSION",
+            "field": "sensor LSB * MAG_CONVERSION = mT",
+        },
+    }
+    metadata.update(extra)
+    return metadata
+
+
+# ------------------------------- Writer
+# Buffers records per z-layer and writes them out one chunk at a time with a single sequential write.
+# write() accepts TCP_RECORD_DTYPE arrays as returned by magwire.ScanRecordReader.
+class ScanFileWriter:
+    def __init__(self, path, chunk_records=CHUNK_RECORDS, **metadata):
+        self.path = path
+        self.chunk_records = chunk_records
+        header = json.dumps(scan_metadata(**metadata)).encode()
+        if SCAN_PREFIX.size + len(header) > SCAN_HEADER_SIZE:
+            raise ValueError("scan metadata does not fit in the file header")
+        self._file = open(path, "wb")
+        self._file.write((SCAN_PREFIX.pack(SCAN_MAGIC, SCAN_VERSION, len(header)) + header).ljust(SCAN_HEADER_SIZE, b"\0"))
+        self._pending = []
+        self._pending_count = 0
+        self._pending_z = None
+        self._pending_t = (0.0, 0.0)
+        self.records_written = 0
+        self.bytes_written = SCAN_HEADER_SIZE
+
+    # t_recv is when the records arrived (time.time()), kept per chunk for replay
+    def write(self, records, t_recv=None):
+        if len(records) == 0:
+            return
+        if t_recv is None:
+            t_recv = time.time()
+        # Split into runs of records taken at the same z
+        n_z = records["n_z"]
+        breaks = np.flatnonzero(n_z[1:] != n_z[:-1]) + 1
+        for run in np.split(records, breaks):
+            z = int(run["n_z"][0])
+            if z != self._pending_z:
+                self.flush()
+                self._pending_z = z
+            self._pending_t = (self._pending_t[0] if self._pending else t_recv, t_recv)
+            self._pending.append(run)
+            self._pending_count += len(run)
+            if self._pending_count >= self.chunk_records:
+                self.flush()
+
+    # Write the buffered records as one chunk
+    def flush(self):
+        if self._pending_count:
+            data = b"".join(run.tobytes() for run in self._pending)
+            t_first, t_last = self._pending_t
+            self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, self._pending_count, self._pending_z, t_first, t_last) + data)
+            self.records_written += self._pending_count
+            self.bytes_written += CHUNK_HEADER.size + len(data)
+            self._pending = []
+            self._pending_count = 0
+        self._file.flush()
+
+    # flush() and make sure it reached the disk
+    def sync(self):
+        self.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+# ------------------------------- Background writer
+# Runs a ScanFileWriter on its own thread so the TCP receiver never waits on the disk.
+# write() hands record arrays over through a bounded queue; the writer thread drains everything
+# queued at once, lets ScanFileWriter turn it into large sequential chunk writes and fsyncs every
+# fsync_interval seconds. When the queue is full write() blocks rather than dropping scan data and
+# the stall is counted. Only record arrays count against max_queue: roll() and close() queue behind
+# them without ever waiting, so they can be called from the Tk thread.
+# A failed write (disk full, I/O error) loses that record array only and is counted in errors; a roll
+# that cannot open the new file keeps writing to the current one.
+# stats() reports queue depth, writer throughput and failures for the GUI.
+class BackgroundScanWriter:
+    def __init__(self, path, max_queue=WRITE_QUEUE_SIZE, fsync_interval=FSYNC_INTERVAL, **metadata):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.stalls = 0
+        self.errors = 0              # failed writes, rolls and syncs
+        self.bytes_per_s = 0.0
+        self.bytes_total = 0
+        self.max_queue = max_queue
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_queue)  # free places for record arrays
+        self._writer = ScanFileWriter(path, **metadata)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, records):
+        if not self.write_nowait(records):
+            self.write_wait(records)
+
+    # Like write() but never waits: returns False, and queues nothing, when the queue is full.
+    # The stall is counted here, follow up with write_wait() rather than write().
+    def write_nowait(self, records):
+        if not self._slots.acquire(blocking=False):
+            self.stalls += 1
+            return False
+        self._queue.put((time.time(), records))
+        return True
+
+    # Waits for room in the queue without counting a stall
+    def write_wait(self, records):
+        self._slots.acquire()
+        self._queue.put((time.time(), records))
+
+    # Finish the current file and continue in a new one
+    def roll(self, path, **metadata):
+        self._queue.put(("roll", path, metadata))
+
+    # Write out everything still queued and close the file
+    def close(self, timeout=10):
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_size": self.max_queue,
+            "bytes_per_s": self.bytes_per_s,
+            "bytes_total": self.bytes_total,
+            "stalls": self.stalls,
+            "errors": self.errors,
+        }
+
+    def _error(self, what, e):
+        self.errors += 1
+        print(f"[SCAN WRITER] Error {what}:", e)
+
+    def _run(self):
+        last_sync = last_rate = time.monotonic()
+        rate_bytes = 0
+        dirty = False
+        while True:
+            items = []
+            try:
+                items.append(self._queue.get(timeout=0.5))
+                # Drain whatever else is queued so it goes out in the same writes
+                while True:
+                    items.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            # Record arrays free their place in the queue once they are taken off it
+            for item in items:
+                if item is not None and item[0] != "roll":
+                    self._slots.release()
+            # Every item on its own: one failed write must not lose the ones queued behind it
+            for item in items:
+                if item is None:
+                    try:
+                        self._writer.close()
+                    except Exception as e:
+                        self._error(f"closing {self._writer.path}", e)
+                    return
+                if item[0] == "roll":
+                    _, path, metadata = item
+                    try:
+                        writer = ScanFileWriter(path, **metadata)
+                    except Exception as e:
+                        self._error(f"opening {path}, still writing to {self._writer.path}", e)
+                        continue
+                    try:
+                        self._writer.close()
+                    except Exception as e:
+                        self._error(f"closing {self._writer.path}", e)
+                    self._writer = writer
+                    self.path = path
+                    dirty = False
+                    continue
+                t_recv, records = item
+                try:
+                    self._writer.write(records, t_recv)
+                except Exception as e:
+                    self._error(f"writing {len(records)} records to {self._writer.path}", e)
+                    continue
+                rate_bytes += records.nbytes
+                dirty = True
+
+            now = time.monotonic()
+            if dirty and (not items or now - last_sync >= self.fsync_interval):
+                # Interval elapsed, or the stream went quiet: get the buffered chunk onto the disk
+                dirty = False
+                last_sync = now
+                try:
+                    self._writer.sync()
+                except Exception as e:
+                    self._error(f"syncing {self._writer.path}", e)
+            if now - last_rate >= 1.0:
+                self.bytes_per_s = rate_bytes / (now - last_rate)
+                self.bytes_total += rate_bytes
+                rate_bytes = 0
+                last_rate = now
+
+
+# ------------------------------- Reader
+# Opens a scan file through np.memmap: only the chunk headers are read up front, records are paged in
+# when they are used. A multi-GB scan opens immediately and a single z-layer can be pulled out
+# without touching the rest of the file. Record arrays can go straight into magdecode.parse_records.
+class ScanFile:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            prefix = f.read(SCAN_HEADER_SIZE)
+        if len(prefix) < SCAN_PREFIX.size:
+            raise ValueError(f"{path} is not a scan file")
+        magic, version, header_len = SCAN_PREFIX.unpack_from(prefix)
+        if magic != SCAN_MAGIC or not 1 <= version <= SCAN_VERSION:
+            raise ValueError(f"{path} is not a v{SCAN_VERSION} scan file")
+        self.version = version
+        chunk_header = CHUNK_HEADER if version >= 2 else CHUNK_HEADER_V1
+        self.record_dtype = TCP_RECORD_DTYPE if version == SCAN_VERSION else TCP_RECORD_DTYPE_V1
+        record_size = self.record_dtype.itemsize
+        self.metadata = json.loads(prefix[SCAN_PREFIX.size:SCAN_PREFIX.size + header_len])
+        self._raw = np.memmap(path, dtype=np.uint8, mode="r")
+
+        # Walk the chunk headers: (n_z, offset of the first record, record count)
+        # and the arrival time of the first and last record of every chunk
+        self.chunks = []
+        self.chunk_times = []
+        offset, size = SCAN_HEADER_SIZE, len(self._raw)
+        while offset + chunk_header.size <= size:
+            magic, count, n_z, *times = chunk_header.unpack(bytes(self._raw[offset:offset + chunk_header.size]))
+            if magic != CHUNK_MAGIC:
+                break
+            start = offset + chunk_header.size
+            # A chunk torn by a crash keeps its complete records
+            count = min(count, (size - start) // record_size)
+            if count:
+                self.chunks.append((n_z, start, count))
+                self.chunk_times.append(tuple(times) or None)
+            offset = start + count * record_size
+
+    def __len__(self):
+        return sum(count for _, _, count in self.chunks)
+
+    def chunk(self, i):
+        _, start, count = self.chunks[i]
+        return self._raw[start:start + count * self.record_dtype.itemsize].view(self.record_dtype)
+
+    # z positions (motor steps) present in the file, in scan order
+    def layers(self):
+        return list(dict.fromkeys(n_z for n_z, _, _ in self.chunks))
+
+    # A single chunk comes back as a view on the file, several are copied into one array.
+    # np.concatenate would promote the big-endian record fields to native order, so copy into a
+    # record_dtype array explicitly to keep the records byte for byte as received.
+    def _join(self, indices):
+        if len(indices) == 1:
+            return self.chunk(indices[0])
+        out = np.empty(sum(self.chunks[i][2] for i in indices), dtype=self.record_dtype)
+        pos = 0
+        for i in indices:
+            part = self.chunk(i)
+            out[pos:pos + len(part)] = part
+            pos += len(part)
+        return out
+
+    def layer(self, n_z):
+        return self._join([i for i, (z, _, _) in enumerate(self.chunks) if z == n_z])
+
+    def records(self):
+        return self._join(list(range(len(self.chunks))))
+
+    # Drops the mapping; arrays already handed out keep it alive until they are released
+    def close(self):
+        self._raw = None
+        self.chunks = []
+        self.chunk_times = []
+
+
+# ------------------------------- UDP capture
+# Optional recording of the live heatmap stream for replay: a 16 byte header (magic "MIRAUDP1",
+# version, reserved) then per datagram its arrival time (float64) and length (uint16) followed by the
+# datagram exactly as received (magwire format).
+UDP_CAPTURE_MAGIC = b"MIRAUDP1"
+UDP_CAPTURE_VERSION = 1
+UDP_CAPTURE_HEADER = struct.Struct(">8sH6x")
+UDP_CAPTURE_ENTRY = struct.Struct(">dH")
+
+
+# Appends datagrams through a large buffer so the UDP receiver only hits the disk every few seconds
+class UdpCaptureWriter:
+    def __init__(self, path, buffering=1 << 20):
+        self.path = path
+        self._file = open(path, "wb", buffering=buffering)
+        self._file.write(UDP_CAPTURE_HEADER.pack(UDP_CAPTURE_MAGIC, UDP_CAPTURE_VERSION))
+
+    def write(self, t_recv, data):
+        self._file.write(UDP_CAPTURE_ENTRY.pack(t_recv, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+
+# Yields (arrival time, datagram) from a UDP capture file, stopping at a torn last entry
+def read_udp_capture(path):
+    with open(path, "rb") as f:
+        magic, version = UDP_CAPTURE_HEADER.unpack(f.read(UDP_CAPTURE_HEADER.size))
+        if magic != UDP_CAPTURE_MAGIC or version != UDP_CAPTURE_VERSION:
+            raise ValueError(f"{path} is not a v{UDP_CAPTURE_VERSION} UDP capture")
+        while True:
+            entry = f.read(UDP_CAPTURE_ENTRY.size)
+            if len(entry) < UDP_CAPTURE_ENTRY.size:
+                return
+            t_recv, length = UDP_CAPTURE_ENTRY.unpack(entry)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield t_recv, data
@@ -0,0 +1,90 @@
+import time
+from collections import deque
+
+
+# ------------------------------- Frame budget of the Tk thread
+# All App views are updated from one Tk timer that fires every frame (UPDATE_INTERVAL). Each frame
+# the views run in priority order:
+#   - Essential views (the live heatmap) run every frame, whatever they cost.
+#   - The other views run when their interval is up and their measured cost still fits in what is
+#     left of the frame budget. A view that does not fit waits for a later frame, but never for
+#     longer than MAX_VIEW_WAIT.
+#   - A view's interval stretches to cost / BACKGROUND_SHARE. A view taking 40 ms then runs at
+#     most every 160 ms, so heavy views get at most that share of the Tk thread.
+FRAME_BUDGET = 0.025         # seconds of view updates per frame
+BACKGROUND_SHARE = 0.25      # most of the Tk thread a non-essential view may take on average
+MAX_VIEW_WAIT = 1.0          # seconds a due view may be held back for the budget
+COST_SMOOTHING = 0.2         # weight of the newest measurement in a view's cost
+FPS_WINDOW = 2.0             # seconds the per-view frame rate is measured over
+
+
+class View:
+    def __init__(self, name, update, interval, essential):
+        self.name = name
+        self.update = update         # returns True when it showed something new
+        self.interval = interval
+        self.essential = essential
+        self.cost = 0.0              # smoothed seconds per update
+        self.last_run = None
+        self.due_since = None        # when the view first had to wait for the budget
+        self.shown = deque()         # times of the updates that showed something, for fps
+        self.skipped = 0             # frames the view was due but held back
+
+
+class FrameScheduler:
+    def __init__(self, frame_interval, budget=FRAME_BUDGET, background_share=BACKGROUND_SHARE,
+                 max_wait=MAX_VIEW_WAIT, clock=time.perf_counter):
+        self.frame_interval = frame_interval
+        self.budget = budget
+        self.background_share = background_share
+        self.max_wait = max_wait
+        self.clock = clock
+        self.views = []
+
+    # Views run in the order they are added, so add them by priority
+    def add(self, name, update, interval, essential=False):
+        self.views.append(View(name, update, interval, essential))
+
+    def _due(self, view, now):
+        if view.last_run is None or view.essential:
+            return True
+        interval = max(view.interval, view.cost / self.background_share)
+        # Half a frame early rather than a whole frame late, frames only come every frame_interval
+        return now - view.last_run >= interval - self.frame_interval / 2
+
+    # One frame. Returns the delay in ms until the next one, counted from the start of this one so
+    # the frame rate does not drop by the time the views took.
+    def tick(self):
+        start = self.clock()
+        for view in self.views:
+            now = self.clock()
+            if not self._due(view, now):
+                continue
+            if not view.essential and (now - start) + view.cost > self.budget:
+                if view.due_since is None:
+                    view.due_since = now
+                if now - view.due_since < self.max_wait:
+                    view.skipped += 1
+                    continue
+            try:
+                shown = view.update()
+            except Exception as e:
+                print(f"[SCHEDULER] {view.name} update failed: {e}")
+                shown = False
+            done = self.clock()
+            view.cost += COST_SMOOTHING * ((done - now) - view.cost) if view.last_run is not None else done - now
+            view.last_run, view.due_since = now, None
+            if shown:
+                view.shown.append(done)
+        elapsed = self.clock() - start
+        return max(1, round((self.frame_interval - elapsed) * 1e3))
+
+    # {view name: (frames per second over the last FPS_WINDOW, smoothed cost in seconds)}
+    def stats(self):
+        now = self.clock()
+        stats = {}
+        for view in self.views:
+            while view.shown and now - view.shown[0] > FPS_WINDOW:
+                view.shown.popleft()
+            stats[view.name] = (len(view.shown) / FPS_WINDOW, view.cost)
+        return stats
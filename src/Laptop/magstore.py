@@ -0,0 +1,83 @@
+import threading
+import numpy as np
+
+
+# ------------------------------- Columnar sample store
+# One row per sensor sample. Positions and fields are float32, the pixel id int16.
+# pose (n_theta, n_r, n_z motor steps) and counter are int32: the counter and
+# absolute moves can run past what int16 holds.
+SAMPLE_COLUMNS = {
+    "x": (np.float32, ()),
+    "y": (np.float32, ()),
+    "z": (np.float32, ()),
+    "Bx": (np.float32, ()),
+    "By": (np.float32, ()),
+    "Bz": (np.float32, ()),
+    "pixel": (np.int16, ()),
+    "pose": (np.int32, (3,)),
+    "counter": (np.int32, ()),
+}
+
+
+# Preallocated column arrays that grow by doubling. append() is called from the TCP receiver
+# thread, snapshot() from the GUI. Rows below the current length are never written again and a
+# grow or clear swaps in new arrays, so the views handed out by snapshot() stay consistent
+# without copying while the writer keeps appending.
+# generation counts the changes (appends and clears). A reader that notes it before taking a
+# snapshot can tell from an unchanged generation that there is nothing new to draw. clears counts
+# only the clears, for readers that keep their own running totals of the rows seen so far.
+class SampleStore:
+    def __init__(self, capacity=1 << 16):
+        self._lock = threading.Lock()
+        self._initial_capacity = capacity
+        self._columns = self._allocate(capacity)
+        self._length = 0
+        self.generation = 0
+        self.clears = 0
+
+    @staticmethod
+    def _allocate(capacity):
+        return {name: np.empty((capacity,) + shape, dtype=dtype) for name, (dtype, shape) in SAMPLE_COLUMNS.items()}
+
+    def __len__(self):
+        return self._length
+
+    # Append n samples. Every argument is an array of length n (pose is (n, 3)).
+    def append(self, x, y, z, Bx, By, Bz, pixel, pose, counter):
+        values = {"x": x, "y": y, "z": z, "Bx": Bx, "By": By, "Bz": Bz,
+                  "pixel": pixel, "pose": pose, "counter": counter}
+        n = len(x)
+        if n == 0:
+            return
+        with self._lock:
+            start, end = self._length, self._length + n
+            capacity = len(self._columns["x"])
+            if end > capacity:
+                while capacity < end:
+                    capacity *= 2
+                grown = self._allocate(capacity)
+                for name, column in self._columns.items():
+                    grown[name][:start] = column[:start]
+                self._columns = grown
+            for name, column in self._columns.items():
+                column[start:end] = values[name]
+            self._length = end
+            self.generation += 1
+
+    # Read-only views of rows [start, len) of every column, taken at one consistent length.
+    def snapshot(self, start=0):
+        with self._lock:
+            columns, length = self._columns, self._length
+        views = {}
+        for name, column in columns.items():
+            view = column[start:length]
+            view.flags.writeable = False
+            views[name] = view
+        return views
+
+    def clear(self):
+        with self._lock:
+            self._columns = self._allocate(self._initial_capacity)
+            self._length = 0
+            self.generation += 1
+            self.clears += 1
@@ -0,0 +1,152 @@
+import csv
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from magdecode import decode_words
+
+
+# ------------------------------- Health of the live UDP stream
+# Every heatmap datagram carries its sequence number, the Pi's frame counter (frame_id) and read
+# time of its first frame (see magwire.py). Every frame carries the FPGA's 8-bit timestamp, which
+# goes up by one per measurement cycle (tmag_scheduling_core.vhdl). Comparing a datagram with the
+# one before it tells where frames went missing:
+#   network   sequence numbers skipped: datagrams sent by the Pi and never received
+#   pi        frames the Pi read but did not send (superseded in its LifoQueue)
+#   fpga      timestamps skipped beyond the Pi's frame counter: frames the FPGA measured that the
+#             Pi never read off SPI (FIFO overflow or a slow reader)
+# and the frame rate of each stage shows which one holds the stream below the FPGA rate.
+# Only the newest HEALTH_WINDOW seconds are counted, except for the out-of-order total.
+# When the Pi script restarts its sequence numbers start again from 0. A datagram numbered below the
+# newest one but sent after it, or more than RESTART_SEQ_GAP below it, starts the figures over
+# instead of counting as out of order, like a new stream id does for the scan stream (magresume.py).
+HEALTH_WINDOW = 5.0          # seconds of datagrams the rolling figures are taken over
+RESTART_SEQ_GAP = 1000       # datagrams back no reordering reaches
+JITTER_GAIN = 1 / 16         # RFC 3550 interarrival jitter smoothing
+
+
+# FPGA timestamp of a frame: the most common one among its words. Zero padding words are skipped.
+def frame_timestamp(frame):
+    _, _, _, _, timestamps = decode_words(frame)
+    timestamps = timestamps[np.asarray(frame) != 0]
+    if len(timestamps) == 0:
+        return None
+    return int(np.bincount(timestamps).argmax())
+
+
+class StreamHealth:
+    def __init__(self, window=HEALTH_WINDOW, clock=time.monotonic):
+        self._lock = threading.Lock()
+        self._window = window
+        self._clock = clock
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        # One row per received datagram: (arrival, frames in it, datagrams lost before it, Pi
+        # frames, FPGA frames and Pi frames not sent since the previous one, t_read). Late
+        # datagrams have t_read None and only correct the loss.
+        self._rows = deque()
+        self._last = None        # (seq, frame_id, fpga timestamp, t_read, t_recv, frames, t_sent) of the newest in-order datagram
+        self.out_of_order = 0
+        self.jitter = 0.0
+
+    # Called by the UDP receiver for every datagram, frames as from unpack_udp_datagram
+    def received(self, header, frames, t_recv):
+        now = self._clock()
+        timestamp = frame_timestamp(frames[0])
+        with self._lock:
+            last = self._last
+            if last is not None and header.seq < last[0] and (header.t_sent > last[6] or last[0] - header.seq > RESTART_SEQ_GAP):
+                # The Pi script restarted
+                self._reset()
+                last = None
+            if last is not None and header.seq <= last[0]:
+                # Late or duplicate. A late one was counted lost when the gap opened, take that back.
+                self.out_of_order += 1
+                self._rows.append((now, len(frames), -1 if header.seq < last[0] else 0, 0, 0, 0, None))
+                self._expire(now)
+                return
+            lost = pi_frames = fpga_frames = skipped = 0
+            if last is not None:
+                seq, frame_id, last_timestamp, t_read, t_arrived, n_frames, _ = last
+                lost = header.seq - seq - 1
+                pi_frames = (header.frame_id - frame_id) & 0xFFFFFFFF
+                # Lost datagrams are taken to have held as many frames as the one before them
+                skipped = max(0, pi_frames - n_frames * (lost + 1))
+                if timestamp is not None and last_timestamp is not None:
+                    fpga_frames = (timestamp - last_timestamp) % 256
+                    # The 8-bit timestamp wraps every 256 frames, count at least what the Pi counted
+                    if pi_frames > fpga_frames:
+                        fpga_frames += (pi_frames - fpga_frames + 255) // 256 * 256
+                # RFC 3550: difference of the arrival spacing and the read spacing on the Pi
+                spacing = (t_recv - t_arrived) - (header.t_read - t_read)
+                self.jitter += JITTER_GAIN * (abs(spacing) - self.jitter)
+            self._rows.append((now, len(frames), lost, pi_frames, fpga_frames, skipped, header.t_read))
+            self._last = (header.seq, header.frame_id, timestamp, header.t_read, t_recv, len(frames), header.t_sent)
+            self._expire(now)
+
+    def _expire(self, now):
+        while self._rows and now - self._rows[0][0] > self._window:
+            self._rows.popleft()
+
+    # Rolling figures over the window:
+    #   loss %          datagrams lost on the network, of those sent
+    #   out of order    datagrams that arrived after a later one, since the start
+    #   jitter          interarrival jitter in seconds
+    #   fps             frames per second measured by the FPGA, read by the Pi and received here
+    #   fpga gaps       frames the FPGA measured that the Pi never read
+    #   pi skipped      frames the Pi read but never sent
+    def stats(self):
+        with self._lock:
+            self._expire(self._clock())
+            rows = list(self._rows)
+            out_of_order, jitter = self.out_of_order, self.jitter
+        received = len(rows)
+        lost = max(0, sum(row[2] for row in rows))
+        # Rates from the spacing of the in-order datagrams, each counted from the one before it
+        in_order = [row for row in rows if row[6] is not None]
+        read_span = in_order[-1][6] - in_order[0][6] if len(in_order) > 1 else 0.0
+        arrival_span = in_order[-1][0] - in_order[0][0] if len(in_order) > 1 else 0.0
+        pi_frames = sum(row[3] for row in in_order[1:])
+        fpga_frames = sum(row[4] for row in in_order[1:])
+        return {
+            "loss %": 100 * lost / (lost + received) if received else 0.0,
+            "out of order": out_of_order,
+            "jitter": jitter,
+            "fpga fps": fpga_frames / read_span if read_span > 0 else 0.0,
+            "pi fps": pi_frames / read_span if read_span > 0 else 0.0,
+            "received fps": sum(row[1] for row in in_order[1:]) / arrival_span if arrival_span > 0 else 0.0,
+            "fpga gaps": sum(max(0, row[4] - row[3]) for row in in_order),
+            "pi skipped": sum(row[5] for row in in_order),
+        }
+
+    def summary(self):
+        s = self.stats()
+        return (f"Stream: loss {s['loss %']:.1f}%, out of order {s['out of order']}, jitter {s['jitter'] * 1e3:.2f} ms"
+                f" | fps FPGA {s['fpga fps']:.1f}, Pi {s['pi fps']:.1f}, received {s['received fps']:.1f}"
+                f" | FPGA gaps {s['fpga gaps']}, Pi skipped {s['pi skipped']}")
+
+
+# Stream metrics as CSV, one row per write() with the wall clock time first, for plotting a
+# session afterwards. Rows are flushed as they are written.
+class MetricsLog:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "w", newline="")
+        self._writer = None
+
+    def write(self, stats):
+        if self._writer is None:
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(["time"] + list(stats))
+        self._writer.writerow([f"{time.time():.3f}"] + [f"{value:.6g}" for value in stats.values()])
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
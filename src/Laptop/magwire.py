@@ -0,0 +1,222 @@
+import json
+import struct
+import time
+from collections import namedtuple
+import numpy as np
+
+from magdecode import WORDS_PER_FRAME
+
+
+# ------------------------------- UDP live heatmap datagram
+# Keep in sync with the copy in src/Raspberry_Pi_5/magpi1.py.
+# Header (big-endian, 40 bytes): magic "MU", version, n_frames, sequence number (uint32),
+# frame id of the first frame (uint32, counts every frame read on the Pi), then the Pi times
+# (float64, time.time()) at which the first frame was read, put on the UDP queue and sent.
+# Body: n_frames * 64 big-endian uint64 packets. Frames shorter than 64 packets are padded with
+# zero words; a valid FPGA packet always has its header bit set, so a zero word is never real data.
+# Version 1 datagrams (16 byte header with only the read time) are still accepted, for old captures.
+UDP_MAGIC = b"MU"
+UDP_VERSION = 2
+UDP_HEADER = struct.Struct(">2sBBIIddd")
+UDP_HEADER_V1 = struct.Struct(">2sBBId")
+UDP_MAX_FRAMES = 16          # 16 * 512 B + header stays under a 9 KB datagram
+_FRAME_BYTES = WORDS_PER_FRAME * 8
+
+UdpHeader = namedtuple("UdpHeader", "seq frame_id t_read t_queued t_sent")
+
+
+# t_read is the Pi time the first frame was read. t_queued defaults to t_read and t_sent to now.
+def pack_udp_datagram(seq, t_read, frames, frame_id=0, t_queued=None, t_sent=None):
+    n_frames = len(frames)
+    if not 0 < n_frames <= UDP_MAX_FRAMES:
+        raise ValueError(f"cannot pack {n_frames} frames into one datagram")
+    words = []
+    for frame in frames:
+        words.extend(frame)
+        words.extend([0] * (WORDS_PER_FRAME - len(frame)))
+    if t_queued is None:
+        t_queued = t_read
+    if t_sent is None:
+        t_sent = time.time()
+    header = UDP_HEADER.pack(UDP_MAGIC, UDP_VERSION, n_frames, seq & 0xFFFFFFFF, frame_id & 0xFFFFFFFF,
+                             t_read, t_queued, t_sent)
+    return header + struct.pack(f">{len(words)}Q", *words)
+
+
+# Returns (header, frames): a UdpHeader and an (n_frames, 64) uint64 view on the datagram.
+def unpack_udp_datagram(data):
+    if len(data) < UDP_HEADER_V1.size:
+        raise ValueError(f"datagram too short ({len(data)} bytes)")
+    magic, version, n_frames = struct.unpack_from(">2sBB", data)
+    if magic != UDP_MAGIC or version not in (1, UDP_VERSION):
+        raise ValueError(f"unknown datagram {magic!r} v{version}")
+    if version == 1:
+        _, _, _, seq, t_read = UDP_HEADER_V1.unpack_from(data)
+        header, size = UdpHeader(seq, seq, t_read, t_read, t_read), UDP_HEADER_V1.size
+    else:
+        header, size = UdpHeader(*UDP_HEADER.unpack_from(data)[3:]), UDP_HEADER.size
+    if len(data) != size + n_frames * _FRAME_BYTES:
+        raise ValueError(f"datagram length {len(data)} does not match {n_frames} frames")
+    frames = np.frombuffer(data, dtype=">u8", count=n_frames * WORDS_PER_FRAME, offset=size)
+    return header, frames.reshape(n_frames, WORDS_PER_FRAME)
+
+
+# ------------------------------- TCP scan record stream
+# Keep in sync with the copy in src/Raspberry_Pi_5/magpi1.py.
+# Every record is a fixed 536 bytes so a socket buffer can be viewed as an array of records:
+# Header (big-endian, 24 bytes): magic "MT", version, number of valid packets (<= 64),
+# n_theta, n_r, n_z (int32 motor steps), the acquisition counter (uint32) and the record's
+# sequence number in the Pi's scan stream (uint32, see "Scan stream resume" below).
+# Body: 64 big-endian uint64 packets, zero padded after the valid ones.
+# Version 1 records (532 bytes, no sequence number) are only found in older scan files.
+TCP_MAGIC = b"MT"
+TCP_VERSION = 2
+TCP_RECORD_HEADER = struct.Struct(">2sBBiiiII")
+TCP_RECORD_DTYPE_V1 = np.dtype([
+    ("magic", "S2"),
+    ("version", "u1"),
+    ("n_words", "u1"),
+    ("n_theta", ">i4"),
+    ("n_r", ">i4"),
+    ("n_z", ">i4"),
+    ("counter", ">u4"),
+    ("words", ">u8", (WORDS_PER_FRAME,)),
+])
+TCP_RECORD_DTYPE = np.dtype([
+    ("magic", "S2"),
+    ("version", "u1"),
+    ("n_words", "u1"),
+    ("n_theta", ">i4"),
+    ("n_r", ">i4"),
+    ("n_z", ">i4"),
+    ("counter", ">u4"),
+    ("seq", ">u4"),
+    ("words", ">u8", (WORDS_PER_FRAME,)),
+])
+TCP_RECORD_SIZE = TCP_RECORD_DTYPE.itemsize
+
+
+def pack_scan_record(location, frame, seq=0):
+    n_theta, n_r, n_z, counter = location
+    header = TCP_RECORD_HEADER.pack(TCP_MAGIC, TCP_VERSION, len(frame), n_theta, n_r, n_z, counter & 0xFFFFFFFF,
+                                    seq & 0xFFFFFFFF)
+    padding = [0] * (WORDS_PER_FRAME - len(frame))
+    return header + struct.pack(f">{WORDS_PER_FRAME}Q", *frame, *padding)
+
+
+# Turns the raw TCP byte stream back into records. feed() takes whatever recv() returned and hands
+# back every complete record in it as a TCP_RECORD_DTYPE array; a partial record is kept for the next call.
+class ScanRecordReader:
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, data):
+        buf = self._pending + data if self._pending else data
+        n = len(buf) // TCP_RECORD_SIZE
+        self._pending = bytes(buf[n * TCP_RECORD_SIZE:])
+        records = np.frombuffer(buf, dtype=TCP_RECORD_DTYPE, count=n)
+        if n and (np.any(records["magic"] != TCP_MAGIC) or np.any(records["version"] != TCP_VERSION)):
+            raise ValueError("corrupt scan record stream")
+        return records
+
+
+# Yields ((n_theta, n_r, n_z, counter), words) for every record that carries data.
+def iter_scan_records(records):
+    locations = zip(records["n_theta"].tolist(), records["n_r"].tolist(),
+                    records["n_z"].tolist(), records["counter"].tolist())
+    for location, n_words, words in zip(locations, records["n_words"].tolist(), records["words"]):
+        if n_words:
+            yield location, words[:n_words]
+
+
+# ------------------------------- Scan stream resume
+# Keep in sync with the copy in src/Raspberry_Pi_5/magpi1.py.
+# The Pi numbers its scan records and keeps the ones the laptop has not acknowledged yet, so a
+# dropped connection resumes where it left off instead of losing what was in flight (magresume.py).
+# Every connection on the scan port starts with a hello from the Pi (big-endian, 12 bytes): magic
+# "MH", version, pad, the stream id (uint32, random per run of the Pi script) and the sequence number
+# of the first record that follows (uint32). Records follow with consecutive sequence numbers.
+# The laptop answers on the same connection with acks (8 bytes): magic "MK", version, pad and the
+# sequence number of the next record it expects, i.e. everything before it has been received.
+SCAN_HELLO_MAGIC = b"MH"
+SCAN_ACK_MAGIC = b"MK"
+SCAN_RESUME_VERSION = 1
+SCAN_HELLO = struct.Struct(">2sBxII")
+SCAN_ACK = struct.Struct(">2sBxI")
+
+
+def pack_scan_hello(stream_id, first_seq):
+    return SCAN_HELLO.pack(SCAN_HELLO_MAGIC, SCAN_RESUME_VERSION, stream_id & 0xFFFFFFFF, first_seq & 0xFFFFFFFF)
+
+
+# Returns (stream_id, first_seq)
+def unpack_scan_hello(data):
+    magic, version, stream_id, first_seq = SCAN_HELLO.unpack(data)
+    if magic != SCAN_HELLO_MAGIC or version != SCAN_RESUME_VERSION:
+        raise ValueError(f"unknown scan stream hello {magic!r} v{version}")
+    return stream_id, first_seq
+
+
+def pack_scan_ack(next_seq):
+    return SCAN_ACK.pack(SCAN_ACK_MAGIC, SCAN_RESUME_VERSION, next_seq & 0xFFFFFFFF)
+
+
+# Turns the ack byte stream back into sequence numbers, like ScanRecordReader. feed() returns the
+# latest ack in data, or None when it did not complete one; earlier acks are covered by the latest.
+class ScanAckReader:
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, data):
+        buf = self._pending + data
+        n = len(buf) // SCAN_ACK.size
+        self._pending = buf[n * SCAN_ACK.size:]
+        if n == 0:
+            return None
+        magic, version, next_seq = SCAN_ACK.unpack_from(buf, (n - 1) * SCAN_ACK.size)
+        if magic != SCAN_ACK_MAGIC or version != SCAN_RESUME_VERSION:
+            raise ValueError("corrupt scan ack stream")
+        return next_seq
+
+
+# ------------------------------- Command channel
+# Keep in sync with the copy in src/Raspberry_Pi_5/magpi1.py.
+# One long-lived TCP connection from the laptop to the Pi's command port carries every command.
+# Message: header (big-endian, 7 bytes) magic "MC", version, body length (uint32), then the body,
+# a UTF-8 JSON object:
+#   request  {"id": 7, "cmd": "move", "r": 100, "theta": 0, "z": 0}   id chosen by the laptop
+#   reply    {"id": 7, "ok": true, "status": "Reached r=100, theta=0, z=0"}   or "ok": false, "error": ...
+#   event    {"event": "progress", ...}   pushed by the Pi at any time, no id
+# Replies may come back in any order, a slow motor move does not hold up a stop behind it.
+CMD_MAGIC = b"MC"
+CMD_VERSION = 1
+CMD_HEADER = struct.Struct(">2sBI")
+CMD_MAX_BODY = 65536
+
+
+def pack_command_message(message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return CMD_HEADER.pack(CMD_MAGIC, CMD_VERSION, len(body)) + body
+
+
+# Turns the command byte stream back into messages, like ScanRecordReader. feed() takes whatever
+# recv() returned and hands back every complete message in it as a dict.
+class CommandReader:
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, data):
+        buf = self._pending + data
+        messages = []
+        start = 0
+        while len(buf) - start >= CMD_HEADER.size:
+            magic, version, length = CMD_HEADER.unpack_from(buf, start)
+            if magic != CMD_MAGIC or version != CMD_VERSION or length > CMD_MAX_BODY:
+                raise ValueError("corrupt command stream")
+            end = start + CMD_HEADER.size + length
+            if end > len(buf):
+                break
+            messages.append(json.loads(buf[start + CMD_HEADER.size:end]))
+            start = end
+        self._pending = buf[start:]
+        return messages
@@ -1,12 +1,14 @@
 import socket
 import threading
-import json
 import time
 import sys
 import math
-import random
 import queue
 
+from magwire import pack_udp_datagram
+from magcommand import CommandServer
+from magresume import ScanSpool, read_acks, ACK_TIMEOUT
+
 # Dummy GPIO definitions for simulation
 class GPIO:
     BCM = OUT = HIGH = 1
@@ -28,15 +30,19 @@ DATA_FILE = "data.txt"
 tcp_message_queue = queue.Queue()
 udp_message_queue = queue.Queue()
 tcp_send_queue = queue.Queue()
+scan_spool = ScanSpool()  # records sent but not acked by the laptop, resent after a reconnect
 
 acquisition_enabled = False
 running = True
 motor_stable_event = threading.Event()
+command_server = None  # CommandServer, replies and events to the laptop
+PROGRESS_INTERVAL = 1.0  # seconds between progress events during acquisition
 
 n_theta = 0
 n_r = 2800 * 7
 n_z = 0
 counter = 0
+frames_read = 0
 
 # GPIO Pin Definitions
 THETA_DIR = 24 
@@ -116,9 +122,14 @@ def reset_r_z():
 
 #---------------------- SPI -----------------------------------
 
+# The FPGA timestamp counts measurement cycles, one per frame, and wraps at 8 bits
+simulated_timestamp = 0
+
 def simulate_spi():
+    global simulated_timestamp
     frames = []
-    timestamp = int(time.time() * 1000) & 0xFF
+    timestamp = simulated_timestamp
+    simulated_timestamp = (simulated_timestamp + 1) & 0xFF
     t = time.time()
     for pix_id in range(64):
         angle = (t * 10 + pix_id) % (2 * math.pi)
@@ -150,13 +161,15 @@ def read_frame(n=64):
     return frames
 
 def continuous_frame_reader():
-    global running
+    global running, frames_read
     while running:
         if acquisition_enabled:
             frames = simulate_spi()
+            t_read = time.time()
             if frames:
-                udp_message_queue.put(frames)
+                udp_message_queue.put((frames_read, t_read, time.time(), frames))
                 tcp_message_queue.put(frames)
+                frames_read += 1
             time.sleep(0.01)
         else:
             time.sleep(0.1)
@@ -177,27 +190,34 @@ def frame_writer():
 
 def udp_sender(ip, port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    seq = 0
     while running:
         try:
-            frames = udp_message_queue.get(timeout=1)
-            sock.sendto(json.dumps(frames).encode(), (ip, port))
+            frame_id, t_read, t_queued, frames = udp_message_queue.get(timeout=1)
+            sock.sendto(pack_udp_datagram(seq, t_read, [frames], frame_id, t_queued), (ip, port))
+            seq += 1
         except queue.Empty:
             pass
 
+# Every connection starts where the laptop's last ack left off (see magresume.py)
 def tcp_sender(ip, port):
     while running:
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # A send blocked on a dead connection gives up instead of hanging
+            sock.settimeout(ACK_TIMEOUT)
             sock.connect((ip, port))
+            sock.sendall(scan_spool.resume())
+            threading.Thread(target=read_acks, args=(sock, scan_spool), daemon=True).start()
             while running:
                 try:
-                    block = tcp_send_queue.get(timeout=2)
-                    # Convert block to JSON, append a newline delimiter, and send it.
-                    msg = json.dumps(block).encode() + b"\n"
-                    sock.sendall(msg)
+                    location, frame = tcp_send_queue.get(timeout=2)
+                    sock.sendall(scan_spool.add(location, frame))
                     #print("[TCP SENDER]: Sent")
                 except queue.Empty:
-                    continue
+                    pass
+                if scan_spool.stalled(ACK_TIMEOUT):
+                    raise ConnectionError(f"no ack for {ACK_TIMEOUT:g} s")
         except Exception as e:
             print("[TCP SENDER] Connection error:", e)
             time.sleep(2)
@@ -209,37 +229,39 @@ def tcp_sender(ip, port):
 
 def acquisition_thread():
     global counter
+    last_progress = 0.0
     while running:
         if acquisition_enabled:
             sweep()
             counter += 1
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                command_server.push_event("progress", counter=counter, theta=n_theta, r=n_r, z=n_z)
+                last_progress = time.monotonic()
             time.sleep(0.01)
         else:
             time.sleep(0.1)
 
-def command_listener(port):
-    global acquisition_enabled, running
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(("0.0.0.0", port))
-    server.listen(1)
-    print(f"[CMD LISTENER] Listening on port {port}")
-    while running:
-        conn, addr = server.accept()
-        with conn:
-            cmd = conn.recv(1024).decode().strip()
-            print(f"[CMD RECEIVED] {cmd}")
-            if cmd == "start":
-                acquisition_enabled = True
-                conn.send(b"started\n")
-            elif cmd == "stop":
-                acquisition_enabled = False
-                tcp_message_queue.queue.clear()
-                udp_message_queue.queue.clear()
-                tcp_send_queue.queue.clear()
-                conn.send(b"stopped\n")
-            else:
-                conn.send(b"unknown\n")
+# Commands from the laptop over the persistent command connection (see magcommand.py)
+def handle_command(message, t_recv):
+    global acquisition_enabled
+    cmd = message.get("cmd")
+    if cmd == "clock":
+        # Clock offset probe, see maglatency.py
+        return {"t_recv": t_recv, "t_sent": time.time()}
+    print(f"[CMD RECEIVED] {cmd}")
+    if cmd == "start":
+        acquisition_enabled = True
+        return {"status": "Acquisition started"}
+    elif cmd == "pause":
+        acquisition_enabled = False
+        return {"status": "Acquisition paused"}
+    elif cmd == "stop":
+        acquisition_enabled = False
+        tcp_message_queue.queue.clear()
+        udp_message_queue.queue.clear()
+        tcp_send_queue.queue.clear()
+        return {"status": "Acquisition stopped"}
+    return {"error": f"unknown command {cmd!r}"}
 
 if __name__ == "__main__":
     ip = sys.argv[1]
@@ -254,7 +276,8 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"[INIT] Error creating {DATA_FILE}: {e}")
 
-    threading.Thread(target=command_listener, args=(cmd_port,), daemon=True).start()
+    command_server = CommandServer(cmd_port, handle_command)
+    command_server.start()
     threading.Thread(target=continuous_frame_reader, daemon=True).start()
     threading.Thread(target=frame_writer, daemon=True).start()
     threading.Thread(target=tcp_sender, args=(ip, tcp_port), daemon=True).start()
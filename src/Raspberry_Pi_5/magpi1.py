@@ -1,4 +1,5 @@
 import socket
+import struct
 import threading
 import json
 import time
@@ -24,6 +25,7 @@ n_theta = 0              # Theta motor step counter
 n_r = 0                  # r motor current position (cumulative)
 n_z = 0                  # Total number of steps moved in z direction
 counter = 0              # Acquisition cycle counter
+frames_read = 0          # Frames read from the FPGA, tags every frame for latency tracing
 
 # Motor sweep parameters
 r_count = 0
@@ -40,6 +42,8 @@ full_revolution_z = 22400
 acquisition_enabled = False
 running = True
 motor_stable_event = threading.Event()
+motion_queue = queue.Queue()  # move, jog and reset commands, run by motion_worker
+PROGRESS_INTERVAL = 1.0  # seconds between progress events to the laptop during acquisition
 
 DATA_FILE = "data.txt"
 
@@ -98,9 +102,14 @@ spi.mode = SPI_MODE
 
 #---------------------- SPI -----------------------------------
 # Define a simulation of SPI for debugging
+# The FPGA timestamp counts measurement cycles, one per frame, and wraps at 8 bits
+simulated_timestamp = 0
+
 def simulate_spi():
+    global simulated_timestamp
     frames = []
-    timestamp = int(time.time() * 1000) & 0xFF
+    timestamp = simulated_timestamp
+    simulated_timestamp = (simulated_timestamp + 1) & 0xFF
     t = time.time()
     for pix_id in range(64):
         angle = (t * 10 + pix_id) % (2 * math.pi)
@@ -224,6 +233,7 @@ def sweep():
                 if n_z + (z_jump - z_jump_half) > full_revolution_z:
                     acquisition_enabled = False
                     reset_r_z()
+                    push_event("state", acquisition=False, status="Sweep completed")
                     return
                 else:
                 # Increment z once r is done
@@ -247,6 +257,7 @@ def sweep():
                 if n_z + z_jump_half > full_revolution_z:
                     acquisition_enabled = False
                     reset_r_z()
+                    push_event("state", acquisition=False, status="Sweep completed")
                     return
                 else:
                 # Increment z once r is done
@@ -302,18 +313,145 @@ def go_to_r_theta_z(target_r, target_theta, target_z):
     print(f"[GO TO] Reached r={n_r}, θ={n_theta}, z={n_z}")
 
 # ---------- COMMUNICATION -----------------------
+# UDP live heatmap datagram, keep in sync with src/Laptop/magwire.py
+# Header (big-endian, 40 bytes): magic "MU", version, n_frames, sequence number, frame id of the first frame,
+# then the times the first frame was read, put on the UDP queue and sent (for latency tracing on the laptop)
+# Body: n_frames * 64 big-endian uint64 packets, short frames padded with zero words
+WORDS_PER_FRAME = 64
+UDP_MAGIC = b"MU"
+UDP_VERSION = 2
+UDP_HEADER = struct.Struct(">2sBBIIddd")
+UDP_FRAMES_PER_DATAGRAM = 1  # >1 batches queued frames into one datagram (less overhead, more latency)
+
+# TCP scan record, keep in sync with src/Laptop/magwire.py
+# Fixed 536 bytes: magic "MT", version, number of valid packets, n_theta, n_r, n_z, counter, sequence number,
+# 64 packets (zero padded)
+TCP_MAGIC = b"MT"
+TCP_VERSION = 2
+TCP_RECORD_HEADER = struct.Struct(">2sBBiiiII")
+TCP_BATCH = 64  # max records coalesced into one sendall
+
+# Scan stream resume, keep in sync with src/Laptop/magwire.py and magresume.py
+# Every scan connection starts with a hello: magic "MH", version, pad, stream id, sequence number of the first
+# record that follows. The laptop acks on the same connection: magic "MK", version, pad, next sequence number
+# it expects. Records stay in scan_spool until acked and are resent from there after a reconnect.
+SCAN_HELLO_MAGIC = b"MH"
+SCAN_ACK_MAGIC = b"MK"
+SCAN_RESUME_VERSION = 1
+SCAN_HELLO = struct.Struct(">2sBxII")
+SCAN_ACK = struct.Struct(">2sBxI")
+SPOOL_RECORDS = 32768  # unacknowledged records kept for a resend (~17 MB), the oldest go first when full
+ACK_TIMEOUT = 10.0  # seconds without an ack, with records waiting, before reconnecting
+
+# Command channel, keep in sync with src/Laptop/magwire.py
+# One long-lived connection from the laptop. Message: magic "MC", version, body length (uint32), then a
+# UTF-8 JSON body: a request {"id", "cmd", ...args}, a reply {"id", "ok", ...} or an event {"event", ...}
+CMD_MAGIC = b"MC"
+CMD_VERSION = 1
+CMD_HEADER = struct.Struct(">2sBI")
+CMD_MAX_BODY = 65536
+
+def pack_udp_datagram(seq, t_read, frames, frame_id, t_queued, t_sent):
+    words = []
+    for frame in frames:
+        words.extend(frame)
+        words.extend([0] * (WORDS_PER_FRAME - len(frame)))
+    header = UDP_HEADER.pack(UDP_MAGIC, UDP_VERSION, len(frames), seq & 0xFFFFFFFF, frame_id & 0xFFFFFFFF,
+                             t_read, t_queued, t_sent)
+    return header + struct.pack(f">{len(words)}Q", *words)
+
+def pack_scan_record(location, frame, seq):
+    n_theta, n_r, n_z, counter = location
+    header = TCP_RECORD_HEADER.pack(TCP_MAGIC, TCP_VERSION, len(frame), n_theta, n_r, n_z, counter & 0xFFFFFFFF,
+                                    seq & 0xFFFFFFFF)
+    padding = [0] * (WORDS_PER_FRAME - len(frame))
+    return header + struct.pack(f">{WORDS_PER_FRAME}Q", *frame, *padding)
+
+# Records sent to the laptop and not acked yet, resent after a reconnect (ScanSpool in src/Laptop/magresume.py)
+class ScanSpool:
+    def __init__(self, max_records=SPOOL_RECORDS):
+        self.max_records = max_records
+        self.stream_id = random.getrandbits(32)
+        self.next_seq = 0
+        self.dropped = 0
+        self._records = deque()  # (seq, packed record)
+        self._lock = threading.Lock()
+        self._waiting_since = time.monotonic()
+
+    # Numbers and spools a record and returns it packed, ready to send
+    def add(self, location, frame):
+        record = pack_scan_record(location, frame, self.next_seq)
+        with self._lock:
+            if not self._records:
+                self._waiting_since = time.monotonic()
+            self._records.append((self.next_seq, record))
+            if len(self._records) > self.max_records:
+                self._records.popleft()
+                self.dropped += 1
+        self.next_seq += 1
+        return record
+
+    # The hello and every unacknowledged record, to send first on a new connection
+    def resume(self):
+        with self._lock:
+            first_seq = self._records[0][0] if self._records else self.next_seq
+            self._waiting_since = time.monotonic()
+            hello = SCAN_HELLO.pack(SCAN_HELLO_MAGIC, SCAN_RESUME_VERSION, self.stream_id, first_seq & 0xFFFFFFFF)
+            return b"".join([hello] + [record for _, record in self._records])
+
+    # The laptop has everything before next_seq
+    def acked(self, next_seq):
+        with self._lock:
+            while self._records and self._records[0][0] < next_seq:
+                self._records.popleft()
+            self._waiting_since = time.monotonic()
+
+    # Records waiting for an ack longer than timeout: the connection is probably dead
+    def stalled(self, timeout=ACK_TIMEOUT):
+        with self._lock:
+            return bool(self._records) and time.monotonic() - self._waiting_since > timeout
+
+scan_spool = ScanSpool()
+
+def pack_command_message(message):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    return CMD_HEADER.pack(CMD_MAGIC, CMD_VERSION, len(body)) + body
+
+# Splits the command byte stream into messages, a partial message is kept for the next feed()
+class CommandReader:
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, data):
+        buf = self._pending + data
+        messages = []
+        start = 0
+        while len(buf) - start >= CMD_HEADER.size:
+            magic, version, length = CMD_HEADER.unpack_from(buf, start)
+            if magic != CMD_MAGIC or version != CMD_VERSION or length > CMD_MAX_BODY:
+                raise ValueError("corrupt command stream")
+            end = start + CMD_HEADER.size + length
+            if end > len(buf):
+                break
+            messages.append(json.loads(buf[start + CMD_HEADER.size:end]))
+            start = end
+        self._pending = buf[start:]
+        return messages
+
 # Continuosly read frames from the FPGA and put them in the UDP and TCP queues
 def continuous_frame_reader():
-    global running
+    global running, frames_read
     init_spi()
     while running:
         if acquisition_enabled:
             #frames = simulate_spi()
             frames = read_frame()
+            t_read = time.time()
             check_parity_frames(frames)
             if frames:
-                udp_message_queue.put(frames)
+                udp_message_queue.put((frames_read, t_read, time.time(), frames))
                 tcp_message_queue.put(frames)
+                frames_read += 1
             time.sleep(0.01)
         else:
             time.sleep(0.1)
@@ -336,28 +474,80 @@ def frame_writer():
 # Send the frames via UDP for the live heatmap
 def udp_sender(ip, port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    seq = 0
     while running:
         try:
-            frames = udp_message_queue.get(timeout=1)
-            sock.sendto(json.dumps(frames).encode(), (ip, port))
+            batch = [udp_message_queue.get(timeout=1)]
+            # Pick up frames that are already waiting, up to UDP_FRAMES_PER_DATAGRAM
+            while len(batch) < UDP_FRAMES_PER_DATAGRAM:
+                try:
+                    batch.append(udp_message_queue.get_nowait())
+                except queue.Empty:
+                    break
+            # LifoQueue hands out the newest frame first, send them oldest first
+            batch.reverse()
+            frame_id, t_read, t_queued, _ = batch[0]
+            datagram = pack_udp_datagram(seq, t_read, [frames for _, _, _, frames in batch], frame_id, t_queued, time.time())
+            sock.sendto(datagram, (ip, port))
+            seq += 1
         except queue.Empty:
             pass
 
-# Send the (location, magnetic data) via TCP to the laptop
+# Reads the laptop's acks until the connection closes, then shuts it down so the sender reconnects
+def read_acks(sock):
+    pending = b""
+    try:
+        while True:
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                continue
+            if not data:
+                break
+            buf = pending + data
+            n = len(buf) // SCAN_ACK.size
+            pending = buf[n * SCAN_ACK.size:]
+            if n:
+                # Only the latest ack matters, it covers the earlier ones
+                magic, version, next_seq = SCAN_ACK.unpack_from(buf, (n - 1) * SCAN_ACK.size)
+                if magic != SCAN_ACK_MAGIC or version != SCAN_RESUME_VERSION:
+                    break
+                scan_spool.acked(next_seq)
+    except OSError:
+        pass
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+# Send the (location, magnetic data) via TCP to the laptop. Every connection starts with the records the
+# laptop has not acked yet, so nothing in flight is lost when the connection drops.
 def tcp_sender(ip, port):
     while running:
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # A send blocked on a dead connection gives up instead of hanging
+            sock.settimeout(ACK_TIMEOUT)
             sock.connect((ip, port))
+            sock.sendall(scan_spool.resume())
+            threading.Thread(target=read_acks, args=(sock,), daemon=True).start()
             while running:
                 try:
-                    block = tcp_send_queue.get(timeout=2)
-                    # Convert block to JSON, append a newline delimiter, and send it.
-                    msg = json.dumps(block).encode() + b"\n"
-                    sock.sendall(msg)
+                    location, frame = tcp_send_queue.get(timeout=2)
+                    msg = [scan_spool.add(location, frame)]
+                    # Coalesce whatever else is already queued into the same sendall
+                    while len(msg) < TCP_BATCH:
+                        try:
+                            location, frame = tcp_send_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        msg.append(scan_spool.add(location, frame))
+                    sock.sendall(b"".join(msg))
                     #print("[TCP SENDER]: Sent")
                 except queue.Empty:
-                    continue
+                    pass
+                if scan_spool.stalled():
+                    raise ConnectionError(f"no ack for {ACK_TIMEOUT:g} s")
         except Exception as e:
             print("[TCP SENDER] Connection error:", e)
             time.sleep(2)
@@ -370,18 +560,42 @@ def tcp_sender(ip, port):
 # This thread only sweeps and makes the motor stable
 def acquisition_thread():
     global counter
+    last_progress = 0.0
     while running:
         if acquisition_enabled:
             sweep()
             motor_stable_event.set()
             counter += 1
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                push_event("progress", counter=counter, theta=n_theta, r=n_r, z=n_z)
+                last_progress = time.monotonic()
             time.sleep(0.01)
         else:
             time.sleep(0.1)
 
-# Listen to commands from the laptop
+# ---------- COMMANDS FROM THE LAPTOP -----------------------
+command_conn = None  # the laptop's command connection, replies and events go out on it
+command_lock = threading.Lock()
+
+# Send a reply or event to the laptop, dropped when it is not connected
+def send_message(message):
+    with command_lock:
+        if command_conn is not None:
+            try:
+                command_conn.sendall(pack_command_message(message))
+            except OSError:
+                pass
+
+def reply(request, **fields):
+    send_message({"id": request.get("id"), "ok": "error" not in fields, **fields})
+
+def push_event(event, **fields):
+    send_message({"event": event, **fields})
+
+# Listen to commands from the laptop. It keeps one connection open; a new connection replaces the old
+# one, which after a Wi-Fi drop can be dead without the Pi having noticed.
 def command_listener(port):
-    global acquisition_enabled, running
+    global command_conn
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind(("0.0.0.0", port))
@@ -389,39 +603,88 @@ def command_listener(port):
     print(f"[CMD LISTENER] Listening on port {port}")
     while running:
         conn, addr = server.accept()
-        with conn:
-            cmd = conn.recv(1024).decode().strip()
-            print(f"[CMD RECEIVED] {cmd}")
-            if cmd == "start":
-                acquisition_enabled = True
-                conn.send(b"started\n")
-            elif cmd == "pause":
-                acquisition_enabled = False
-                conn.sendall(b"Acquisition paused\n")
-            elif cmd == "reset":
-                acquisition_enabled = False
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with command_lock:
+            if command_conn is not None:
+                try:
+                    command_conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            command_conn = conn
+        threading.Thread(target=command_session, args=(conn,), daemon=True).start()
+
+# Read and answer the commands of one connection
+def command_session(conn):
+    global command_conn
+    reader = CommandReader()
+    try:
+        while running:
+            data = conn.recv(4096)
+            if not data:
+                break
+            t_recv = time.time()
+            for message in reader.feed(data):
+                fields = handle_command(message, t_recv)
+                if fields is not None:
+                    reply(message, **fields)
+    except (OSError, ValueError) as e:
+        print(f"[CMD LISTENER] Connection error: {e}")
+    finally:
+        with command_lock:
+            if command_conn is conn:
+                command_conn = None
+        conn.close()
+
+# Returns the reply fields, or None for motor moves, which reply from motion_worker when they are done
+def handle_command(message, t_recv):
+    global acquisition_enabled
+    cmd = message.get("cmd")
+    if cmd == "clock":
+        # Clock offset probe from the laptop (src/Laptop/maglatency.py): receive and reply times
+        return {"t_recv": t_recv, "t_sent": time.time()}
+    print(f"[CMD RECEIVED] {cmd}")
+    if cmd == "start":
+        acquisition_enabled = True
+        return {"status": "Acquisition started"}
+    elif cmd == "pause":
+        acquisition_enabled = False
+        return {"status": "Acquisition paused"}
+    elif cmd == "stop":
+        acquisition_enabled = False
+        tcp_message_queue.queue.clear()
+        udp_message_queue.queue.clear()
+        tcp_send_queue.queue.clear()
+        return {"status": "Acquisition stopped"}
+    elif cmd in ("reset", "move", "jog"):
+        if cmd == "reset":
+            acquisition_enabled = False
+        motion_queue.put(message)
+        return None
+    return {"error": f"unknown command {cmd!r}"}
+
+# Run motor moves one after the other, so the command listener keeps answering (a stop) while they run.
+# move goes to r, theta, z; jog moves by r, theta, z from where the motors are.
+def motion_worker():
+    while running:
+        try:
+            message = motion_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        cmd = message["cmd"]
+        try:
+            if cmd == "reset":
                 reset_r_z()
-                conn.sendall(b"Motors reset\n")
-            elif cmd[:18]=="update coordinates":
-                    parts = cmd.strip().split(",")
-                    r = int(parts[1])   # 100
-                    theta = int(parts[2])  # 45
-                    z = int(parts[3])   # 200
-                    go_to_r_theta_z(r,theta,z)
-            elif cmd[:19]=="update acoordinates":
-                    parts = cmd.strip().split(",")
-                    r = int(parts[1])  + n_r # 100
-                    theta = int(parts[2]) + n_theta# 45
-                    z = int(parts[3]) + n_z  # 200
-                    go_to_r_theta_z(r,theta,z)
-            elif cmd == "stop":
-                acquisition_enabled = False
-                tcp_message_queue.queue.clear()
-                udp_message_queue.queue.clear()
-                tcp_send_queue.queue.clear()
-                conn.send(b"stopped\n")
+                status = "Motors reset"
             else:
-                conn.send(b"unknown\n")
+                r, theta, z = int(message["r"]), int(message["theta"]), int(message["z"])
+                if cmd == "jog":
+                    r, theta, z = r + n_r, theta + n_theta, z + n_z
+                go_to_r_theta_z(r, theta, z)
+                status = f"Reached r={n_r}, θ={n_theta}, z={n_z}"
+        except (KeyError, TypeError, ValueError) as e:
+            reply(message, error=f"bad {cmd} arguments: {e}")
+            continue
+        reply(message, status=status, r=n_r, theta=n_theta, z=n_z)
 
 if __name__ == "__main__":
     # Extract the free ports on the laptop from the argument
@@ -440,6 +703,7 @@ if __name__ == "__main__":
 
     # Begin threads
     cmd_list = threading.Thread(target=command_listener, args=(cmd_port,), daemon=True).start()
+    motion = threading.Thread(target=motion_worker, daemon=True).start()
     frame_reader = threading.Thread(target=continuous_frame_reader, daemon=True).start()
     frm_writer = threading.Thread(target=frame_writer, daemon=True).start()
     tcpsend = threading.Thread(target=tcp_sender, args=(ip, tcp_port), daemon=True).start()